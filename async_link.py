@@ -0,0 +1,425 @@
+"""
+async_link.py
+
+An asyncio version of DataLink for running the marshaller link without the
+GUI, e.g. from a measurement script. It speaks the same protocols, flow
+control and reply scheme as data_link.py, but instead of a QThread watching
+the uart the serial fd is handed to the event loop with add_reader() and
+add_writer(). One loop can drive several rigs with no threads at all.
+
+    async def main():
+        async with AsyncDataLink('/dev/ttyUSB0', protocol=PROTOCOL_FRAMED,
+                                 flow=FLOW_CREDIT, replies=True) as link:
+            done = await link.send(["move_rel", "x", 5.0, True])
+            await done                #the marshaller's reply
+            async for msg in link:    #anything else it says
+                print(msg)
+
+send() returns once the command has been written, handing back an asyncio
+future for its reply. Without replies the future is already done. Sends are
+made in the order send() is called, with blocking commands waiting for
+everything in flight the same way DataLink does it.
+
+PostOfficeLink puts a PostOffice on top of a link: letters posted to the
+link's address are sent in order and their futures completed, and messages
+from the marshaller can be posted on to an address of your choice. The post
+office may be used from any thread.
+
+Nothing here imports PyQt5.
+"""
+import asyncio
+import collections
+import os
+import sys
+
+import command_batcher
+import flow_control
+import wire_protocol
+import trace_ring
+from trace_ring import TRACE
+from post_office import Letter
+from flow_control import FLOW_FIXED_DELAY, FLOW_CREDIT
+from wire_protocol import PROTOCOL_JSON, PROTOCOL_FRAMED, CommandFailed
+
+#Same as data_link.py, which can't be imported without PyQt5.
+SERIAL_PORT      = '/dev/serial0'
+SERIAL_BAUDRATE  = 115200
+SERIAL_SETTLE    = 0.12 #seconds to let the port settle before flushing it
+WRITE_TIME_DELAY = 0.5
+MAX_IN_FLIGHT    = 4
+REPLY_TIMEOUT    = 30.0
+READY_TIMEOUT    = 2.5
+MESSAGE_Q_SIZE   = 50 #unread messages kept for async for, oldest dropped
+READ_SIZE        = 4096
+
+
+class AsyncDataLink:
+    """The marshaller link on an asyncio event loop. open() (or async with)
+    must be called from the loop that will run it."""
+
+    MY_PO_ID = "DataLink_1"
+
+    def __init__(self, port=SERIAL_PORT, flow=FLOW_FIXED_DELAY,
+                 protocol=PROTOCOL_JSON, replies=False,
+                 max_in_flight=MAX_IN_FLIGHT):
+        assert flow in (FLOW_FIXED_DELAY, FLOW_CREDIT), f"unknown flow {flow}"
+        assert not replies or protocol == PROTOCOL_FRAMED, \
+               "replies need the framed protocol to carry sequence ids"
+        self.port = port
+        self.flow = flow
+        self.codec = wire_protocol.codec(protocol)
+        self.send_gate = flow_control.CreditGate(WRITE_TIME_DELAY)
+        self.replies = replies
+        self.max_in_flight = max(int(max_in_flight), 1)
+        self.reply_timeout = REPLY_TIMEOUT
+        self.reply_timeouts = 0
+        self.dropped_messages = 0 #unread messages pushed out by newer ones
+        self.uart = None
+        self._fd = None
+        self._loop = None
+        self._decoder = self.codec.new_decoder()
+        self._out = bytearray() #written to the fd as it becomes writable
+        self._seq = 0
+        self._in_flight = {} #seq: (reply future, blocking, timeout handle)
+        self._blocking_in_flight = 0
+        self._messages = collections.deque()
+        #asyncio objects are made in open() so they belong to the right loop
+        self._send_lock = None
+        self._changed = None       #credit, in flight or output buffer changed
+        self._message_ready = None
+        self._marshaller_ready = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    def is_open(self):
+        return self._fd is not None
+
+    async def open(self):
+        import serial #not needed until a link is opened
+        self._loop = asyncio.get_running_loop()
+        self.uart = serial.Serial(port     = self.port,
+                                  baudrate = SERIAL_BAUDRATE,
+                                  parity   = serial.PARITY_NONE,
+                                  stopbits = serial.STOPBITS_ONE,
+                                  bytesize = serial.EIGHTBITS,
+                                  timeout  = 0)
+        await asyncio.sleep(SERIAL_SETTLE)
+        self.uart.flushInput()
+        self._decoder.reset()
+        self._send_lock = asyncio.Lock()
+        self._changed = asyncio.Event()
+        self._message_ready = asyncio.Event()
+        self._marshaller_ready = asyncio.Event()
+        self._fd = self.uart.fileno()
+        os.set_blocking(self._fd, False)
+        self._loop.add_reader(self._fd, self._on_readable)
+
+    def close(self):
+        """Closes the port. Commands waiting on a reply fail with
+        ConnectionAbortedError and async for comes to an end."""
+        if self._fd is None:
+            return
+        self._loop.remove_reader(self._fd)
+        self._loop.remove_writer(self._fd)
+        self._fd = None
+        self.send_gate.cancel()
+        self.uart.close()
+        self.uart = None
+        self._out.clear()
+        in_flight, self._in_flight = self._in_flight, {}
+        self._blocking_in_flight = 0
+        for future, _, timeout in in_flight.values():
+            timeout.cancel()
+            if not future.done():
+                future.set_exception(ConnectionAbortedError("link closed"))
+        self._changed.set()
+        self._message_ready.set()
+
+    def expect_restart(self):
+        """Call before resetting the marshaller, see wait_ready()."""
+        self._marshaller_ready.clear()
+
+    async def wait_ready(self, timeout=READY_TIMEOUT):
+        """Waits for the marshaller's ready message. False on timeout."""
+        try:
+            await asyncio.wait_for(self._marshaller_ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    #-----------------------------------------------------------------------
+    #Sending
+
+    async def send(self, content):
+        """Writes one command (or any letter content) to the marshaller once
+        flow control and the commands in flight allow it. Returns a future
+        for the reply. Raises ConnectionAbortedError if the link closes
+        first."""
+        async with self._send_lock:
+            blocking = command_batcher.is_blocking(content)
+            await self._wait_until(lambda: self._has_room(blocking))
+            while True:
+                delay = self.send_gate.take()
+                if delay is None:
+                    raise ConnectionAbortedError("link closed")
+                if delay == 0:
+                    break
+                await self._wait_until(None, delay) #an ack may end it early
+            future = self._loop.create_future()
+            seq = None
+            if self.replies:
+                seq = self._seq = self._seq % 0xFFFF + 1
+                timeout = self._loop.call_later(self.reply_timeout,
+                                                self._reply_overdue, seq)
+                self._in_flight[seq] = (future, blocking, timeout)
+                if blocking:
+                    self._blocking_in_flight += 1
+            data = self.codec.encode(content, seq)
+            self._write(data)
+            if TRACE.enabled:
+                TRACE.record(trace_ring.STAGE_WRITE, 0, len(data))
+            await self._wait_until(lambda: not self._out)
+            if not self.replies:
+                future.set_result(None)
+        return future
+
+    def _has_room(self, blocking):
+        if blocking:
+            return not self._in_flight
+        return not self._blocking_in_flight and \
+               len(self._in_flight) < self.max_in_flight
+
+    async def _wait_until(self, ready, timeout=None):
+        """Waits for ready() to be true, rechecking whenever something
+        changes. With ready None, just waits for a change or the timeout."""
+        while True:
+            if self._fd is None:
+                raise ConnectionAbortedError("link closed")
+            if ready is not None and ready():
+                return
+            self._changed.clear()
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            if ready is None:
+                return
+
+    def _write(self, data):
+        if not self._out:
+            try:
+                written = os.write(self._fd, data)
+            except BlockingIOError:
+                written = 0
+            if written == len(data):
+                return
+            data = data[written:]
+            self._loop.add_writer(self._fd, self._on_writable)
+        self._out += data
+
+    def _on_writable(self):
+        try:
+            written = os.write(self._fd, self._out)
+        except BlockingIOError:
+            return
+        del self._out[:written]
+        if not self._out:
+            self._loop.remove_writer(self._fd)
+            self._changed.set()
+
+    #-----------------------------------------------------------------------
+    #Receiving
+
+    def _on_readable(self):
+        try:
+            data = os.read(self._fd, READ_SIZE)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            print(f"AsyncDataLink: {self.port} read failed, {e}")
+            self.close()
+            return
+        if not data:
+            return
+        if TRACE.enabled:
+            TRACE.record(trace_ring.STAGE_RX_BYTES, 0, len(data))
+        #feed(), not messages(): samples are queued past the next read, so
+        #their data has to be a copy rather than a view into the frame buffer
+        for msg in self._decoder.feed(data):
+            self._message_received(msg)
+
+    def _message_received(self, msg):
+        ctrl = wire_protocol.control_message(msg)
+        if ctrl is not None:
+            kind, count = ctrl
+            if kind == wire_protocol.CTRL_READY:
+                if self.flow == FLOW_CREDIT and count > 0:
+                    self.send_gate.window(count)
+                self._marshaller_ready.set()
+                self._changed.set()
+            elif self.flow == FLOW_CREDIT:
+                if kind == wire_protocol.CTRL_WINDOW:
+                    self.send_gate.window(count)
+                else:
+                    self.send_gate.ack(count)
+                self._changed.set()
+            return
+        if TRACE.enabled:
+            TRACE.record(trace_ring.STAGE_RX_MSG)
+        if self.replies:
+            reply = wire_protocol.reply_message(msg)
+            if reply is not None:
+                self._reply_received(*reply)
+                return
+        if len(self._messages) >= MESSAGE_Q_SIZE:
+            self._messages.popleft()
+            self.dropped_messages += 1
+        self._messages.append(msg)
+        self._message_ready.set()
+
+    def _take_in_flight(self, seq):
+        entry = self._in_flight.pop(seq, None)
+        if entry is not None:
+            if entry[1]:
+                self._blocking_in_flight -= 1
+            entry[2].cancel()
+            self._changed.set()
+        return entry
+
+    def _reply_received(self, seq, status, result):
+        entry = self._take_in_flight(seq)
+        if entry is None or entry[0].done():
+            return #late reply to something that already timed out
+        if status == wire_protocol.STATUS_OK:
+            entry[0].set_result(result)
+        else:
+            entry[0].set_exception(CommandFailed(status, result))
+
+    def _reply_overdue(self, seq):
+        entry = self._take_in_flight(seq)
+        if entry is None:
+            return
+        self.reply_timeouts += 1
+        print(f"AsyncDataLink: no reply to seq {seq} in {self.reply_timeout}s")
+        if not entry[0].done():
+            entry[0].set_exception(TimeoutError("no reply from marshaller"))
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        """Next message from the marshaller that isn't flow control or a
+        reply. Ends when the link is closed."""
+        while not self._messages:
+            if self._fd is None:
+                raise StopAsyncIteration
+            self._message_ready.clear()
+            await self._message_ready.wait()
+        return self._messages.popleft()
+
+
+class PostOfficeLink:
+    """Lets a PostOffice use an AsyncDataLink the way it uses DataLink.
+    run() registers po_id with the post office and sends every letter posted
+    to it, in order, completing the letter's future (if it has one) when the
+    reply comes. Messages from the marshaller are posted to deliver_to when
+    it is given."""
+
+    def __init__(self, link, post_office, po_id=AsyncDataLink.MY_PO_ID,
+                 deliver_to=None):
+        self.link = link
+        self.post_office = post_office
+        self.po_id = po_id
+        self.deliver_to = deliver_to
+        self._loop = None
+        self._letters = None
+
+    def _letter_posted(self, letter):
+        #Any thread. The loop takes it from here.
+        self._loop.call_soon_threadsafe(self._letters.put_nowait, letter)
+
+    def stop(self):
+        """Makes run() return. Safe from any thread."""
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._letters.put_nowait, None)
+
+    async def run(self):
+        """Sends letters until stop() is called or the link closes."""
+        self._loop = asyncio.get_running_loop()
+        self._letters = asyncio.Queue()
+        self.post_office.register(self.po_id, self._letter_posted)
+        incoming = asyncio.ensure_future(self._deliver())
+        try:
+            while self.link.is_open():
+                letter = await self._letters.get()
+                if letter is None:
+                    break
+                await self._send_letter(letter)
+        finally:
+            incoming.cancel()
+
+    async def _send_letter(self, letter):
+        future = letter.future()
+        if future is not None and not future.set_running_or_notify_cancel():
+            return #cancelled while it waited
+        try:
+            reply = await self.link.send(letter.content())
+        except ConnectionAbortedError as e:
+            if future is not None:
+                future.set_exception(e)
+            return
+        if future is not None:
+            reply.add_done_callback(lambda done: _copy_outcome(done, future))
+
+    async def _deliver(self):
+        async for msg in self.link:
+            if self.deliver_to is not None:
+                self.post_office.post(Letter(self.deliver_to, self.po_id, msg))
+
+
+def _copy_outcome(done, future):
+    """Passes an asyncio future's outcome on to a concurrent.futures one."""
+    if done.cancelled():
+        future.set_exception(ConnectionAbortedError("link closed"))
+    elif done.exception() is not None:
+        future.set_exception(done.exception())
+    else:
+        future.set_result(done.result())
+
+
+if __name__ == "__main__":
+    #Drives two simulated rigs from one loop: python async_link.py [count]
+    import time
+    import marshaller_sim
+
+    async def drive(sim, count):
+        async with AsyncDataLink(sim.port, flow=FLOW_CREDIT,
+                                 protocol=PROTOCOL_FRAMED,
+                                 replies=True) as link:
+            sim.announce()
+            start = time.perf_counter()
+            replies = [await link.send(["move_rel", "x", 1.0, False])
+                       for i in range(count)]
+            await asyncio.gather(*replies)
+            return count / (time.perf_counter() - start)
+
+    async def main(count):
+        sims = [marshaller_sim.MarshallerSim(window=4, protocol=PROTOCOL_FRAMED,
+                                             replies=True, exec_time=0.02)
+                for i in range(2)]
+        for sim in sims:
+            sim.start()
+        try:
+            rates = await asyncio.gather(*(drive(sim, count) for sim in sims))
+        finally:
+            for sim in sims:
+                sim.stop()
+        for sim, rate in zip(sims, rates):
+            print(f"{sim.port}: {count} commands, {rate:.1f} cmds/s")
+
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 50))
@@ -0,0 +1,70 @@
+"""
+axis_model.py
+
+Rough timing model of the rig's axes, used to estimate how long low-level
+commands take. The command optimizer uses it to say how much time it saved
+and planners can use it to compare routes.
+
+Each travel axis is an AxisModel: it accelerates at accel up to speed, cruises
+and slows down again (a trapezoid, or a triangle for moves too short to reach
+speed), and every command also costs overhead seconds for the marshaller and
+axis controller to get it going and report done. z only goes up and down and
+each toggle takes Z_TOGGLE_TIME.
+
+The numbers are estimates in user units (inches) and seconds. Measure them on
+the rig and put the real ones here.
+"""
+import math
+
+Z_TOGGLE_TIME = 0.4 #seconds for z_up or z_down
+COMMAND_OVERHEAD = 0.05 #seconds per command on top of any travel
+
+
+class AxisModel:
+
+    def __init__(self, speed, accel, overhead=COMMAND_OVERHEAD):
+        self.speed = speed #inches/s
+        self.accel = accel #inches/s/s
+        self.overhead = overhead
+
+    def move_time(self, distance):
+        """Seconds to move distance inches (either direction), overhead
+        included."""
+        distance = abs(distance)
+        ramp = self.speed * self.speed / self.accel #accelerate + decelerate
+        if distance < ramp:
+            travel = 2.0 * math.sqrt(distance / self.accel)
+        else:
+            travel = distance / self.speed + self.speed / self.accel
+        return self.overhead + travel
+
+
+AXES = {
+    'x': AxisModel(speed=1.0, accel=4.0),
+    'y': AxisModel(speed=1.0, accel=4.0),
+    }
+_DEFAULT_AXIS = AxisModel(speed=1.0, accel=4.0)
+
+
+def axis_model(axis):
+    return AXES.get(axis, _DEFAULT_AXIS)
+
+
+def move_time(axis, distance):
+    return axis_model(axis).move_time(distance)
+
+
+def command_time(cmd, increment=None):
+    """Estimated seconds for one low-level command [name, axis, parm, block].
+    increment is the distance an inc_ command moves, if known."""
+    name, axis, parm = cmd[0], cmd[1], cmd[2]
+    if name in ('z_up', 'z_down'):
+        return Z_TOGGLE_TIME
+    if name == 'move_rel':
+        try:
+            return move_time(axis, float(parm))
+        except (TypeError, ValueError):
+            pass
+    elif name.startswith('inc_') and increment is not None:
+        return move_time(axis, increment)
+    return COMMAND_OVERHEAD
@@ -0,0 +1,1311 @@
+"""
+benchmarks.py
+
+Benchmarks for the commander's communication path. These run against the
+pty-backed marshaller stand-in in marshaller_sim.py, so no esp32 is needed.
+
+usage: python benchmarks.py latency [--count N] [--protocol P]
+       python benchmarks.py throughput [--count N] [--ready-delay S]
+                                       [--protocol P]
+       python benchmarks.py wire [--count N]
+       python benchmarks.py batch [--count N] [--ready-delay S]
+       python benchmarks.py routing [--posts N]
+       python benchmarks.py alloc [--count N]
+       python benchmarks.py trace [--posts N]
+       python benchmarks.py replies [--count N] [--exec-time S]
+       python benchmarks.py startup [--boot-delay S [S ...]]
+       python benchmarks.py suite [--configs C ...] [--workloads W ...]
+                                  [--moves N] [--burst N] [--grid N]
+                                  [--ready-delay S] [--exec-time S]
+                                  [--response-size N] [--drop-rate P]
+                                  [--garble-rate P] [--seed N]
+       python benchmarks.py script [--grid N] [--config C]
+       python benchmarks.py peephole [--points N] [--exec-time S]
+       python benchmarks.py scan [--points N [N ...]] [--seed N]
+       python benchmarks.py barrier [--count N] [--x-time S] [--y-time S]
+       python benchmarks.py stop [--queued N] [--ready-delay S]
+       python benchmarks.py backpressure [--count N] [--exec-time S]
+       python benchmarks.py inbound [--rates N [N ...]] [--seconds S]
+       python benchmarks.py telemetry [--rates N [N ...]] [--seconds S]
+       python benchmarks.py store [--sessions N] [--rows N]
+       python benchmarks.py isobar [--width IN] [--height IN] [--step IN]
+       python benchmarks.py graph [--step IN] [--interval S]
+
+suite is the one to use for checking a performance change end to end. It
+runs representative workloads (single moves, a burst of to_point commands
+and a full grid scan with z down/up at every point) through
+CommandInterpreter, PostOffice and DataLink to the simulator, for each link
+configuration, and reports low-level commands per second, the latency from
+send_command() to the command finishing on its axis (p50/p95/p99), CPU use
+and commands lost. CPU is for the whole process, so it includes the
+simulator's threads.
+"""
+import argparse
+import collections
+import concurrent.futures
+import contextlib
+import gc
+import json
+import math
+import os
+import queue
+import random
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import command_optimizer
+import command_script
+import commands
+import data_link
+import graph_process
+import isobar
+import marshaller_sim
+import measurement_store
+import response_view
+import scan_planner
+import send_queue
+import telemetry
+import wire_protocol
+import trace_ring
+from post_office import PostOffice, Letter
+
+_BENCH_PO_ID = "Bench"
+_PROTOCOLS = (wire_protocol.PROTOCOL_JSON, wire_protocol.PROTOCOL_FRAMED)
+_TEST_CMD = ["move_rel", "x", "1.0", True]
+
+
+def percentile(values, pct):
+    """Returns the pct percentile (0-100) of values using nearest rank."""
+    ordered = sorted(values)
+    if not ordered:
+        return float('nan')
+    rank = int(round(pct / 100.0 * (len(ordered) - 1)))
+    return ordered[rank]
+
+
+@contextlib.contextmanager
+def _quiet():
+    """The communication path prints on every message. Keep that out of the
+    benchmark report."""
+    with open(os.devnull, 'w') as devnull, \
+         contextlib.redirect_stdout(devnull):
+        yield
+
+
+@contextlib.contextmanager
+def _running_link(sim, **link_options):
+    """Starts a DataLink on the simulator's pty and stops it afterward."""
+    po = PostOffice("benchmarks.py")
+    po.register(_BENCH_PO_ID, lambda letter: None)
+    link = data_link.DataLink(po, port=sim.port, **link_options)
+    link.start()
+    if not link.port_open.wait(5.0):
+        raise RuntimeError(f"DataLink never opened {sim.port}")
+    try:
+        yield po, link
+    finally:
+        link.stop()
+        link.wait()
+
+
+def bench_latency(io_mode, count=20, protocol=wire_protocol.PROTOCOL_JSON):
+    """Time from PostOffice.post() to the bytes arriving at the marshaller,
+    for letters spaced far enough apart that WRITE_TIME_DELAY never kicks in.
+    Also reports the CPU the process used while the link sat idle."""
+    sim = marshaller_sim.MarshallerSim(protocol=protocol)
+    sim.start()
+    latencies = []
+    try:
+        with _quiet(), _running_link(sim, io_mode=io_mode,
+                                     protocol=protocol) as (po, link):
+            idle_wall = time.perf_counter()
+            idle_cpu = time.process_time()
+            time.sleep(1.0)
+            idle_cpu = (time.process_time() - idle_cpu) / \
+                       (time.perf_counter() - idle_wall)
+            for i in range(count):
+                time.sleep(data_link.WRITE_TIME_DELAY * 1.2)
+                sent = time.perf_counter()
+                po.post(Letter(data_link.DataLink.MY_PO_ID, _BENCH_PO_ID,
+                               list(_TEST_CMD)))
+                if not sim.wait_for(i + 1, timeout=5.0):
+                    raise RuntimeError(f"letter {i} never reached the marshaller")
+                latencies.append(sim.arrivals[i][0] - sent)
+    finally:
+        sim.stop()
+    return latencies, idle_cpu
+
+
+def bench_throughput(flow, window, count=30, ready_delay=0.05,
+                     protocol=wire_protocol.PROTOCOL_JSON):
+    """Posts count commands as fast as the queue takes them and times how
+    long the simulator takes to process them all. The simulator's uart needs
+    ready_delay to recover after each message."""
+    sim = marshaller_sim.MarshallerSim(ready_delay=ready_delay, window=window,
+                                       protocol=protocol)
+    sim.start()
+    try:
+        with _quiet(), _running_link(sim, io_mode=data_link.IO_EVENT,
+                                     flow=flow, protocol=protocol) as (po, link):
+            sim.announce()
+            time.sleep(0.1) #let the window advert land
+            start = time.perf_counter()
+            for i in range(count):
+                po.post(Letter(data_link.DataLink.MY_PO_ID, _BENCH_PO_ID,
+                               list(_TEST_CMD)))
+            if not sim.wait_processed(count, timeout=count * 2.0):
+                raise RuntimeError("simulator never caught up")
+            elapsed = time.perf_counter() - start
+    finally:
+        sim.stop()
+    return count / elapsed, sim.dropped
+
+
+def run_throughput(args):
+    print(f"{args.count} commands, simulated uart ready delay "
+          f"{args.ready_delay * 1000.0:.0f} ms")
+    print(f"{'flow':>12} {'window':>7} {'cmds/s':>8} {'dropped':>8}")
+    for flow, window in ((data_link.FLOW_FIXED_DELAY, None),
+                         (data_link.FLOW_CREDIT, None),
+                         (data_link.FLOW_CREDIT, 1),
+                         (data_link.FLOW_CREDIT, 4)):
+        rate, dropped = bench_throughput(flow, window, args.count,
+                                         args.ready_delay, args.protocol)
+        print(f"{flow:>12} {str(window):>7} {rate:8.2f} {dropped:8d}")
+
+
+def bench_batch(coalesce, max_batch, count=20, ready_delay=0.05):
+    """Sends count to_point x&y user commands through CommandInterpreter and
+    times how long the simulator takes to run all the low-level commands.
+    Uses the framed protocol and credit flow control so the uart ready delay
+    is the only limit."""
+    protocol = wire_protocol.PROTOCOL_FRAMED
+    sim = marshaller_sim.MarshallerSim(ready_delay=ready_delay, window=1,
+                                       protocol=protocol)
+    sim.start()
+    try:
+        with _quiet(), _running_link(sim, io_mode=data_link.IO_EVENT,
+                                     flow=data_link.FLOW_CREDIT,
+                                     protocol=protocol,
+                                     max_batch=max_batch) as (po, link):
+            interpreter = commands.CommandInterpreter(po, coalesce=coalesce)
+            sim.announce()
+            time.sleep(0.1)
+            start = time.perf_counter()
+            for i in range(count):
+                interpreter.send_command("to_point", "x&y",
+                                         [str(i), str(i + 1)], True)
+            deadline = start + count * 4.0
+            while sim.commands_processed() < count * 2:
+                if time.perf_counter() > deadline:
+                    raise RuntimeError("simulator never caught up")
+                time.sleep(0.01)
+            elapsed = time.perf_counter() - start
+            stats = link.batcher.stats()
+    finally:
+        sim.stop()
+    return count * 2 / elapsed, stats
+
+
+def run_batch(args):
+    print(f"{args.count} to_point x&y commands, simulated uart ready delay "
+          f"{args.ready_delay * 1000.0:.0f} ms")
+    print(f"{'coalesce':>9} {'max_batch':>10} {'cmds/s':>8} {'frames':>7} "
+          f"{'saved':>6}")
+    for coalesce, max_batch in ((False, 1), (True, 1), (False, 8)):
+        rate, stats = bench_batch(coalesce, max_batch, args.count,
+                                  args.ready_delay)
+        print(f"{str(coalesce):>9} {max_batch:10d} {rate:8.2f} "
+              f"{stats['frames_out']:7d} {stats['frames_saved']:6d}")
+
+
+def bench_routing(subscribers, posts=20000):
+    """posts/s and deliveries/s for one topic with the given number of
+    subscribers, against posting the same letter to each of them in turn."""
+    po = PostOffice("benchmarks.py")
+    delivered = [0]
+    def count(letter):
+        delivered[0] += 1
+    for i in range(subscribers):
+        po.register(f"sub{i}", count)
+        po.subscribe("bench.topic", count)
+    letter = Letter("bench.topic", _BENCH_PO_ID, list(_TEST_CMD))
+    singles = [Letter(f"sub{i}", _BENCH_PO_ID, list(_TEST_CMD))
+               for i in range(subscribers)]
+    with _quiet():
+        start = time.perf_counter()
+        for _ in range(posts):
+            po.post(letter)
+        topic_time = time.perf_counter() - start
+        start = time.perf_counter()
+        for _ in range(posts):
+            for single in singles:
+                po.post(single)
+        each_time = time.perf_counter() - start
+    assert delivered[0] == 2 * posts * subscribers
+    return posts / topic_time, posts * subscribers / topic_time, \
+           posts * subscribers / each_time
+
+
+def run_routing(args):
+    print(f"{args.posts} posts to one topic, synchronous delivery")
+    print(f"{'subs':>5} {'posts/s':>10} {'deliv/s':>10} {'1-by-1 deliv/s':>15}")
+    for subscribers in (1, 2, 4, 8, 16, 32):
+        rate, deliveries, each = bench_routing(subscribers, args.posts)
+        print(f"{subscribers:5d} {rate:10.0f} {deliveries:10.0f} {each:15.0f}")
+
+
+class _DictLetter:
+    """Letter the way it was before __slots__, for comparison."""
+    def __init__(self, destination_id=None, source_id=None, info=None):
+        self._to = destination_id
+        self._from = source_id
+        self._content = info
+
+    def letter_to_list(self):
+        return [self._to, self._from, self._content]
+
+
+def _kept_per_call(fn, count):
+    """Memory blocks and bytes still allocated per call after calling fn
+    count times and keeping what it returns."""
+    keep = [None] * count #allocated before tracing starts
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for i in range(count):
+        keep[i] = fn()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    stats = after.compare_to(before, 'filename')
+    blocks = sum(stat.count_diff for stat in stats)
+    size = sum(stat.size_diff for stat in stats)
+    return blocks / count, size / count
+
+
+def bench_alloc(count=10000):
+    dest, src = data_link.DataLink.MY_PO_ID, _BENCH_PO_ID
+    content = list(_TEST_CMD) #shared, so only the letter itself is counted
+    buf = bytearray(256)
+    view = memoryview(buf)
+
+    def old_round_trip():
+        letter = _DictLetter(dest, src, content)
+        as_list = letter.letter_to_list()
+        wire = json.dumps(as_list).encode('utf-8')
+        back = json.loads(wire)
+        return _DictLetter(back[0], back[1], back[2])
+
+    future = concurrent.futures.Future() #shared too
+
+    def command_letter():
+        letter = Letter(dest, src, content)
+        letter.set_future(future)
+        return letter
+
+    def new_round_trip():
+        letter = Letter(dest, src, content)
+        letter.pack_into(view)
+        return Letter.unpack_from(view)[0]
+
+    return {'old letter': _kept_per_call(lambda: _DictLetter(dest, src, content),
+                                         count),
+            'slotted letter': _kept_per_call(lambda: Letter(dest, src, content),
+                                             count),
+            'with a future': _kept_per_call(command_letter, count),
+            'old round trip': _kept_per_call(old_round_trip, count),
+            'packed round trip': _kept_per_call(new_round_trip, count)}
+
+
+def run_alloc(args):
+    print(f"memory kept per letter over {args.count} letters")
+    print(f"{'':>18} {'blocks':>7} {'bytes':>7}")
+    for name, (blocks, size) in bench_alloc(args.count).items():
+        print(f"{name:>18} {blocks:7.2f} {size:7.1f}")
+
+
+def bench_trace(posts=100000):
+    """Cost of one record() call, and of a synchronous post with tracing
+    off and on."""
+    ring = trace_ring.TraceRing()
+    start = time.perf_counter()
+    for i in range(posts):
+        ring.record(trace_ring.STAGE_POST, i, 0)
+    record_ns = (time.perf_counter() - start) / posts * 1e9
+
+    po = PostOffice("benchmarks.py")
+    po.register(_BENCH_PO_ID, lambda letter: None)
+    letter = Letter(_BENCH_PO_ID, _BENCH_PO_ID, list(_TEST_CMD))
+    was_enabled = trace_ring.TRACE.enabled
+    post_ns = {}
+    try:
+        for enabled in (False, True):
+            trace_ring.TRACE.enabled = enabled
+            start = time.perf_counter()
+            for i in range(posts):
+                po.post(letter)
+            post_ns[enabled] = (time.perf_counter() - start) / posts * 1e9
+    finally:
+        trace_ring.TRACE.enabled = was_enabled
+    return record_ns, post_ns[False], post_ns[True]
+
+
+def run_trace(args):
+    record_ns, off_ns, on_ns = bench_trace(args.posts)
+    print(f"record(): {record_ns:.0f} ns")
+    print(f"post() tracing off: {off_ns:.0f} ns, on: {on_ns:.0f} ns")
+
+
+_WIRE_SAMPLES = [
+    ["move_rel", "x", "1.25", True],
+    ["z_up", "z", [], True],
+    ["to_point", "y", "12.5", True],
+    ["set_axis_mac_ids", "m", [["m", "c4:dd:57:b8:e8:e8"],
+                               ["x", "3c:61:05:4b:0c:f8"]], False],
+    ]
+
+
+def bench_wire(protocol, count=20000):
+    """Bytes per message for each sample and decode rate for a stream of
+    count messages fed in 64 byte chunks, like uart reads."""
+    codec = wire_protocol.codec(protocol)
+    sizes = [len(codec.encode(m)) for m in _WIRE_SAMPLES]
+    stream = b''.join(codec.encode(_WIRE_SAMPLES[i % len(_WIRE_SAMPLES)])
+                      for i in range(count))
+    decoder = codec.new_decoder()
+    decoded = 0
+    start = time.perf_counter()
+    for i in range(0, len(stream), 64):
+        decoded += len(decoder.feed(stream[i:i + 64]))
+    elapsed = time.perf_counter() - start
+    assert decoded == count, f"decoded {decoded} of {count}"
+    return sizes, count / elapsed
+
+
+def run_wire(args):
+    names = [m[0] for m in _WIRE_SAMPLES]
+    print(f"bytes on the wire per message, decode rate over {args.count} messages")
+    print(f"{'protocol':>9} " + " ".join(f"{n[:10]:>10}" for n in names) +
+          f" {'msgs/s':>10}")
+    for protocol in (wire_protocol.PROTOCOL_JSON, wire_protocol.PROTOCOL_FRAMED):
+        sizes, rate = bench_wire(protocol, args.count)
+        print(f"{protocol:>9} " + " ".join(f"{n:10d}" for n in sizes) +
+              f" {rate:10.0f}")
+
+
+def bench_replies(block, max_in_flight, count=20, exec_time=0.05):
+    """Sends count sequenced commands, round robin over the four axes, to a
+    simulator that takes exec_time to run each one and times how long until
+    every future is done."""
+    protocol = wire_protocol.PROTOCOL_FRAMED
+    sim = marshaller_sim.MarshallerSim(window=8, protocol=protocol,
+                                       replies=True, exec_time=exec_time)
+    sim.start()
+    try:
+        with _quiet(), _running_link(sim, io_mode=data_link.IO_EVENT,
+                                     flow=data_link.FLOW_CREDIT,
+                                     protocol=protocol, replies=True,
+                                     max_in_flight=max_in_flight) as (po, link):
+            sim.announce()
+            time.sleep(0.1)
+            futures = []
+            start = time.perf_counter()
+            for i in range(count):
+                letter = Letter(data_link.DataLink.MY_PO_ID, _BENCH_PO_ID,
+                                ["move_rel", "xyzt"[i % 4], 1.0, block])
+                letter.set_future(concurrent.futures.Future())
+                futures.append(letter.future())
+                po.post(letter)
+            done, pending = concurrent.futures.wait(futures,
+                                                    timeout=count * exec_time + 5.0)
+            elapsed = time.perf_counter() - start
+    finally:
+        sim.stop()
+    if pending:
+        raise RuntimeError(f"{len(pending)} commands never got a reply")
+    return count / elapsed
+
+
+def run_replies(args):
+    print(f"{args.count} commands, simulated execution time "
+          f"{args.exec_time * 1000.0:.0f} ms")
+    print(f"{'blocking':>9} {'in flight':>10} {'cmds/s':>8}")
+    for block, max_in_flight in ((True, 1), (False, 1), (False, 4), (False, 8)):
+        rate = bench_replies(block, max_in_flight, args.count, args.exec_time)
+        print(f"{str(block):>9} {max_in_flight:10d} {rate:8.2f}")
+
+
+_LEGACY_STARTUP_WAIT = 0.3 + 1.5 #the sleeps CmdInputDisplay used to make
+
+
+def bench_startup(handshake, boot_delay):
+    """Resets the simulator and times how long until the axis ids reach it,
+    either waiting for its ready message or sleeping the old fixed time.
+    Returns None if the axis ids were lost because it was still booting."""
+    sim = marshaller_sim.MarshallerSim(boot_delay=boot_delay,
+                                       says_ready=handshake)
+    sim.start()
+    try:
+        with _quiet(), _running_link(sim, io_mode=data_link.IO_EVENT) as (po, link):
+            start = time.perf_counter()
+            link.expect_restart()
+            sim.restart()
+            if handshake:
+                link.wait_ready(boot_delay + data_link.READY_TIMEOUT)
+            else:
+                time.sleep(_LEGACY_STARTUP_WAIT)
+            po.post(Letter(data_link.DataLink.MY_PO_ID, _BENCH_PO_ID,
+                           ["set_axis_mac_ids", "m",
+                            [["x", "24:0a:c4:00:00:01"]], False]))
+            arrived = sim.wait_for(1, timeout=1.0)
+    finally:
+        sim.stop()
+    if not arrived:
+        return None
+    return sim.arrivals[0][0] - start
+
+
+def run_startup(args):
+    print("reset -> axis ids at the marshaller")
+    print(f"{'boot s':>7} {'fixed wait s':>13} {'handshake s':>12}")
+    for boot_delay in args.boot_delay:
+        times = [bench_startup(handshake, boot_delay)
+                 for handshake in (False, True)]
+        print(f"{boot_delay:7.2f} " + " ".join(
+            f"{'lost' if t is None else f'{t:.3f}':>{w}}"
+            for t, w in zip(times, (13, 12))))
+
+
+#Link setups compared by the suite. coalesce and concurrent are for the
+#CommandInterpreter.
+_SUITE_CONFIGS = collections.OrderedDict((
+    ('legacy', dict(io_mode=data_link.IO_POLLED, flow=data_link.FLOW_FIXED_DELAY,
+                    protocol=wire_protocol.PROTOCOL_JSON)),
+    ('event', dict(io_mode=data_link.IO_EVENT, flow=data_link.FLOW_CREDIT,
+                   protocol=wire_protocol.PROTOCOL_JSON)),
+    ('framed', dict(io_mode=data_link.IO_EVENT, flow=data_link.FLOW_CREDIT,
+                    protocol=wire_protocol.PROTOCOL_FRAMED, replies=True)),
+    ('batched', dict(io_mode=data_link.IO_EVENT, flow=data_link.FLOW_CREDIT,
+                     protocol=wire_protocol.PROTOCOL_FRAMED, replies=True,
+                     max_batch=8, coalesce=True)),
+    ('grouped', dict(io_mode=data_link.IO_EVENT, flow=data_link.FLOW_CREDIT,
+                     protocol=wire_protocol.PROTOCOL_FRAMED, replies=True,
+                     concurrent=True)),
+    ))
+_WORKLOADS = ('moves', 'to_point', 'grid')
+_NO_PROGRESS = 5.0 #seconds without a command finishing before giving up
+
+
+def workload(name, args):
+    """Returns the user commands for a workload as (name, axes, parms,
+    block). Parms are all different so finished commands can be matched
+    back to when they were sent."""
+    if name == 'moves':
+        return [("move_rel", "x", [str((i + 1) * (-1) ** i)], True)
+                for i in range(args.moves)]
+    if name == 'to_point':
+        return [("to_point", "x&y", [f"{i * 0.5:.1f}", f"{i * 0.25:.2f}"], True)
+                for i in range(args.burst)]
+    cmds = []
+    for row in range(args.grid):
+        for col in range(args.grid):
+            x = col if row % 2 == 0 else args.grid - 1 - col #snake
+            cmds.append(("to_point", "x&y", [f"{x:.1f}", f"{row:.1f}"], True))
+            cmds.append(("z_down", "z", [], True))
+            cmds.append(("z_up", "z", [], True))
+    return cmds
+
+
+def _command_key(cmd):
+    """(name, axis, parm) with the parm as it comes out of either protocol."""
+    parm = cmd[2]
+    if type(parm) is list:
+        parm = None
+    else:
+        try:
+            parm = round(float(parm), 3)
+        except (TypeError, ValueError):
+            parm = str(parm)
+    return cmd[0], cmd[1], parm
+
+
+def bench_suite(config, user_cmds, sim_options):
+    """Runs user_cmds through a CommandInterpreter on a link set up as
+    config. Returns (low-level commands, cmds/s, latencies, cpu fraction,
+    lost)."""
+    link_options = dict(_SUITE_CONFIGS[config])
+    coalesce = link_options.pop('coalesce', False)
+    concurrent_axes = link_options.pop('concurrent', False)
+    sim = marshaller_sim.MarshallerSim(window=4, replies=True,
+                                       protocol=link_options['protocol'],
+                                       **sim_options)
+    sim.start()
+    sent = collections.defaultdict(collections.deque)
+    expected = 0
+    try:
+        with _quiet(), _running_link(sim, **link_options) as (po, link):
+            interpreter = commands.CommandInterpreter(
+                po, coalesce=coalesce, concurrent=concurrent_axes)
+            sim.announce()
+            time.sleep(0.1)
+            cpu_start = time.process_time()
+            start = time.perf_counter()
+            for name, axes, parms, block in user_cmds:
+                link.wait_clear()
+                now = time.perf_counter()
+                for cmd in interpreter.create_low_level_public_cmd_list(
+                        name, axes, parms, block):
+                    sent[_command_key(cmd)].append(now)
+                    expected += 1
+                interpreter.send_command(name, axes, parms, block)
+            finished = 0
+            while not sim.wait_completed(expected, timeout=_NO_PROGRESS):
+                if len(sim.completed) == finished:
+                    break #stuck, the rest are lost
+                finished = len(sim.completed)
+            end = time.perf_counter()
+            cpu = (time.process_time() - cpu_start) / (end - start)
+    finally:
+        sim.stop()
+    latencies = []
+    for done, cmd in sim.completed:
+        times = sent.get(_command_key(cmd))
+        if times:
+            latencies.append(done - times.popleft())
+    last = max((done for done, _ in sim.completed), default=end)
+    rate = len(sim.completed) / (last - start)
+    return expected, rate, latencies, cpu, expected - len(latencies)
+
+
+def run_suite(args):
+    sim_options = dict(ready_delay=args.ready_delay, exec_time=args.exec_time,
+                       response_size=args.response_size,
+                       drop_rate=args.drop_rate, garble_rate=args.garble_rate,
+                       seed=args.seed)
+    print(f"simulated marshaller: {sim_options}")
+    print(f"{'config':>8} {'workload':>9} {'cmds':>5} {'cmds/s':>8} "
+          f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'cpu':>6} {'lost':>5}")
+    for config in args.configs:
+        for name in args.workloads:
+            count, rate, latencies, cpu, lost = bench_suite(
+                config, workload(name, args), sim_options)
+            ms = [t * 1000.0 for t in latencies]
+            print(f"{config:>8} {name:>9} {count:5d} {rate:8.1f} "
+                  f"{percentile(ms, 50):8.1f} {percentile(ms, 95):8.1f} "
+                  f"{percentile(ms, 99):8.1f} {cpu * 100.0:5.1f}% {lost:5d}")
+
+
+def bench_script(config, user_cmds, how, player=None, path=None):
+    """Runs user_cmds to the simulator either live, through send_command()
+    one at a time, or by replaying the script at path with player. Returns
+    (low-level commands, seconds until the last one finished, CPU seconds)."""
+    link_options = dict(_SUITE_CONFIGS[config])
+    coalesce = link_options.pop('coalesce', False)
+    concurrent_axes = link_options.pop('concurrent', False)
+    sim = marshaller_sim.MarshallerSim(window=8, replies=True,
+                                       protocol=link_options['protocol'])
+    sim.start()
+    try:
+        with _quiet(), _running_link(sim, **link_options) as (po, link):
+            interpreter = commands.CommandInterpreter(
+                po, coalesce=coalesce, concurrent=concurrent_axes)
+            sim.announce()
+            time.sleep(0.1)
+            cpu_start = time.process_time()
+            start = time.perf_counter()
+            if how == 'live':
+                futures = []
+                for name, axes, parms, block in user_cmds:
+                    link.wait_clear()
+                    futures += interpreter.send_command(name, axes, parms,
+                                                        block)
+                concurrent.futures.wait(futures, timeout=60.0)
+            else:
+                player.interpreter = interpreter
+                player.codec = link.codec
+                player.link = link
+                if not player.play(path):
+                    raise RuntimeError(f"replay failed, {player.error!r}")
+            count = len(sim.completed)
+            elapsed = time.perf_counter() - start
+            cpu = time.process_time() - cpu_start
+    finally:
+        sim.stop()
+    return count, elapsed, cpu
+
+
+def run_script(args):
+    user_cmds = workload('grid', args)
+    fd, path = tempfile.mkstemp(suffix=".jsonl")
+    os.close(fd)
+    recorder = command_script.ScriptRecorder(path)
+    for cmd in user_cmds:
+        recorder.record(*cmd)
+    recorder.close()
+    player = command_script.ScriptPlayer(None, None)
+    print(f"{args.grid}x{args.grid} grid, {len(user_cmds)} user commands, "
+          f"{args.config} link")
+    print(f"{'run':>14} {'cmds':>5} {'cmds/s':>8} {'cpu us/cmd':>11}")
+    try:
+        for how in ('live', 'replay', 'cached replay'):
+            count, elapsed, cpu = bench_script(args.config, user_cmds, how,
+                                               player, path)
+            print(f"{how:>14} {count:5d} {count / elapsed:8.1f} "
+                  f"{cpu / count * 1e6:11.1f}")
+    finally:
+        os.remove(path)
+
+
+def jog_workload(points):
+    """User commands for measuring points the way they get jogged to by
+    hand: increment runs that overshoot and come back, and a z_up before
+    every move whether or not z is already up."""
+    cmds = [("set_inc", "x&y", ["0.1"], True)]
+    for i in range(points):
+        cmds.append(("z_up", "z", [], True))
+        cmds += [("inc_right", "x", [], True)] * 5
+        cmds.append(("inc_left", "x", [], True))
+        cmds.append(("z_up", "z", [], True))
+        cmds += [("inc_away", "y", [], True)] * 3
+        cmds.append(("move_rel", "y", ["0.25"], True))
+        cmds.append(("move_rel", "y", ["-0.25"], True))
+        cmds.append(("z_down", "z", [], True))
+        cmds.append(("z_up", "z", [], True))
+    return cmds
+
+
+def bench_peephole(optimize, user_cmds, exec_time):
+    """Sends user_cmds as one stream, optimized or not, and times the
+    simulator running them. Returns (letters, seconds, optimizer stats)."""
+    sim = marshaller_sim.MarshallerSim(window=4, exec_time=exec_time)
+    sim.start()
+    try:
+        with _quiet(), _running_link(sim, io_mode=data_link.IO_EVENT,
+                                     flow=data_link.FLOW_CREDIT) as (po, link):
+            interpreter = commands.CommandInterpreter(po, optimize=optimize)
+            sim.announce()
+            time.sleep(0.1)
+            start = time.perf_counter()
+            contents = list(interpreter.stream_contents(user_cmds))
+            for content in contents:
+                link.wait_clear()
+                interpreter.post_content(content)
+            if not sim.wait_completed(len(contents), timeout=60.0):
+                raise RuntimeError("simulator never caught up")
+            elapsed = sim.completed[-1][0] - start
+            stats = interpreter.optimizer.stats() if optimize else None
+    finally:
+        sim.stop()
+    return len(contents), elapsed, stats
+
+
+def run_peephole(args):
+    user_cmds = jog_workload(args.points)
+    print(f"{len(user_cmds)} jogging user commands, simulated "
+          f"{args.exec_time * 1000.0:.0f} ms per command")
+    print(f"{'optimize':>9} {'letters':>8} {'sim s':>7}")
+    for optimize in (False, True):
+        letters, elapsed, _ = bench_peephole(optimize, user_cmds,
+                                             args.exec_time)
+        print(f"{str(optimize):>9} {letters:8d} {elapsed:7.2f}")
+    optimizer = command_optimizer.CommandOptimizer()
+    with _quiet():
+        interpreter = commands.CommandInterpreter(PostOffice("benchmarks.py"))
+    cmds = []
+    with _quiet():
+        for name, axes, parms, block in user_cmds:
+            cmds += interpreter.create_low_level_public_cmd_list(
+                name, axes, parms, block)
+    optimizer.optimize(cmds)
+    stats = optimizer.stats()
+    print(f"optimizer: {stats['commands_in']} -> {stats['commands_out']} "
+          f"commands, about {stats['seconds_saved']:.1f}s of axis time saved "
+          f"on the rig (axis_model.py)")
+
+
+def _snake(points, rows):
+    """points in the order a by-hand raster scan would take them: by rows
+    of y, alternately left to right and right to left."""
+    top = max(y for _, y in points) + 1e-9
+    bottom = min(y for _, y in points)
+    band = (top - bottom) / rows
+    order = []
+    for row in range(rows):
+        low = bottom + row * band
+        row_points = sorted(p for p in points if low <= p[1] < low + band)
+        order += row_points if row % 2 == 0 else row_points[::-1]
+    return order
+
+
+def run_scan(args):
+    rng = random.Random(args.seed)
+    print("modelled travel for a scan of random points on a 16 x 20 in top")
+    print(f"{'points':>7} {'plan ms':>8} {'given s':>8} {'snake s':>8} "
+          f"{'nn s':>7} {'2-opt s':>8}")
+    for count in args.points:
+        points = [(rng.uniform(0.0, 16.0), rng.uniform(0.0, 20.0))
+                  for _ in range(count)]
+        planner = scan_planner.ScanPlanner()
+        planned = planner.order(points)
+        plan_ms = planner.plan_time * 1000.0
+        nn = scan_planner.ScanPlanner(max_time=0.0).order(points)
+        snake = _snake(points, max(int(count ** 0.5 / 2), 1))
+        print(f"{count:7d} {plan_ms:8.1f} {planner.path_time(points):8.0f} "
+              f"{planner.path_time(snake):8.0f} {planner.path_time(nn):7.0f} "
+              f"{planner.path_time(planned):8.0f}")
+
+
+def bench_barrier(concurrent, replies, count, exec_time):
+    """Sends count diagonal to_point moves, x and y one after the other or
+    as barrier groups. Returns seconds until the simulator finished them."""
+    protocol = wire_protocol.PROTOCOL_FRAMED
+    sim = marshaller_sim.MarshallerSim(window=4, replies=replies,
+                                       exec_time=exec_time, protocol=protocol)
+    sim.start()
+    try:
+        with _quiet(), _running_link(sim, io_mode=data_link.IO_EVENT,
+                                     flow=data_link.FLOW_CREDIT,
+                                     protocol=protocol,
+                                     replies=replies) as (po, link):
+            interpreter = commands.CommandInterpreter(po, concurrent=concurrent)
+            sim.announce()
+            time.sleep(0.1)
+            start = time.perf_counter()
+            for i in range(count):
+                link.wait_clear()
+                interpreter.send_command("to_point", "x&y",
+                                         [str(i + 1), str(-i - 1)], True)
+            if not sim.wait_completed(count * 2, timeout=count * 2.0):
+                raise RuntimeError("simulator never caught up")
+            elapsed = sim.completed[-1][0] - start
+    finally:
+        sim.stop()
+    return elapsed
+
+
+def run_barrier(args):
+    exec_time = {'x': args.x_time, 'y': args.y_time}
+    print(f"{args.count} to_point x&y moves, x takes {args.x_time * 1000.0:.0f}"
+          f" ms, y {args.y_time * 1000.0:.0f} ms")
+    print(f"{'replies':>8} {'concurrent':>11} {'s':>7} {'s/move':>7}")
+    for replies in (False, True):
+        for concurrent in (False, True):
+            elapsed = bench_barrier(concurrent, replies, args.count, exec_time)
+            print(f"{str(replies):>8} {str(concurrent):>11} {elapsed:7.2f} "
+                  f"{elapsed / args.count:7.3f}")
+
+
+def bench_stop(priority, replies, queued, ready_delay):
+    """Queues up moves, then asks for a stop, either through the priority
+    lane or at the back of the queue like any other command. Returns
+    (seconds from the stop being posted to it reaching the simulator,
+    letters cancelled)."""
+    protocol = wire_protocol.PROTOCOL_FRAMED
+    sim = marshaller_sim.MarshallerSim(ready_delay=ready_delay, window=1,
+                                       replies=replies, exec_time=0.02,
+                                       protocol=protocol)
+    sim.start()
+    try:
+        with _quiet(), _running_link(sim, io_mode=data_link.IO_EVENT,
+                                     flow=data_link.FLOW_CREDIT,
+                                     protocol=protocol,
+                                     replies=replies) as (po, link):
+            interpreter = commands.CommandInterpreter(po)
+            sim.announce()
+            time.sleep(0.1)
+            for i in range(queued):
+                interpreter.send_command("move_rel", "x", [str(i + 1)], False)
+            time.sleep(5 * ready_delay) #a few under way
+            posted = time.perf_counter()
+            if priority:
+                interpreter.send_stop(lift=False)
+            else:
+                interpreter.post_content(["stop", "m", [], False],
+                                         priority=send_queue.PRIORITY_NORMAL)
+            deadline = posted + queued * ready_delay * 2 + 5.0
+            while not sim.stops and time.perf_counter() < deadline:
+                time.sleep(0.001)
+            cancelled = link.letters_cancelled
+    finally:
+        sim.stop()
+    if not sim.stops:
+        return None, cancelled
+    return sim.stops[0] - posted, cancelled
+
+
+def run_stop(args):
+    print(f"stop behind {args.queued} queued moves, simulated uart ready "
+          f"delay {args.ready_delay * 1000.0:.0f} ms")
+    print(f"{'replies':>8} {'lane':>9} {'stop ms':>8} {'cancelled':>10}")
+    for replies in (False, True):
+        for priority in (False, True):
+            latency, cancelled = bench_stop(priority, replies, args.queued,
+                                            args.ready_delay)
+            shown = "never" if latency is None else f"{latency * 1000.0:.1f}"
+            print(f"{str(replies):>8} {'priority' if priority else 'fifo':>9}"
+                  f" {shown:>8} {cancelled:10d}")
+
+
+def bench_backpressure(blocking, axes, count, exec_time):
+    """Posts count move_rel letters as fast as a GUI thread could, cycling
+    through axes, either with the old blocking put or through the post
+    office with backpressure. With more than one axis, each turn through
+    them is one user command whose letters share an Admission. Returns (ms
+    spent posting, longest post ms, letters merged, letters rejected,
+    commands only partly queued, times the link went under pressure,
+    seconds until the simulator finished)."""
+    sim = marshaller_sim.MarshallerSim(ready_delay=exec_time, window=1,
+                                       exec_time=exec_time)
+    sim.start()
+    pressure = []
+    try:
+        with _quiet(), _running_link(sim, io_mode=data_link.IO_EVENT,
+                                     flow=data_link.FLOW_CREDIT) as (po, link):
+            link.backpressureChanged.connect(
+                lambda on, depth: on and pressure.append(depth))
+            sim.announce()
+            time.sleep(0.1)
+            longest = 0.0
+            commands = []
+            start = time.perf_counter()
+            for i in range(count):
+                letter = Letter(data_link.DataLink.MY_PO_ID, _BENCH_PO_ID,
+                                ["move_rel", axes[i % len(axes)], "0.1",
+                                 False])
+                letter.set_future(concurrent.futures.Future())
+                if i % len(axes) == 0:
+                    admission = send_queue.Admission(len(axes))
+                    commands.append([])
+                if len(axes) > 1:
+                    letter.set_admission(admission)
+                commands[-1].append(letter.future())
+                posted = time.perf_counter()
+                if blocking:
+                    link.to_backend_q.put(letter)
+                else:
+                    po.post(letter)
+                longest = max(longest, time.perf_counter() - posted)
+            posting = time.perf_counter() - start
+            split = sum(1 for futures in commands
+                        if len({f.done() and
+                                isinstance(f.exception(), queue.Full)
+                                for f in futures}) > 1)
+            merged = link.to_backend_q.merged
+            rejected = link.letters_rejected
+            expected = count - merged - rejected
+            if not sim.wait_completed(expected, timeout=count * 2.0):
+                raise RuntimeError("simulator never caught up")
+            elapsed = sim.completed[-1][0] - start
+    finally:
+        sim.stop()
+    return (posting * 1000.0, longest * 1000.0, merged, rejected, split,
+            len(pressure), elapsed)
+
+
+def run_backpressure(args):
+    print(f"{args.count} move_rel letters posted at once, simulated "
+          f"{args.exec_time * 1000.0:.0f} ms per command, queue of "
+          f"{data_link.TO_BACKEND_Q_SIZE}")
+    print(f"{'enqueue':>13} {'axes':>5} {'post ms':>8} {'max ms':>7} "
+          f"{'merged':>7} "
+          f"{'rejected':>9} {'split':>6} {'pressure':>9} {'sim s':>7}")
+    for blocking in (True, False):
+        for axes in (('x',), ('x', 'y')):
+            posting, longest, merged, rejected, split, pressure, elapsed = \
+                bench_backpressure(blocking, axes, args.count, args.exec_time)
+            print(f"{'blocking' if blocking else 'backpressure':>13} "
+                  f"{'&'.join(axes):>5} {posting:8.1f} {longest:7.1f} "
+                  f"{merged:7d} "
+                  f"{rejected:9d} {split:6d} {pressure:9d} {elapsed:7.2f}")
+
+
+def bench_inbound(rate, seconds, io_mode):
+    """Streams rate telemetry messages a second at a link for seconds and
+    takes them from its inbox every response_view.REFRESH_MS, as the GUI
+    does. Returns (messages taken, batches, longest batch ms, messages
+    dropped)."""
+    sim = marshaller_sim.MarshallerSim(telemetry_rate=rate)
+    interval = response_view.REFRESH_MS / 1000.0
+    taken = batches = 0
+    longest = 0.0
+    try:
+        with _quiet(), _running_link(sim, io_mode=io_mode) as (po, link):
+            sim.start()
+            end = time.perf_counter() + seconds
+            while time.perf_counter() < end:
+                time.sleep(interval)
+                began = time.perf_counter()
+                batch = link.take_inbox(response_view.MAX_PER_BATCH)
+                lines = [response_view.format_message(t, msg)
+                         for t, msg in batch]
+                longest = max(longest, time.perf_counter() - began)
+                if lines:
+                    taken += len(lines)
+                    batches += 1
+            dropped = link.inbox_dropped
+    finally:
+        sim.stop()
+    return taken, batches, longest * 1000.0, dropped
+
+
+def run_inbound(args):
+    print(f"telemetry for {args.seconds:.0f}s, taken every "
+          f"{response_view.REFRESH_MS} ms. Qt events is what a signal per "
+          f"message would have cost.")
+    print(f"{'mode':>8} {'rate/s':>7} {'msgs':>6} {'batches':>8} "
+          f"{'per batch':>10} {'max ms':>7} {'dropped':>8} {'qt events':>10}")
+    for mode in (data_link.IO_POLLED, data_link.IO_EVENT):
+        for rate in args.rates:
+            taken, batches, longest, dropped = bench_inbound(
+                rate, args.seconds, mode)
+            print(f"{mode:>8} {rate:7d} {taken:6d} {batches:8d} "
+                  f"{taken / max(batches, 1):10.1f} {longest:7.2f} "
+                  f"{dropped:8d} {batches:5d}/{taken:<5d}")
+
+
+def bench_telemetry(rate, seconds, protocol, store):
+    """Streams rate samples a second at a link for seconds, into a
+    TelemetryStore if store is True or the link's inbox if not. Returns
+    (samples sent, samples kept, CPU us per sample, gen 0 collections)."""
+    sim = marshaller_sim.MarshallerSim(protocol=protocol, telemetry_rate=rate)
+    tm = telemetry.TelemetryStore() if store else None
+    try:
+        with _quiet(), _running_link(sim, io_mode=data_link.IO_EVENT,
+                                     protocol=protocol,
+                                     telemetry=tm) as (po, link):
+            collections_before = gc.get_stats()[0]['collections']
+            cpu_start = time.process_time()
+            sim.start()
+            time.sleep(seconds)
+            sim.stop_telemetry()
+            time.sleep(0.1) #let the link take in the last of it
+            cpu = time.process_time() - cpu_start
+            collected = gc.get_stats()[0]['collections'] - collections_before
+            kept = tm.count if store else len(link.take_inbox())
+    finally:
+        sim.stop()
+    sent = sim.telemetry_sent
+    return sent, kept, cpu / max(sent, 1) * 1e6, collected
+
+
+def run_telemetry(args):
+    if not telemetry.numpy_available():
+        print("telemetry needs numpy")
+        return
+    print(f"telemetry for {args.seconds:.0f}s. CPU is the whole process, "
+          f"simulator included.")
+    print(f"{'protocol':>9} {'into':>6} {'rate/s':>7} {'sent':>7} {'kept':>7} "
+          f"{'cpu us':>7} {'gc gen0':>8}")
+    for protocol, store in ((wire_protocol.PROTOCOL_JSON, False),
+                            (wire_protocol.PROTOCOL_JSON, True),
+                            (wire_protocol.PROTOCOL_FRAMED, True)):
+        for rate in args.rates:
+            sent, kept, cpu, collected = bench_telemetry(rate, args.seconds,
+                                                         protocol, store)
+            print(f"{protocol:>9} {'rings' if store else 'inbox':>6} "
+                  f"{rate:7d} {sent:7d} {kept:7d} {cpu:7.1f} {collected:8d}")
+    store = telemetry.TelemetryStore()
+    samples = store.capacity
+    data = struct.pack(f'<{2 * 100}f', *range(200))
+    began = time.perf_counter()
+    for i in range(samples // 100):
+        store.add_block(i * 0.01, 0.0001, 2, data)
+    fill = time.perf_counter() - began
+    began = time.perf_counter()
+    store.envelope("load", samples, 500)
+    envelope = time.perf_counter() - began
+    print(f"{samples} samples added in blocks of 100 in {fill * 1000.0:.1f} ms,"
+          f" min/max of all of them into 500 buckets in "
+          f"{envelope * 1000.0:.1f} ms")
+
+
+def run_store(args):
+    """Writes sessions of measurements to the store and to json lines, then
+    times opening all of them and looking up one grid point's history."""
+    rng = random.Random(1)
+    root = tempfile.mkdtemp()
+    try:
+        began = time.perf_counter()
+        appended = 0.0
+        for i in range(args.sessions):
+            session = measurement_store.MeasurementSession(
+                os.path.join(root, f"{i:04d}"))
+            rows = [(rng.randrange(64) * 0.25, rng.randrange(80) * 0.25,
+                     rng.uniform(1.0, 5.0), rng.uniform(0.001, 0.02))
+                    for _ in range(args.rows)]
+            with open(os.path.join(root, f"{i:04d}.jsonl"), 'w') as f:
+                for row in rows:
+                    f.write(json.dumps(dict(zip(measurement_store.COLUMNS,
+                                                row))) + "\n")
+            appended_at = time.perf_counter()
+            session.append_rows(rows)
+            appended += time.perf_counter() - appended_at
+            session.close()
+        one = measurement_store.MeasurementSession(os.path.join(root, "one"))
+        appended_at = time.perf_counter()
+        for _ in range(20):
+            one.append(1.0, 1.0, 2.0, 0.01)
+        one_append = (time.perf_counter() - appended_at) / 20
+        one.close()
+        shutil.rmtree(os.path.join(root, "one"))
+        total = args.sessions * args.rows
+        print(f"{args.sessions} sessions of {args.rows} rows, written in "
+              f"{time.perf_counter() - began:.2f}s ({appended:.2f}s appending)."
+              f" One row appended and committed: {one_append * 1000.0:.2f} ms")
+
+        began = time.perf_counter()
+        sessions = measurement_store.open_sessions(root)
+        opened = time.perf_counter() - began
+        found = measurement_store.history(sessions, 2.0, 3.0)
+        indexed = time.perf_counter() - began
+        mean = sum(s.column('compliance')[i] for s, i in found) / len(found)
+        for session in sessions:
+            session.close()
+
+        began = time.perf_counter()
+        index = collections.defaultdict(list)
+        for i in range(args.sessions):
+            with open(os.path.join(root, f"{i:04d}.jsonl")) as f:
+                for line in f:
+                    row = json.loads(line)
+                    index[(round(row['x'] / 0.25),
+                           round(row['y'] / 0.25))].append(row)
+        parsed = time.perf_counter() - began
+        print(f"{'':>22} {'ms':>8}")
+        print(f"{'open store':>22} {opened * 1000.0:8.1f}")
+        print(f"{'open + grid history':>22} {indexed * 1000.0:8.1f}   "
+              f"{len(found)} rows at (2, 3), mean compliance {mean:.4f}")
+        print(f"{'parse json lines':>22} {parsed * 1000.0:8.1f}   "
+              f"{total} rows")
+    finally:
+        shutil.rmtree(root)
+
+
+def _compliance_at(x, y, width, height):
+    """A made up compliance map, stiffest at the edges of the top."""
+    u, v = x / width - 0.5, y / height - 0.5
+    return 0.004 + 0.012 * math.exp(-(u * u + v * v) * 8.0) + \
+           0.002 * math.sin(x * 1.3) * math.cos(y * 0.9)
+
+
+def run_isobar(args):
+    """Feeds a snake scan of a top into an IsobarMap point by point, timing
+    each point's update with its contours, then times working out the whole
+    map from scratch."""
+    if not isobar.numpy_available():
+        print("isobar needs numpy")
+        return
+    cols = int(args.width / args.step) + 1
+    rows = int(args.height / args.step) + 1
+    points = [(x * args.step, y * args.step)
+              for x, y in _snake([(i, j) for j in range(rows)
+                                  for i in range(cols)], rows)]
+    values = [_compliance_at(x, y, args.width, args.height) for x, y in points]
+    isobars = isobar.IsobarMap((0.0, args.width), (0.0, args.height))
+    times = []
+    for (x, y), value in zip(points, values):
+        began = time.perf_counter()
+        isobars.add_point(x, y, value)
+        isobars.contours()
+        times.append(time.perf_counter() - began)
+    ms = [t * 1000.0 for t in times]
+    segments = sum(len(s) for _, s in isobars.contours())
+    print(f"{len(points)} points over {args.width:g} x {args.height:g} in, "
+          f"grid {isobars.nx} x {isobars.ny}, {len(isobars.levels())} levels,"
+          f" {segments} segments")
+    print(f"live update per point: p50 {percentile(ms, 50):.2f} ms, "
+          f"p95 {percentile(ms, 95):.2f} ms, max {max(ms):.2f} ms "
+          f"({isobars.tiles_redone / len(points):.1f} tiles redone a point)")
+    began = time.perf_counter()
+    whole = isobar.IsobarMap((0.0, args.width), (0.0, args.height),
+                             levels=isobars.levels())
+    whole.add_points([p[0] for p in points], [p[1] for p in points], values)
+    whole.contours()
+    print(f"whole map from scratch: "
+          f"{(time.perf_counter() - began) * 1000.0:.1f} ms")
+
+
+def _tick_lateness(stop, tick=0.001):
+    """Stands in for the DataLink thread: wakes every tick seconds and
+    records how late it was, which is how long it waited for the GIL."""
+    late = []
+    while not stop.is_set():
+        due = time.perf_counter() + tick
+        time.sleep(tick)
+        late.append(time.perf_counter() - due)
+    return late
+
+
+def bench_graph(points, values, interval, in_process, width, height):
+    """Feeds a scan to the isobar map, in this process or the graph
+    process, every interval seconds while timing a 1 ms ticker."""
+    stop = threading.Event()
+    with concurrent.futures.ThreadPoolExecutor(1) as pool:
+        if in_process:
+            isobars = isobar.IsobarMap((0.0, width), (0.0, height))
+        else:
+            graph = graph_process.GraphProcess((0.0, width), (0.0, height),
+                                               show=False)
+            graph.start()
+            time.sleep(2.0) #let it import numpy before timing anything
+        ticker = pool.submit(_tick_lateness, stop)
+        began = time.perf_counter()
+        for (x, y), value in zip(points, values):
+            if in_process:
+                isobars.add_point(x, y, value)
+                isobars.contours()
+            else:
+                graph.publish(x, y, 1.0, value)
+            time.sleep(interval)
+        elapsed = time.perf_counter() - began
+        stop.set()
+        late = [t * 1000.0 for t in ticker.result()]
+    stats = {} if in_process else graph.stop()
+    return late, elapsed, stats
+
+
+def run_graph(args):
+    """A 1 ms ticker's lateness while a scan's isobars are worked out in the
+    commander's process and in the graph process."""
+    if not graph_process.graph_available():
+        print("the graph process needs Python 3.8 and numpy")
+        return
+    width, height = 15.0, 20.0
+    cols, rows = int(width / args.step) + 1, int(height / args.step) + 1
+    points = [(i * args.step, j * args.step)
+              for j in range(rows) for i in range(cols)]
+    values = [_compliance_at(x, y, width, height) for x, y in points]
+    print(f"{len(points)} points, one every {args.interval * 1000.0:g} ms")
+    print("1 ms ticker lateness while the isobars are worked out")
+    print(f"{'isobars':>10} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for in_process in (True, False):
+        late, elapsed, stats = bench_graph(points, values, args.interval,
+                                           in_process, width, height)
+        where = "in process" if in_process else "separate"
+        print(f"{where:>10} {percentile(late, 50):8.2f} "
+              f"{percentile(late, 99):8.2f} {max(late):8.2f}")
+        if stats:
+            print(f"{'':>10} graph process took {stats.get('points', 0)} "
+                  f"points in {stats.get('updates', 0)} updates, lost "
+                  f"{stats.get('lost', 0)}, {stats['notifications']} "
+                  f"notifications")
+
+
+def run_latency(args):
+    print(f"post -> wire latency, {args.count} letters per mode")
+    print(f"{'mode':>8} {'p50 ms':>8} {'p95 ms':>8} {'max ms':>8} {'idle cpu':>9}")
+    for mode in (data_link.IO_POLLED, data_link.IO_EVENT):
+        latencies, idle_cpu = bench_latency(mode, args.count, args.protocol)
+        ms = [t * 1000.0 for t in latencies]
+        print(f"{mode:>8} {percentile(ms, 50):8.2f} {percentile(ms, 95):8.2f} "
+              f"{max(ms):8.2f} {idle_cpu * 100.0:8.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="commander link benchmarks")
+    sub = parser.add_subparsers(dest='bench')
+    sub.required = True
+    p = sub.add_parser('latency', help="post -> wire latency, polled vs event I/O")
+    p.add_argument('--count', type=int, default=20)
+    p.add_argument('--protocol', choices=_PROTOCOLS, default=_PROTOCOLS[0])
+    p.set_defaults(func=run_latency)
+    p = sub.add_parser('throughput', help="commands/s, fixed delay vs credit")
+    p.add_argument('--count', type=int, default=30)
+    p.add_argument('--ready-delay', type=float, default=0.05)
+    p.add_argument('--protocol', choices=_PROTOCOLS, default=_PROTOCOLS[0])
+    p.set_defaults(func=run_throughput)
+    p = sub.add_parser('wire', help="message size and decode rate per protocol")
+    p.add_argument('--count', type=int, default=20000)
+    p.set_defaults(func=run_wire)
+    p = sub.add_parser('batch', help="to_point throughput with and without batching")
+    p.add_argument('--count', type=int, default=20)
+    p.add_argument('--ready-delay', type=float, default=0.05)
+    p.set_defaults(func=run_batch)
+    p = sub.add_parser('routing', help="post office fan-out rate vs subscribers")
+    p.add_argument('--posts', type=int, default=20000)
+    p.set_defaults(func=run_routing)
+    p = sub.add_parser('alloc', help="allocations per letter, old vs slotted/packed")
+    p.add_argument('--count', type=int, default=10000)
+    p.set_defaults(func=run_alloc)
+    p = sub.add_parser('trace', help="cost of trace events on the post path")
+    p.add_argument('--posts', type=int, default=100000)
+    p.set_defaults(func=run_trace)
+    p = sub.add_parser('replies', help="blocking vs pipelined commands with replies")
+    p.add_argument('--count', type=int, default=20)
+    p.add_argument('--exec-time', type=float, default=0.05)
+    p.set_defaults(func=run_replies)
+    p = sub.add_parser('startup', help="reset to axis ids, fixed sleeps vs handshake")
+    p.add_argument('--boot-delay', type=float, nargs='+', default=[0.3, 1.0, 2.0])
+    p.set_defaults(func=run_startup)
+    p = sub.add_parser('suite', help="workloads x link configs through the simulator")
+    p.add_argument('--configs', nargs='+', choices=list(_SUITE_CONFIGS),
+                   default=list(_SUITE_CONFIGS))
+    p.add_argument('--workloads', nargs='+', choices=_WORKLOADS,
+                   default=list(_WORKLOADS))
+    p.add_argument('--moves', type=int, default=10)
+    p.add_argument('--burst', type=int, default=10)
+    p.add_argument('--grid', type=int, default=3, help="points per side")
+    p.add_argument('--ready-delay', type=float, default=0.005)
+    p.add_argument('--exec-time', type=float, default=0.02)
+    p.add_argument('--response-size', type=int, default=0)
+    p.add_argument('--drop-rate', type=float, default=0.0)
+    p.add_argument('--garble-rate', type=float, default=0.0)
+    p.add_argument('--seed', type=int, default=None)
+    p.set_defaults(func=run_suite)
+    p = sub.add_parser('script', help="live commands vs compiled script replay")
+    p.add_argument('--grid', type=int, default=10, help="points per side")
+    p.add_argument('--config', choices=list(_SUITE_CONFIGS), default='framed')
+    p.set_defaults(func=run_script)
+    p = sub.add_parser('peephole', help="command stream with and without the optimizer")
+    p.add_argument('--points', type=int, default=10)
+    p.add_argument('--exec-time', type=float, default=0.02)
+    p.set_defaults(func=run_peephole)
+    p = sub.add_parser('scan', help="scan planning time and modelled travel")
+    p.add_argument('--points', type=int, nargs='+', default=[50, 200, 1000])
+    p.add_argument('--seed', type=int, default=1)
+    p.set_defaults(func=run_scan)
+    p = sub.add_parser('barrier', help="x&y moves one axis at a time vs barrier groups")
+    p.add_argument('--count', type=int, default=20)
+    p.add_argument('--x-time', type=float, default=0.05)
+    p.add_argument('--y-time', type=float, default=0.03)
+    p.set_defaults(func=run_barrier)
+    p = sub.add_parser('stop', help="stop latency behind a full queue, fifo vs priority")
+    p.add_argument('--queued', type=int, default=40)
+    p.add_argument('--ready-delay', type=float, default=0.05)
+    p.set_defaults(func=run_stop)
+    p = sub.add_parser('backpressure', help="posting a burst, blocking put vs backpressure")
+    p.add_argument('--count', type=int, default=200)
+    p.add_argument('--exec-time', type=float, default=0.02)
+    p.set_defaults(func=run_backpressure)
+    p = sub.add_parser('inbound', help="telemetry taken from the inbox in display-rate batches")
+    p.add_argument('--rates', type=int, nargs='+', default=[100, 500, 2000])
+    p.add_argument('--seconds', type=float, default=2.0)
+    p.set_defaults(func=run_inbound)
+    p = sub.add_parser('telemetry', help="telemetry into numpy rings vs the inbox")
+    p.add_argument('--rates', type=int, nargs='+', default=[1000, 5000])
+    p.add_argument('--seconds', type=float, default=2.0)
+    p.set_defaults(func=run_telemetry)
+    p = sub.add_parser('store', help="measurement store vs parsing json lines")
+    p.add_argument('--sessions', type=int, default=20)
+    p.add_argument('--rows', type=int, default=5000)
+    p.set_defaults(func=run_store)
+    p = sub.add_parser('isobar', help="live isobar updates during a scan")
+    p.add_argument('--width', type=float, default=15.0)
+    p.add_argument('--height', type=float, default=20.0)
+    p.add_argument('--step', type=float, default=0.5)
+    p.set_defaults(func=run_isobar)
+    p = sub.add_parser('graph', help="isobars in the commander's process or "
+                                     "the graph process")
+    p.add_argument('--step', type=float, default=0.5)
+    p.add_argument('--interval', type=float, default=0.005)
+    p.set_defaults(func=run_graph)
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
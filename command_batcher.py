@@ -0,0 +1,190 @@
+"""
+command_batcher.py
+
+Packs several low-level commands into one message for the marshaller to fan
+out to the axis controllers, so they cost one uart write (and one wait for
+the uart to get ready again) instead of one each.
+
+A batch is itself a command, addressed to the marshaller:
+
+    ["batch", "m", [cmd, cmd, ...], block]
+
+where each cmd is the usual [name, axis, parm, block] low-level command and
+block is True if any of them is blocking.
+
+Batches get made in two places. CommandInterpreter packs every low-level
+command made from one user command into one batch when it is created with
+coalesce=True. DataLink hands each outgoing letter to its CommandBatcher,
+which can also sweep up whatever else is queued within a short window. Both
+need marshaller firmware that understands "batch", so both are off unless
+asked for.
+
+A barrier group looks the same but is named "group":
+
+    ["group", "m", [cmd, ...], block]
+
+Its commands are for different axes and the marshaller starts them all at
+once and counts the group finished when the last one is, so x and y of a
+to_point move together. CommandInterpreter makes groups when created with
+concurrent=True. A group always goes in a frame of its own.
+"""
+import queue
+import threading
+import time
+
+import send_queue
+import wire_protocol
+
+BATCH_NAME = "batch"
+BATCH_AXIS = "m"
+GROUP_NAME = "group"
+
+DEFAULT_MAX_BATCH = 1     #1 means DataLink doesn't coalesce at all
+DEFAULT_WINDOW    = 0.005 #seconds to wait for more commands to join a batch
+
+
+def batch_content(cmds):
+    """Returns the batch command holding the low-level commands in cmds. A
+    batch in cmds has its commands pulled up into the new one."""
+    flat = []
+    for cmd in cmds:
+        if is_batch(cmd):
+            flat.extend(cmd[2])
+        else:
+            flat.append(cmd)
+    block = any(cmd[3] for cmd in flat)
+    return [BATCH_NAME, BATCH_AXIS, flat, block]
+
+
+def group_content(cmds):
+    """Returns the barrier group holding the low-level commands in cmds,
+    blocking if any of them is."""
+    block = any(cmd[3] for cmd in cmds)
+    return [GROUP_NAME, BATCH_AXIS, list(cmds), block]
+
+
+def is_batch(content):
+    return type(content) is list and len(content) == 4 and \
+           content[0] == BATCH_NAME
+
+
+def is_group(content):
+    return type(content) is list and len(content) == 4 and \
+           content[0] == GROUP_NAME
+
+
+def is_blocking(content):
+    """True for a low-level command (or batch) that must finish before the
+    next one starts."""
+    return type(content) is list and len(content) == 4 and bool(content[3])
+
+
+def command_count(content):
+    """Number of low-level commands in a piece of letter content."""
+    if is_batch(content) or is_group(content):
+        return len(content[2])
+    return 1
+
+
+def _batchable(content):
+    """Only plain low-level commands can ride in a batch. Anything else, e.g.
+    set_axis_mac_ids, a group or a stop, goes on its own."""
+    if is_batch(content):
+        return True
+    if type(content) is not list or len(content) != 4 or \
+       content[0] == wire_protocol.STOP:
+        return False
+    return content[0] in wire_protocol.COMMAND_OPCODES and \
+           (type(content[2]) is not list or content[2] == [])
+
+
+class CommandBatcher:
+    """Coalesces letters from DataLink's outgoing queue. next_letters()
+    returns the letters that should go out together as one frame, and
+    content_for() turns them into the content to serialize.
+
+    max_batch is the most low-level commands one frame may carry and window
+    is how long to hold a frame open waiting for more. Counters:
+        commands_in   low-level commands that went through
+        frames_out    frames they went out in
+        frames_saved  the difference, i.e. uart writes not made
+    """
+
+    def __init__(self, max_batch=DEFAULT_MAX_BATCH, window=DEFAULT_WINDOW):
+        self.max_batch = max(int(max_batch), 1)
+        self.window = window
+        self.commands_in = 0
+        self.frames_out = 0
+        self._held = None #letter taken from the queue that didn't fit
+        self._lock = threading.Lock()
+
+    def frames_saved(self):
+        return self.commands_in - self.frames_out
+
+    def stats(self):
+        return {'commands_in': self.commands_in,
+                'frames_out': self.frames_out,
+                'frames_saved': self.frames_saved()}
+
+    def next_letters(self, q, wait=True, stop_marker=None):
+        """Returns a list of letters from q to send as one frame. Blocks for
+        the first letter. With wait False, only letters already in q are
+        swept up, so the polled loop never sits here. stop_marker, when it
+        comes out of the queue, is returned on its own. A letter held from
+        last time goes first unless something more urgent, e.g. a stop, has
+        been queued since, which then goes on its own ahead of it."""
+        if self._held is not None:
+            if self._held is not stop_marker and \
+               q.more_urgent(send_queue.priority_of(self._held)):
+                return [q.get()]
+            first, self._held = self._held, None
+        else:
+            first = q.get()
+        if first is stop_marker or self.max_batch == 1 or \
+           not _batchable(first.content()):
+            return [first]
+        letters = [first]
+        count = command_count(first.content())
+        deadline = time.perf_counter() + self.window
+        while count < self.max_batch:
+            try:
+                if wait:
+                    remaining = deadline - time.perf_counter()
+                    if remaining <= 0:
+                        break
+                    letter = q.get(timeout=remaining)
+                else:
+                    letter = q.get_nowait()
+            except queue.Empty:
+                break
+            if letter is stop_marker or not _batchable(letter.content()) or \
+               count + command_count(letter.content()) > self.max_batch:
+                self._held = letter #goes out next time
+                break
+            letters.append(letter)
+            count += command_count(letter.content())
+        return letters
+
+    def content_for(self, letters):
+        """Returns the content to put on the wire for letters and counts
+        it."""
+        if len(letters) == 1:
+            content = letters[0].content()
+        else:
+            content = batch_content([letter.content() for letter in letters])
+        with self._lock:
+            self.commands_in += command_count(content)
+            self.frames_out += 1
+        return content
+
+    def has_held(self):
+        return self._held is not None
+
+    def held(self):
+        """The held letter, if any, left where it is."""
+        return self._held
+
+    def take_held(self):
+        """Returns the held letter, if any, and forgets it."""
+        held, self._held = self._held, None
+        return held
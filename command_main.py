@@ -10,29 +10,94 @@ the lower level part of the program.
 The commands module contains the CommandsList class that is responsible for
 supplying the list of user commands that run the compliance system. After some
 processing, commands are sent on to the marshalller via the data_link object.
+
+The dialog is built from cmd_main.ui through ui_cache.py, which keeps a
+compiled copy of the form. Hardware modules (RPi.GPIO, serial) are imported
+the first time they are used. Run with --startup-profile to get a breakdown
+of where startup time goes.
 """
 
 import sys
-from   PyQt5.QtCore import pyqtSlot, QDataStream, QIODevice, Qt
-from   PyQt5.QtWidgets import QApplication, QDialog
-from   PyQt5.uic import loadUi
-from   functools import partial
-import RPi.GPIO as GPIO
 import time
+import startup_profile
+_startup = startup_profile.PhaseTimer()
+from   PyQt5.QtCore import pyqtSlot, QDataStream, QIODevice, Qt, QTimer
+from   PyQt5.QtWidgets import QApplication, QDialog, QShortcut
+from   PyQt5.QtGui import QKeySequence
+from   functools import partial
+_startup.mark("import PyQt5")
 
 
 
 
 from  post_office import PostOffice, Letter
+import mailboxes
+import qt_mailbox
 import commands
 import component_ids
 import data_link
+import trace_ring
+import ui_cache
+import command_script
+import response_view
+from   latency_stats import LATENCY
 import json
+_startup.mark("import commander modules")
 
 #Make modules stored in py_compliance_proj/common available
 import sys
 sys.path.insert(0, '/media/loki9/USBDRV1/softDev/py_compliance_proj/common')
 
+#Wire protocol spoken to the marshaller. Switch to data_link.PROTOCOL_FRAMED
+#once the marshaller firmware understands the framed protocol.
+LINK_PROTOCOL = data_link.PROTOCOL_JSON
+#Batching of low-level commands into one frame, see command_batcher.py. Also
+#needs marshaller support. COALESCE_COMMANDS packs the commands made from one
+#user command, LINK_MAX_BATCH > 1 lets DataLink pack whatever is queued within
+#LINK_BATCH_WINDOW seconds.
+COALESCE_COMMANDS = False
+LINK_MAX_BATCH    = 1
+LINK_BATCH_WINDOW = 0.005
+#Sequence ids and completion replies, see data_link.py. Needs the framed
+#protocol and firmware that replies. Blocking commands then wait for the one
+#ahead to finish, and up to LINK_MAX_IN_FLIGHT non-blocking ones overlap.
+LINK_REPLIES       = False
+LINK_MAX_IN_FLIGHT = data_link.MAX_IN_FLIGHT
+#Peephole optimizing of the low-level commands of scripts and scans, see
+#command_optimizer.py. Increments become relative moves, runs of relative moves
+#on one axis are merged and z toggles that wouldn't move z are dropped.
+#Commands from the dialog are never optimized.
+OPTIMIZE_COMMANDS = False
+#Barrier groups, see command_batcher.py. The axes of a multi-axis command such
+#as to_point on x&y move at the same time instead of one after the other.
+#Needs marshaller support.
+CONCURRENT_AXES = False
+#Stops the axes, cancels everything queued for the marshaller and any script
+#being played, then lifts z. See send_queue.py.
+STOP_SHORTCUT = "Ctrl+Space"
+#Post office delivery. Async gives every registrant a mailbox so a slow one
+#can't stall the GUI thread; the dialog's own mail is drained by the Qt event
+#loop. Off until it has been run against the marshaller, mail is then
+#delivered on the posting thread as it always was.
+ASYNC_POST_OFFICE = False
+#Message tracing, see trace_ring.py. Ctrl+T turns it on and off, Ctrl+D dumps
+#what has been recorded to TRACE_DUMP_FILE.
+TRACE_DUMP_FILE = "commander_trace.bin"
+LATENCY_REFRESH_MS = 1000 #how often the latency panel is redrawn
+#Startup waits for the marshaller to say it is ready after the reset. Older
+#firmware never does, so after this long we carry on without it.
+MARSHALLER_READY_TIMEOUT = data_link.READY_TIMEOUT
+MARSHALLER_RESET_PULSE   = 0.25 #seconds EN is held low
+#Scripts, see command_script.py. Ctrl+R starts and stops recording the commands
+#sent into SCRIPT_FILE, Ctrl+P replays it and Ctrl+Shift+P stops a replay.
+SCRIPT_FILE = "commander_script.jsonl"
+#Telemetry from the marshaller is kept in NumPy ring buffers, see
+#telemetry.py. Without numpy installed it is simply not kept. The latency
+#panel shows the range of each channel over the last TELEMETRY_WINDOW samples.
+TELEMETRY_WINDOW = 1000
+STARTUP_PROFILE_SWITCH = "--startup-profile"
+_profile_startup = False #set by main() from the command line
+
 
 
 class CmdInputDisplay(QDialog):
@@ -41,12 +106,16 @@ class CmdInputDisplay(QDialog):
     #Dialog status strings
     START_UP = "Starting up..."
     READY    = "Ready"
+    NO_PORT  = "Serial port didn't open"
     MARSHALLER_RESET_PIN = 21
     MY_PO_ID = 'Commander'
     
     def __init__(self):
+        self._startup_began = time.perf_counter()
+        self.startup_time = None #seconds from here to ready_for_business
         super(CmdInputDisplay, self).__init__()
-        loadUi('cmd_main.ui', self)
+        ui_cache.load_ui('cmd_main.ui', self)
+        _startup.mark("load cmd_main.ui")
 
         #initial widget configuration
         self.gBx_chat.setEnabled(False)
@@ -81,12 +150,40 @@ class CmdInputDisplay(QDialog):
       
         self.cmds = commands.CommandList()
         self._populate_commands()
+        _startup.mark("components and commands")
 
-        self.post_office = PostOffice( "commander_main.py")
-        self.post_office.register(self.MY_PO_ID, self.mail_call)
-        self.cmd_interpreter = commands.CommandInterpreter( self.post_office)
+        self.post_office = PostOffice( "commander_main.py",
+                                       async_delivery=ASYNC_POST_OFFICE)
+        if ASYNC_POST_OFFICE:
+            my_mailbox = mailboxes.Mailbox(self.mail_call,
+                                           policy=mailboxes.POLICY_DROP_OLDEST)
+            self._mail_pump = qt_mailbox.QtMailboxPump(my_mailbox)
+            self.post_office.register(self.MY_PO_ID, self.mail_call,
+                                      mailbox=my_mailbox)
+        else:
+            self.post_office.register(self.MY_PO_ID, self.mail_call)
+        self.cmd_interpreter = commands.CommandInterpreter( self.post_office,
+                                                   coalesce=COALESCE_COMMANDS,
+                                                   optimize=OPTIMIZE_COMMANDS,
+                                                   concurrent=CONCURRENT_AXES)
         
-        self.data_link = data_link.DataLink(self.post_office)
+        self.telemetry = self._make_telemetry_store()
+        self.data_link = data_link.DataLink(self.post_office,
+                                            io_mode=data_link.IO_EVENT,
+                                            flow=data_link.FLOW_CREDIT,
+                                            protocol=LINK_PROTOCOL,
+                                            max_batch=LINK_MAX_BATCH,
+                                            batch_window=LINK_BATCH_WINDOW,
+                                            replies=LINK_REPLIES,
+                                            max_in_flight=LINK_MAX_IN_FLIGHT,
+                                            telemetry=self.telemetry)
+        self._recorder = None
+        self.script_player = command_script.ScriptPlayer(self.cmd_interpreter,
+                                                         self.data_link.codec,
+                                                         link=self.data_link)
+        self.response_feed = response_view.ResponseFeed(self.lv_client_response,
+                                                        self.data_link.take_inbox)
+        _startup.mark("post office and data link")
         
         #signals and slots
         self.rb_edit_mac.toggled.connect(self.on_edit_mac_toggle)
@@ -100,13 +197,28 @@ class CmdInputDisplay(QDialog):
         self.pBtn_save_y_mac.clicked.connect(lambda: self.on_save_btn_clicked('y'))
         self.pBtn_save_z_mac.clicked.connect(lambda: self.on_save_btn_clicked('z'))
         self.pBtn_save_t_mac.clicked.connect(lambda: self.on_save_btn_clicked('t'))
+        self.pBtn_reset_latency.clicked.connect(self.reset_latency)
+        self._latency_timer = QTimer(self)
+        self._latency_timer.timeout.connect(self.show_latency)
+        self._latency_timer.start(LATENCY_REFRESH_MS)
+        QShortcut(QKeySequence("Ctrl+T"), self, self.toggle_trace)
+        QShortcut(QKeySequence("Ctrl+D"), self, self.dump_trace)
+        QShortcut(QKeySequence("Ctrl+R"), self, self.toggle_recording)
+        QShortcut(QKeySequence("Ctrl+P"), self, self.play_script)
+        QShortcut(QKeySequence("Ctrl+Shift+P"), self, self.script_player.stop)
+        QShortcut(QKeySequence(STOP_SHORTCUT), self, self.stop_everything)
         
-        self.restart_marshaller()
-        
-        self.data_link.start()
-        time.sleep(0.3) #Need to let uart get ready. Slow to ready state.
-        self.send_axis_ids_to_marshaller()
-        self.ready_for_business()
+        #The link has to be listening before the reset or the marshaller's
+        #ready message would be lost in open_uart()'s flush.
+        self.data_link.marshallerReady.connect(self.on_marshaller_ready,
+                                               Qt.QueuedConnection)
+        self.data_link.backpressureChanged.connect(self.on_backpressure,
+                                                   Qt.QueuedConnection)
+        self.data_link.commandRejected.connect(self.on_command_rejected,
+                                               Qt.QueuedConnection)
+        self.data_link.portOpened.connect(self.on_port_opened,
+                                          Qt.QueuedConnection)
+        self.data_link.start() #the reset follows in on_port_opened
 
         
     def mail_call( self,letter ):
@@ -130,6 +242,34 @@ class CmdInputDisplay(QDialog):
             for(widget, mac_val) in zip(mac_boxes, mac_vals):
                 widget.setText(mac_val)
                 
+    def _make_telemetry_store(self):
+        import telemetry #only here, it brings in numpy which is slow to import
+        if not telemetry.numpy_available():
+            print("numpy isn't installed, telemetry won't be kept")
+            return None
+        store = telemetry.TelemetryStore()
+        _startup.mark("telemetry store")
+        return store
+    
+    @pyqtSlot(bool)
+    def on_port_opened(self, opened):
+        """The link has opened the uart, or given up on it, so it is now
+        listening for the marshaller's ready message. Startup carries on from
+        here rather than the GUI thread waiting for the port. Without the
+        port there is nothing to reset or wait for, and the dialog stays
+        not ready."""
+        _startup.mark("open serial port")
+        if not opened:
+            self._status = self.NO_PORT
+            self.lbl_status.setText(self._status)
+            self.response_feed.note(f"could not open {self.data_link.port}")
+            return
+        self.data_link.expect_restart()
+        self.restart_marshaller()
+        _startup.mark("reset marshaller")
+        QTimer.singleShot(int(MARSHALLER_READY_TIMEOUT * 1000),
+                          self.on_marshaller_ready_timeout)
+    
     def restart_marshaller(self):
         """ sends a reset to the esp32 running the marshaller by toggling the
         esp32 EN pin low. This insures that the marshaller is running when we
@@ -138,12 +278,15 @@ class CmdInputDisplay(QDialog):
         does gpiozero module, so we use BCM numbering. The MARSHALLER_RESET_PIN
         should be attached to the RST (ED) pin on the esp32.
         """
+        import RPi.GPIO as GPIO #only here, it is slow to import and Pi only
         GPIO.setmode(GPIO.BCM)
         GPIO.setwarnings(False)
         GPIO.setup(self.MARSHALLER_RESET_PIN, GPIO.OUT, initial=GPIO.HIGH)
         GPIO.output(self.MARSHALLER_RESET_PIN, GPIO.LOW)
-        time.sleep(0.250)
-        GPIO.output(self.MARSHALLER_RESET_PIN, GPIO.HIGH)
+        #EN goes high again from the event loop, the GUI isn't held up
+        QTimer.singleShot(int(MARSHALLER_RESET_PULSE * 1000),
+                          partial(GPIO.output, self.MARSHALLER_RESET_PIN,
+                                  GPIO.HIGH))
         
         
     def send_axis_ids_to_marshaller(self):
@@ -154,8 +297,8 @@ class CmdInputDisplay(QDialog):
         kept in the commander directory. Sending this information to the
         marshaller allows the system to keep one file containing the mac
         addresses rather than having to keep copies on each hardware platform.
+        Called once the marshaller has said it is ready, so no waiting here.
         """
-        time.sleep(1.5)  #uart connection takes some time!!! 1.0 fails!
         mac_list = []
         for name in self._component_manager.get_current_component_names():
             mac_id_str = self._component_manager.get_id(name, self._component_manager.STRING)
@@ -240,6 +383,50 @@ class CmdInputDisplay(QDialog):
         self.update_command_attribs( command)
 
         
+    @pyqtSlot()
+    def on_marshaller_ready(self):
+        """The marshaller is up, after our reset or one of its own. Either way
+        it has forgotten the axis ids."""
+        self.send_axis_ids_to_marshaller()
+        if self._status != self.READY:
+            self._startup_done("handshake")
+            
+    @pyqtSlot()
+    def on_marshaller_ready_timeout(self):
+        if self._status != self.READY:
+            print(f"marshaller never said ready in {MARSHALLER_READY_TIMEOUT}s,"
+                  f" carrying on without it")
+            self.send_axis_ids_to_marshaller()
+            self._startup_done("timeout")
+            
+    def _startup_done(self, how):
+        self.startup_time = time.perf_counter() - self._startup_began
+        print(f"startup took {self.startup_time:.2f}s ({how})")
+        self.ready_for_business()
+        if _profile_startup:
+            _startup.mark(f"wait for marshaller ({how})")
+            for line in _startup.report():
+                print(line)
+        
+    @pyqtSlot(bool, int)
+    def on_backpressure(self, under_pressure, depth):
+        """The DataLink's queue filled up or drained. Sending is held off
+        while it is full of commands still to go."""
+        if self._status != self.READY:
+            return
+        if under_pressure:
+            self.lbl_status.setText(f"Busy, {depth} commands queued")
+        else:
+            self.lbl_status.setText(self._status)
+        self.pBtn_send_message.setEnabled(not under_pressure)
+        
+    def on_command_rejected(self, content):
+        """The DataLink's queue was full and a command wasn't sent, none of
+        its axes."""
+        self.response_feed.note(f"not sent, queue full: {content}")
+        if self._status == self.READY:
+            self.lbl_status.setText("Queue full, command not sent")
+        
     @pyqtSlot()
     def ready_for_business(self):
         self._status=self.READY
@@ -263,6 +450,7 @@ class CmdInputDisplay(QDialog):
     
     @pyqtSlot()
     def send_command_to_client(self):
+        ui_time = time.perf_counter()
         name = self.cBx_command.currentText()
         axis = self.cBx_axis.currentText()
         axis_list = self.cmd_interpreter.get_axis_list(axis)
@@ -273,20 +461,102 @@ class CmdInputDisplay(QDialog):
             if self.lbl_parm2.isVisible():
                 parm_list.append(  self.le_parm2.text().strip())
             block = self.cmds.public_dict_[name].blocking
-            self.cmd_interpreter.send_command( name, axis, parm_list, block )
+            self.cmd_interpreter.send_command( name, axis, parm_list, block,
+                                               ui_time=ui_time)
+            if self._recorder is not None:
+                self._recorder.record( name, axis, parm_list, block)
         else: #do not send. 
             print(f"send_command_to_client not sending to {axis}")
     
+    @pyqtSlot()
+    def show_latency(self):
+        """Redraws the latency panel from the per-stage histograms."""
+        lines = LATENCY.format_summary()
+        link = self.data_link
+        lines.append(f"queued {link.to_backend_q.depth()}/"
+                     f"{data_link.TO_BACKEND_Q_SIZE}, merged "
+                     f"{link.to_backend_q.merged}, rejected "
+                     f"{link.letters_rejected}")
+        lines.append(f"responses {self.response_feed.messages} in "
+                     f"{self.response_feed.batches} batches, dropped "
+                     f"{link.inbox_dropped}")
+        if self.telemetry is not None and self.telemetry.count:
+            lines.append(f"telemetry {self.telemetry.count} samples")
+            for channel in self.telemetry.channels:
+                _, lo, hi = self.telemetry.envelope(channel, TELEMETRY_WINDOW, 1)
+                lines.append(f"  {channel:<11}{lo[0]:10.4f} to {hi[0]:10.4f}")
+        self.pte_latency.setPlainText("\n".join(lines))
+        
+    @pyqtSlot()
+    def reset_latency(self):
+        LATENCY.reset()
+        self.show_latency()
+        
+    @pyqtSlot()
+    def toggle_trace(self):
+        if trace_ring.TRACE.enabled:
+            trace_ring.TRACE.disable()
+        else:
+            trace_ring.TRACE.enable()
+        print(f"message tracing {'on' if trace_ring.TRACE.enabled else 'off'}")
+        
+    @pyqtSlot()
+    def dump_trace(self):
+        count = trace_ring.TRACE.dump(TRACE_DUMP_FILE)
+        print(f"{count} trace events written to {TRACE_DUMP_FILE}")
+    
+    @pyqtSlot()
+    def stop_everything(self):
+        ui_time = time.perf_counter()
+        self.script_player.stop()
+        self.cmd_interpreter.send_stop(ui_time=ui_time)
+        print("stop sent")
+        
+    @pyqtSlot()
+    def toggle_recording(self):
+        if self._recorder is None:
+            self._recorder = command_script.ScriptRecorder(SCRIPT_FILE)
+            print(f"recording commands to {SCRIPT_FILE}")
+        else:
+            self._recorder.close()
+            print(f"recorded {self._recorder.count} commands to {SCRIPT_FILE}")
+            self._recorder = None
+            
+    @pyqtSlot()
+    def play_script(self):
+        if self._recorder is not None:
+            self.toggle_recording() #don't replay into the file being read
+        if not self.script_player.start(SCRIPT_FILE):
+            print("a script is already playing")
+    
     @pyqtSlot()
     def close_dlg(self):
+        self.script_player.stop()
+        self.response_feed.stop()
+        if self._recorder is not None:
+            self.toggle_recording()
+        self.data_link.stop()
+        self.data_link.wait()
+        print(f"DataLink batching: {self.data_link.batcher.stats()}")
+        print(f"Mailboxes: {self.post_office.mailbox_stats()}")
+        print(f"Responses: {self.response_feed.stats()}")
+        self.post_office.shutdown()
+        if trace_ring.TRACE.enabled:
+            self.dump_trace()
         self.reject()
         
     
     
 def main():
+    global _profile_startup
+    if STARTUP_PROFILE_SWITCH in sys.argv:
+        sys.argv.remove(STARTUP_PROFILE_SWITCH)
+        _profile_startup = True
     app = QApplication(sys.argv)
+    _startup.mark("QApplication")
     dlg=CmdInputDisplay()
     dlg.show()
+    _startup.mark("show dialog")
     sys.exit(app.exec ())
 
 if __name__=="__main__":
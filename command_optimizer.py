@@ -0,0 +1,140 @@
+"""
+command_optimizer.py
+
+A peephole pass over low-level commands before they go to the marshaller.
+Command streams built from increments, relative moves and z toggles often
+have waste in them: five inc_rights in a row, a z_up when z is already up, a
+move_rel of +0.5 straight after one of -0.5. CommandOptimizer keeps track of
+what it knows about the axes and
+
+- turns inc_left/inc_right/inc_away/inc_towards into move_rel by the
+  increment, once a set_inc has told it what the increment is
+- merges consecutive relative moves on the same axis into one move_rel, or
+  drops them if they cancel out
+- drops a z_up when z is known to be up and a z_down when it is known to be
+  down
+
+Only neighbouring commands are merged, so the path the probe takes doesn't
+change. z starts out unknown and forget() makes it unknown again. Call it
+when the marshaller restarts or a command fails, since z may not be where
+the optimizer thinks it is.
+
+The optimizer counts the commands that went in and came out and uses
+axis_model.py to estimate how many seconds the dropped and merged commands
+would have taken.
+
+feed() takes one command at a time and returns the commands that are ready
+to send. A relative move is held back in case the next command can merge
+with it, so call flush() at the end of a run. optimize() does a whole list.
+
+CommandInterpreter only optimizes scripts and scans, each run with an
+optimizer of its own, never a command the user sends from the dialog.
+"""
+import axis_model
+
+#increment command: direction it moves its axis
+INCREMENTS = {'inc_left': -1.0,    #x
+              'inc_right': 1.0,    #x
+              'inc_away': 1.0,     #y
+              'inc_towards': -1.0, #y
+              }
+Z_TOGGLES = ('z_up', 'z_down')
+_NO_DISTANCE = 1e-9 #inches, moves shorter than this are no move at all
+
+
+class CommandOptimizer:
+
+    def __init__(self, increment=None):
+        """increment is the inc_ distance for both x and y if known up
+        front, CommandList.increment_distance say."""
+        self.increments = {}
+        if increment is not None:
+            self.increments = {'x': float(increment), 'y': float(increment)}
+        self._z = None #last z toggle sent, None if unknown
+        self._pending = None #[axis, distance, block, commands, seconds]
+        self.commands_in = 0
+        self.commands_out = 0
+        self.seconds_saved = 0.0
+
+    def forget(self):
+        """Makes the z position unknown again."""
+        self._z = None
+
+    def stats(self):
+        return {'commands_in': self.commands_in,
+                'commands_out': self.commands_out,
+                'commands_saved': self.commands_in - self.commands_out,
+                'seconds_saved': self.seconds_saved}
+
+    def optimize(self, cmds):
+        """Returns the optimized form of a list of low-level commands."""
+        out = []
+        for cmd in cmds:
+            out += self.feed(cmd)
+        out += self.flush()
+        return out
+
+    def feed(self, cmd):
+        """Takes the next low-level command [name, axis, parm, block] and
+        returns a list of the commands now ready to send."""
+        self.commands_in += 1
+        name, axis, parm, block = cmd
+        distance = self._relative_distance(name, axis, parm)
+        if distance is not None:
+            return self._move(cmd, axis, distance, block)
+        out = self.flush()
+        if name == 'set_inc':
+            try:
+                self.increments[axis] = float(parm)
+            except (TypeError, ValueError):
+                self.increments.pop(axis, None)
+        elif name in Z_TOGGLES:
+            if name == self._z:
+                self.seconds_saved += axis_model.Z_TOGGLE_TIME
+                return out
+            self._z = name
+        out.append(cmd)
+        self.commands_out += 1
+        return out
+
+    def flush(self):
+        """Returns the held relative move, if any, as the command to send."""
+        pending, self._pending = self._pending, None
+        if pending is None:
+            return []
+        axis, distance, block, cmds, seconds = pending
+        if abs(distance) < _NO_DISTANCE:
+            self.seconds_saved += seconds #they cancelled out
+            return []
+        if len(cmds) == 1 and cmds[0][0] == 'move_rel':
+            cmd = cmds[0] #nothing to merge, send it as it came
+        else:
+            cmd = ['move_rel', axis, str(round(distance, 6)), block]
+        self.seconds_saved += seconds - axis_model.move_time(axis, distance)
+        self.commands_out += 1
+        return [cmd]
+
+    def _relative_distance(self, name, axis, parm):
+        """How far a relative move or increment goes, None if cmd isn't one
+        or the distance isn't known."""
+        if name == 'move_rel':
+            try:
+                return float(parm)
+            except (TypeError, ValueError):
+                return None
+        if name in INCREMENTS and axis in self.increments:
+            return INCREMENTS[name] * self.increments[axis]
+        return None
+
+    def _move(self, cmd, axis, distance, block):
+        seconds = axis_model.move_time(axis, distance)
+        out = []
+        if self._pending is not None and self._pending[0] == axis:
+            self._pending[1] += distance
+            self._pending[2] = self._pending[2] or block
+            self._pending[3].append(cmd)
+            self._pending[4] += seconds
+        else:
+            out = self.flush()
+            self._pending = [axis, distance, block, [cmd], seconds]
+        return out
@@ -0,0 +1,245 @@
+"""
+command_script.py
+
+Recording and replay of user commands, the scripting service the README
+talks about.
+
+A script file is json lines, one user command per line, exactly as the GUI
+hands it to CommandInterpreter.send_command():
+
+    {"cmd": "to_point", "axes": "x&y", "parms": ["3.0", "1.5"], "block": true}
+
+ScriptRecorder appends commands to a file as they are sent. ScriptPlayer
+replays a file. Rather than going through send_command() one user command
+at a time, every command is compiled once into the letter contents the
+interpreter would have made, checked against CommandList and encoded for the
+link's protocol. The letters then carry their bytes with them, so DataLink
+just writes them out (adding a sequence id if it uses them). The compiled
+program is kept, so running the same unchanged file again skips compiling
+altogether.
+
+The file is read and compiled as it is played, so a long script starts
+moving straight away. lookahead is how many letters may be posted to the
+DataLink and not finished yet, which keeps the link busy without flooding
+its queue. Given the DataLink as well, the player also waits whenever the
+link is under backpressure (DataLink.wait_clear()), so it leaves room in the
+queue for whatever else is being sent. A command that fails or times out
+stops the replay.
+"""
+import concurrent.futures
+import json
+import os
+import threading
+import time
+
+import commands
+
+DEFAULT_LOOKAHEAD = 8 #letters posted but not finished
+
+
+class ScriptError(ValueError):
+    """A line of a script that can't be turned into commands."""
+
+
+class ScriptRecorder:
+    """Appends user commands to a script file, or writes a new one with
+    append=False. Each line is flushed as it is written so a crash loses
+    nothing already sent."""
+
+    def __init__(self, path, append=True):
+        self.path = path
+        self.count = 0
+        self._file = open(path, 'a' if append else 'w')
+
+    def record(self, cmd_name, axes, parm_list, block):
+        self._file.write(json.dumps({"cmd": cmd_name, "axes": axes,
+                                     "parms": list(parm_list),
+                                     "block": bool(block)}) + "\n")
+        self._file.flush()
+        self.count += 1
+
+    def close(self):
+        self._file.close()
+
+
+def read_script(path):
+    """Yields (line number, user command) from a script file as it is read.
+    Blank lines and lines starting with # are skipped."""
+    with open(path) as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                step = json.loads(line)
+                yield line_no, (step["cmd"], step["axes"],
+                                list(step.get("parms", [])),
+                                bool(step.get("block", True)))
+            except (ValueError, KeyError, TypeError) as e:
+                raise ScriptError(f"{path}:{line_no}: bad line, {e}")
+
+
+def check_command(cmd_name, axes, parm_list):
+    """Raises ScriptError unless cmd_name is a user command that takes axes
+    and at most as many parms as it has names for."""
+    cmd = commands.CommandList.public_dict_.get(cmd_name)
+    if cmd is None:
+        raise ScriptError(f"unknown command {cmd_name}")
+    if axes not in cmd.axis_list:
+        raise ScriptError(f"{cmd_name} doesn't take axis {axes}")
+    names = [name for name in cmd.parm_list if name]
+    if len(parm_list) > len(names):
+        raise ScriptError(f"{cmd_name} takes at most {len(names)} parms")
+
+
+def _checked(user_cmds):
+    commands.CommandList() #makes sure public_dict_ is filled in
+    for line_no, user_cmd in user_cmds:
+        try:
+            check_command(*user_cmd[:3])
+        except ScriptError as e:
+            raise ScriptError(f"line {line_no}: {e}")
+        yield user_cmd
+
+
+def compile_steps(user_cmds, interpreter, codec):
+    """Yields a step of [(content, wire), ...] for the letters the user
+    commands turn into, wire being (protocol, bytes) ready for the DataLink.
+    A multi-axis command's letters are one step, to be queued all or none
+    (see CommandInterpreter.post_group()). user_cmds is (line number, user
+    command) pairs as read_script() gives them. An optimizing interpreter
+    optimizes the script as a whole."""
+    for group in interpreter.stream_groups(_checked(user_cmds)):
+        yield [(content, (codec.name, codec.encode(content)))
+               for content in group]
+
+
+class ScriptPlayer:
+    """Replays script files through a CommandInterpreter on a thread of its
+    own. codec is the DataLink's (DataLink.codec), so letters are encoded
+    for the protocol it speaks. link is the DataLink itself, if the player
+    should hold off while it is under backpressure."""
+
+    def __init__(self, interpreter, codec, lookahead=DEFAULT_LOOKAHEAD,
+                 link=None):
+        self.interpreter = interpreter
+        self.codec = codec
+        self.link = link
+        self.lookahead = max(int(lookahead), 1)
+        self._compiled = {} #path: (mtime, [(content, wire)])
+        self._thread = None
+        self._stop = threading.Event()
+        self.letters_sent = 0
+        self._unfinished = 0 #letters posted, or about to be, not finished
+        self.elapsed = 0.0
+        self.error = None
+
+    def start(self, path):
+        """Starts replaying path in the background. Returns False if a
+        replay is already running."""
+        if self.running():
+            return False
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.play, args=(path,),
+                                        name="ScriptPlayer", daemon=True)
+        self._thread.start()
+        return True
+
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def stop(self):
+        """Stops posting letters. Those already posted still run."""
+        self._stop.set()
+
+    def wait(self, timeout=None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def steps(self, path):
+        """The compiled steps for path, from the cache if the file hasn't
+        changed, otherwise compiled as they are read and cached once the
+        whole file has been."""
+        mtime = os.stat(path).st_mtime_ns
+        cached = self._compiled.get(path)
+        if cached is not None and cached[0] == mtime:
+            yield from cached[1]
+            return
+        program = []
+        for step in compile_steps(read_script(path), self.interpreter,
+                                  self.codec):
+            program.append(step)
+            yield step
+        self._compiled[path] = (mtime, program)
+
+    def play(self, path):
+        """Replays path on the calling thread. Returns True if every letter
+        was posted and finished without error."""
+        self.letters_sent = 0
+        self.error = None
+        room = threading.Condition()
+        self._unfinished = 0
+        failed = [] #exceptions from finished letters
+
+        def finished(future):
+            if future.cancelled():
+                failed.append(concurrent.futures.CancelledError())
+            elif future.exception() is not None:
+                failed.append(future.exception())
+            with room:
+                self._unfinished -= 1
+                room.notify()
+
+        start = time.perf_counter()
+        try:
+            for step in self.steps(path):
+                if not self._make_room(room, failed, len(step)):
+                    break
+                contents = [content for content, _ in step]
+                wires = [wire for _, wire in step]
+                for future in self.interpreter.post_group(contents,
+                                                          wires=wires):
+                    future.add_done_callback(finished)
+                    self.letters_sent += 1
+            self._wait_finished(room, failed)
+        except Exception as e:
+            #bad line or unreadable file
+            self.error = e
+        if failed and self.error is None:
+            #a command failed, timed out or was cancelled
+            self.error = failed[0]
+        self.elapsed = time.perf_counter() - start
+        if self.error is not None:
+            print(f"ScriptPlayer: {path} stopped after {self.letters_sent} "
+                  f"letters, {self.error!r}")
+            return False
+        print(f"ScriptPlayer: {path}, {self.letters_sent} letters in "
+              f"{self.elapsed:.2f}s")
+        return not self._stop.is_set()
+
+    def _wait_finished(self, room, failed):
+        """Waits until every letter posted has finished, stop() is called
+        or one has failed."""
+        with room:
+            while self._unfinished and not (self._stop.is_set() or failed):
+                room.wait(0.1)
+
+    def _make_room(self, room, failed, count=1):
+        """Waits until count more letters can be posted with no more than
+        lookahead unfinished, or until none are for a step bigger than
+        that, and the link is clear to send. Reserves their places. Returns
+        False if stop() is called or a letter has failed meanwhile."""
+        with room:
+            while self._unfinished and \
+                  self._unfinished + count > self.lookahead:
+                room.wait(0.1)
+                if self._stop.is_set() or failed:
+                    return False
+            if self._stop.is_set() or failed:
+                return False
+            self._unfinished += count
+        if self.link is not None:
+            while not self.link.wait_clear(0.1):
+                if self._stop.is_set() or failed:
+                    return False
+        return not (self._stop.is_set() or failed)
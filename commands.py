@@ -27,11 +27,25 @@ from PyQt5.QtCore import (pyqtSignal,
                           QObject,
                           )
 import time
+import concurrent.futures
 import post_office
+import command_batcher
+import command_optimizer
+import send_queue
+import latency_stats
+from latency_stats import LATENCY
 
 _AXIS_SEPARATOR = '&' #used for mutli-axis cmds to separate the axes in display
 
 
+def _grouped(contents, together=False):
+    """contents as stream_groups() gives them: one list if together, else
+    one list each."""
+    if together:
+        return [contents] if contents else []
+    return [[content] for content in contents]
+
+
 print("Importing commands.py")
 
 class Command:
@@ -124,7 +138,9 @@ class CommandList:
     
     
     _private_cmd_list = [("set_axis_mac_ids","m","", False), #used for comm level
-
+             ("batch","m","", False), #several low-level cmds in one frame
+             ("group","m","", False), #low-level cmds that move together
+             ("stop","m","", False), #halt, marshaller drops what's pending
              ]
     #This is the dictionary that stores dinternal commands and their attributes.
     #The command name is the keyword and the value for each keyword is the
@@ -180,8 +196,23 @@ class CommandInterpreter(QObject):
     
     MY_PO_ID = "CommandInterpreter_1"
     
-    def __init__(self, po):
+    def __init__(self, po, coalesce=False, optimize=False, concurrent=False):
+        """coalesce True packs all the low-level commands made from one user
+        command into a single batch letter, see command_batcher.py. The
+        marshaller firmware must understand batch commands.
+        optimize True runs the low-level commands of scripts and scans
+        (stream_contents()) through a CommandOptimizer, see
+        command_optimizer.py. Commands sent one at a time with
+        send_command() never are, the optimizer would drop a z toggle the
+        user asked for whenever it thinks z is already there.
+        concurrent True sends the commands of a multi-axis user command, e.g.
+        to_point on x&y, as one barrier group so the axes move at the same
+        time. Also needs firmware support."""
         super().__init__()
+        self.coalesce = coalesce
+        self.concurrent = concurrent
+        self.optimize = optimize
+        self.optimizer = None #the last stream's, for its stats
         self.cmds_to_send = [] #CommMarshal will get commands here
         print(f"in CmdIntrp, msg in po: {po.id_msg}")
         self.post_office = po
@@ -231,21 +262,155 @@ class CommandInterpreter(QObject):
         return axis_str.split(sep=_AXIS_SEPARATOR)
         
     
-    def send_command(self, cmd_name, axes, parm_list, block):
+    def send_command(self, cmd_name, axes, parm_list, block, ui_time=None,
+                     priority=None):
         """ The ui that gets a user-created command should call this to start
         the process that sends the command to the backend  This should be a call
-        to the ESP32 over serial comm I believe. NOT an Emit????"""
+        to the ESP32 over serial comm I believe. NOT an Emit????
+        ui_time is the time.perf_counter() when the user asked for the
+        command, for the latency stats.
+        priority, e.g. send_queue.PRIORITY_CONTROL for a safety z_up, sends
+        the command ahead of whatever is queued.
+        Returns a list of concurrent.futures.Future, one per letter posted,
+        that complete when the DataLink has sent (or, with replies on, the
+        marshaller has finished) the command. See data_link.py."""
         
         #TOO: Map command into 1 or more lower level commands. This results
         #in a cmd_list that needs to be sent to the marshaller, via the
         #data_link, one at a time
-        cmd_list = self.create_low_level_public_cmd_list( cmd_name, axes,
-                                                   parm_list, block)
-        for cmd in cmd_list:
-            letter = post_office.Letter('DataLink_1', self.MY_PO_ID, cmd)
-            self.post_office.post(letter)
+        contents = self.low_level_contents( cmd_name, axes, parm_list, block)
+        futures = self.post_group(contents, ui_time, priority=priority)
  #           if len(cmd_list) > 1:
  #               time.sleep(0.3)  #pause to give uart time to re-init
 
         #self.gotNewCommands.emit()
+        return futures
+
+
+    def low_level_contents(self, cmd_name, axes, parm_list, block):
+        """The letter contents send_command() posts for a user command: its
+        low-level commands, or a single batch or group of them when
+        coalescing or concurrent. They are never optimized."""
+        cmd_list = self.create_low_level_public_cmd_list( cmd_name, axes,
+                                                   parm_list, block)
+        return self._pack(cmd_list, self._multi_axis(axes))
+
+
+    def stream_contents(self, user_cmds):
+        """Yields the letter contents for a run of user commands, each
+        (cmd_name, axes, parm_list, block). When optimizing, the run gets an
+        optimizer of its own that starts knowing nothing about the axes, so
+        commands are merged across user commands too and the result doesn't
+        depend on what was sent before. Used for scripts and scans."""
+        for group in self.stream_groups(user_cmds):
+            yield from group
+
+
+    def stream_groups(self, user_cmds):
+        """stream_contents() as lists to post with post_group(). The
+        contents of a multi-axis user command come in one list, so they are
+        queued together or not at all, anything else one to a list."""
+        if not self.optimize:
+            for cmd_name, axes, parm_list, block in user_cmds:
+                contents = self.low_level_contents(cmd_name, axes, parm_list,
+                                                   block)
+                yield from _grouped(contents, self._multi_axis(axes))
+            return
+        optimizer = command_optimizer.CommandOptimizer(
+            CommandList.increment_distance)
+        self.optimizer = optimizer
+        for cmd_name, axes, parm_list, block in user_cmds:
+            group = self._multi_axis(axes)
+            if group:
+                #only this user command's commands go in its group
+                yield from _grouped(self._pack(optimizer.flush()))
+            cmds = []
+            for cmd in self.create_low_level_public_cmd_list( cmd_name, axes,
+                                                        parm_list, block):
+                cmds += optimizer.feed(cmd)
+            if group:
+                cmds += optimizer.flush()
+            yield from _grouped(self._pack(cmds, group), group)
+        yield from _grouped(self._pack(optimizer.flush()))
+        self._report_savings(optimizer.stats())
+
+
+    def _multi_axis(self, axes):
+        return _AXIS_SEPARATOR in axes
+
+
+    def _pack(self, cmd_list, group=False):
+        """The letter contents for cmd_list. group True if they are the
+        commands of one multi-axis user command."""
+        if len(cmd_list) > 1:
+            if group and self.concurrent:
+                return [command_batcher.group_content(cmd_list)]
+            if self.coalesce:
+                return [command_batcher.batch_content(cmd_list)]
+        return cmd_list
+
+
+    def _report_savings(self, stats):
+        saved = stats['commands_saved']
+        seconds = stats['seconds_saved']
+        if saved > 0 or seconds > 0.0:
+            print(f"CmdInterp: optimizer saved {saved} commands, about "
+                  f"{seconds:.2f}s")
+
+
+    def send_stop(self, cancel_pending=True, lift=True, ui_time=None):
+        """Halts the axes. The stop goes ahead of everything queued and, with
+        cancel_pending, everything queued is cancelled (see data_link.py).
+        lift follows it with a z_up. Returns the futures of the letters
+        posted."""
+        priority = send_queue.PRIORITY_STOP if cancel_pending else \
+                   send_queue.PRIORITY_CONTROL
+        futures = [self.post_content(["stop", "m", [], False], ui_time,
+                                     priority=priority)]
+        if lift:
+            futures.append(self.post_content(
+                ["z_up", "z", [], True], ui_time,
+                priority=send_queue.PRIORITY_CONTROL))
+        return futures
+
+
+    def post_group(self, contents, ui_time=None, wires=None, priority=None):
+        """Posts the letter contents of one user command and returns their
+        futures. More than one share an Admission, so the DataLink queues
+        them all or none, and a to_point can't move one axis and not the
+        other. wires, if given, has a wire for each content (see
+        post_content())."""
+        admission = send_queue.Admission(len(contents)) \
+                    if len(contents) > 1 else None
+        wires = wires or [None] * len(contents)
+        return [self.post_content(content, ui_time, wire, priority, admission)
+                for content, wire in zip(contents, wires)]
+
+
+    def post_content(self, content, ui_time=None, wire=None, priority=None,
+                     admission=None):
+        """Posts one letter of low-level content to the DataLink and returns
+        its future. wire is (protocol, bytes) if the content has already been
+        encoded, see command_script.py. priority is as for send_command().
+        admission is a send_queue.Admission shared by the letters of one
+        user command."""
+        letter = post_office.Letter('DataLink_1', self.MY_PO_ID, content)
+        future = concurrent.futures.Future()
+        letter.set_future(future)
+        if priority is not None:
+            letter.set_priority(priority)
+        if wire is not None:
+            letter.set_wire(*wire)
+        if admission is not None:
+            letter.set_admission(admission)
+        self._stamp(letter, ui_time)
+        self.post_office.post(letter)
+        return future
+
+
+    def _stamp(self, letter, ui_time):
+        if LATENCY.enabled:
+            if ui_time is not None:
+                letter.stamp(latency_stats.STAGE_UI, ui_time)
+            letter.stamp(latency_stats.STAGE_INTERPRET)
         
\ No newline at end of file
@@ -18,18 +18,163 @@ The idea is to run the actual port monitoring functionality as thread. Rather
 than direct calls, a queue is used to transfer data btween the main thread
 running the gui and the data_link communication thread. Polling is used to
 check for data in a queue that needs to be processed.
+
+Since then the link has grown the following, each described where it is
+done:
+
+- two I/O modes for run(), the original polled loop and an event driven one
+  with its own writer thread (IO_POLLED, IO_EVENT)
+- flow control between writes (flow_control.py), a choice of wire protocol
+  (wire_protocol.py) and batching of commands into one frame
+  (command_batcher.py)
+- a future on each letter, finished when it is written or, with replies on,
+  when the marshaller answers it (write_letters(), _wait_for_room())
+- the marshaller's ready message at startup (_marshaller_is_ready())
+- a send queue with lanes by priority, where a stop goes first and cancels
+  what is behind it (backend_transport_callback(), cancel_pending())
+- backpressure: posting never blocks, a full queue rejects the command
+  (_pressure_changed(), _reject())
+- an inbox of the marshaller's messages for the GUI and a store for its
+  telemetry (backend_message_received())
+
+Future callbacks run on the link's threads, so GUI code must not touch
+widgets from one.
+
+async_link.py has the same link for asyncio, without Qt or threads, for
+headless and scripted runs.
 """
 from PyQt5 import QtCore
-from PyQt5.QtCore import pyqtSlot, QByteArray, QThread
-import serial
+from PyQt5.QtCore import pyqtSignal, pyqtSlot, QByteArray, QThread
 import time
 import queue
+import os
+import selectors
+import threading
+import collections
 import post_office
-import json
+import flow_control
+import wire_protocol
+import command_batcher
+import send_queue
+import trace_ring
+from trace_ring import TRACE
+import latency_stats
+from latency_stats import LATENCY
+from flow_control import FLOW_FIXED_DELAY, FLOW_CREDIT
+from wire_protocol import PROTOCOL_JSON, PROTOCOL_FRAMED, CommandFailed
 
 TO_BACKEND_Q_SIZE     = 50
 TO_POST_OFFICE_Q_SIZE = 50
 SERIAL_TIMEOUT        = 0.1
+SERIAL_PORT           = '/dev/serial0'
+SERIAL_BAUDRATE       = 115200
+WRITE_TIME_DELAY      = 0.5 #seconds. Minimum time between uart writes.
+MAX_IN_FLIGHT         = 4    #non-blocking commands awaiting a reply at once
+REPLY_TIMEOUT         = 30.0 #seconds. Long enough for the slowest move.
+REPLY_CHECK_INTERVAL  = 1.0  #seconds between overdue reply checks when idle
+READY_TIMEOUT         = 2.5  #seconds. An esp32 boots in about 1 s.
+STOP_HISTORY          = 100  #stop latencies kept
+INBOX_SIZE            = 2000 #inbound messages kept for the GUI to pick up
+HIGH_WATERMARK        = 40   #queued letters that put the link under pressure
+LOW_WATERMARK         = 10   #and the number it must drain to before it's clear
+
+#I/O modes for DataLink.run(). IO_POLLED is the original loop that reads the
+#uart with a short timeout and then checks the outgoing queue, so a letter can
+#sit in the queue for up to SERIAL_TIMEOUT before it is looked at. IO_EVENT
+#uses a writer thread that blocks on the outgoing queue and wakes as soon as a
+#letter is put there, while run() itself waits in a selector on the serial fd
+#and only wakes when bytes arrive (or stop() is called).
+IO_POLLED = 'polled'
+IO_EVENT  = 'event'
+
+_STOP_WRITER = object() #put in to_backend_q to wake and stop the writer thread
+
+
+def _blocking(letters):
+    for letter in letters:
+        if command_batcher.is_blocking(letter.content()):
+            return True
+    return False
+
+
+def _start_future(letter):
+    """Marks a letter's future as running. False if it was cancelled, in which
+    case the letter should not be sent."""
+    future = letter.future()
+    return future is None or future.set_running_or_notify_cancel()
+
+
+def _priority(letters):
+    return min(send_queue.priority_of(letter) for letter in letters)
+
+
+def _cancelled(letters):
+    """True if every letter has a future and all of them were cancelled."""
+    for letter in letters:
+        future = letter.future()
+        if future is None or not future.cancelled():
+            return False
+    return True
+
+
+def _copy_outcome(done, future):
+    """Passes one finished future's outcome on to another."""
+    if future.done():
+        return
+    if done.cancelled():
+        future.cancel()
+    elif done.exception() is not None:
+        future.set_exception(done.exception())
+    else:
+        future.set_result(done.result())
+
+
+def _merge_moves(queued, letter):
+    """Under backpressure, a move_rel right behind a queued move_rel on the
+    same axis becomes one letter moving the sum of the two. Returns that
+    letter, or None if they can't be merged. The merged letter takes on the
+    queued letter's future and stamps, and the new letter's future gets the
+    same outcome."""
+    a, b = queued.content(), letter.content()
+    if type(a) is not list or type(b) is not list or len(a) != 4 or \
+       len(b) != 4 or a[0] != 'move_rel' or b[0] != 'move_rel' or \
+       a[1] != b[1] or letter.priority() is not None:
+        return None
+    try:
+        distance = float(a[2]) + float(b[2])
+    except (TypeError, ValueError):
+        return None
+    futures = [f for f in (queued.future(), letter.future()) if f is not None]
+    if any(f.done() for f in futures):
+        return None
+    merged = post_office.Letter(queued.destination(), queued.source(),
+                                ['move_rel', a[1], str(round(distance, 6)),
+                                 bool(a[3] or b[3])])
+    merged.set_priority(queued.priority())
+    for stage, t in (queued.stamps() or {}).items():
+        merged.stamp(stage, t)
+    if futures:
+        merged.set_future(futures[0])
+        for future in futures[1:]:
+            futures[0].add_done_callback(
+                lambda done, future=future: _copy_outcome(done, future))
+    return merged
+
+
+def _is_telemetry(msg):
+    return type(msg) is list and len(msg) > 0 and \
+           msg[0] in (wire_protocol.TELEMETRY, wire_protocol.SAMPLES)
+
+
+def _finish(letters, result=None, error=None):
+    for letter in letters:
+        future = letter.future()
+        if future is None or future.done():
+            continue
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
 
 
 class DataLink( QThread ):
@@ -40,22 +185,97 @@ class DataLink( QThread ):
     locaton. Data is posted into queues that are checked by signal/slot methods
     that PyQt5 implements.
 
-    NOTE: There is a time-since-last-transmission check in run() where the
-    uart.write occurs to make sure that messages don't get processed to
-    quickly. The uart is very slow to get to ready state after a write.
+    NOTE: Every uart.write first goes through send_gate (a CreditGate) to
+    make sure that messages don't get processed to quickly. The uart is very
+    slow to get to ready state after a write.
     TODO: Check to see if read poses the same problems.
     """
     
     MY_PO_ID  = "DataLink_1"
     
-    def __init__( self, post_office ):
+    marshallerReady = pyqtSignal() #the marshaller said ready, see wait_ready()
+    backpressureChanged = pyqtSignal(bool, int) #under pressure, queue depth
+    commandRejected = pyqtSignal(object) #content of a command not queued
+    portOpened = pyqtSignal(bool) #run() has the uart open, or failed to
+    
+    def __init__( self, post_office, port=SERIAL_PORT, io_mode=IO_POLLED,
+                  flow=FLOW_FIXED_DELAY, protocol=PROTOCOL_JSON,
+                  max_batch=command_batcher.DEFAULT_MAX_BATCH,
+                  batch_window=command_batcher.DEFAULT_WINDOW,
+                  replies=False, max_in_flight=MAX_IN_FLIGHT, telemetry=None):
         QThread.__init__(self)
+        assert io_mode in (IO_POLLED, IO_EVENT), f"unknown io mode {io_mode}"
+        assert flow in (FLOW_FIXED_DELAY, FLOW_CREDIT), f"unknown flow {flow}"
+        assert not replies or protocol == PROTOCOL_FRAMED, \
+               "replies need the framed protocol to carry sequence ids"
         self._post_office = post_office
-        self._post_office.register(self.MY_PO_ID, self.backend_transport_callback)
+        self._post_office.register(self.MY_PO_ID,
+                                   self.backend_transport_callback,
+                                   direct=True) #to_backend_q is our mailbox
         
-        self.to_backend_q     = queue.Queue(TO_BACKEND_Q_SIZE)
+        self.port    = port
+        self.io_mode = io_mode
+        self.uart    = None
+        #Lanes by priority, see send_queue.py. The normal lane has watermarks,
+        #see _pressure_changed().
+        self.to_backend_q     = send_queue.SendQueue(TO_BACKEND_Q_SIZE,
+                                                 HIGH_WATERMARK, LOW_WATERMARK,
+                                                 self._pressure_changed)
+        self.clear_to_send = threading.Event() #cleared while under pressure
+        self.clear_to_send.set()
+        self.letters_rejected = 0 #posted while to_backend_q was full
+        #Messages from the marshaller for the GUI, (perf_counter(), message),
+        #see backend_message_received()
+        self.inbox = collections.deque(maxlen=INBOX_SIZE)
+        self.telemetry = telemetry #where samples go, e.g. a TelemetryStore
+        self.inbox_dropped = 0 #fell out of inbox before the GUI took them
         self.to_post_office_q = queue.Queue(TO_POST_OFFICE_Q_SIZE)
         self.running = True #boolean used to indicate run() should continue.
+        self.port_open = threading.Event() #set once run() has the uart open
+        self.marshaller_ready = threading.Event()
+        self.ready_at = None #perf_counter() of the last ready message
+        #How soon after one write the next may go out. FLOW_FIXED_DELAY keeps
+        #writes WRITE_TIME_DELAY apart. FLOW_CREDIT sends as soon as the
+        #marshaller has acked enough to leave room in its receive window,
+        #falling back to the fixed delay for firmware that never advertises one.
+        self.flow = flow
+        self.send_gate = flow_control.CreditGate(WRITE_TIME_DELAY)
+        #PROTOCOL_JSON is the original json.dumps() of the letter content.
+        #PROTOCOL_FRAMED sends length-prefixed, CRC checked frames with a
+        #compact binary form for low-level commands.
+        self.codec = wire_protocol.codec(protocol)
+        #Letters taken off to_backend_q go through the batcher, which can pack
+        #several low-level commands into one batch frame. With the default
+        #max_batch of 1 every letter goes out on its own.
+        self.batcher = command_batcher.CommandBatcher(max_batch, batch_window)
+        self._decoder = self.codec.new_decoder()
+        self._wake_w = None #write end of the pipe used to wake the selector
+        #Letters written and waiting on a reply, oldest first. Without
+        #sequence ids the marshaller answers in order, so a reply goes with
+        #the oldest one.
+        self._awaiting_reply = collections.deque(maxlen=TO_BACKEND_Q_SIZE)
+        #With replies each frame goes out with a sequence id and the
+        #marshaller answers it with ["reply", seq, status, result] when the
+        #command is done, which finishes the futures of the letters in that
+        #frame. Only the framed protocol has room for a sequence id, and only
+        #firmware that replies should be run this way. Without replies a
+        #future is finished (with None) as soon as its letter is written, so
+        #callers see the same interface either way.
+        #Frames in flight by seq: (letters, blocking, deadline)
+        self.replies = replies
+        self.max_in_flight = max(int(max_in_flight), 1)
+        self.reply_timeout = REPLY_TIMEOUT
+        self.reply_timeouts = 0
+        self._in_flight = {}
+        self._blocking_in_flight = 0
+        self._in_flight_cond = threading.Condition()
+        self._seq = 0
+        self._unsent = None #polled loop: letters dequeued, waiting for room
+        self._waiting = None #letters held in _wait_for_room()
+        self.letters_cancelled = 0 #by stops
+        self._stop_posted = {} #letter id: perf_counter() a stop was queued
+        #seconds from a stop being posted to its bytes being written
+        self.stop_latencies = collections.deque(maxlen=STOP_HISTORY)
         
     def backend_transport_callback(self, letter):
         """Post Office calls this to deliver a letter to this DataLink
@@ -72,82 +292,544 @@ class DataLink( QThread ):
         
         #Add letter to queue for processing when the run thread activates. Any
         #letter added to the queue is assumed to be for the backend.
-        self.to_backend_q.put(letter)
-        print(f"mail call for DataLink. Letter is:")
-        print(f"To:      {letter.destination()}")
-        print(f"From:    {letter.source()}")
-        print(f"Content: {letter.content()}")
+        #A stop or a safety command goes out ahead of any moves already
+        #queued, and a stop cancels everything not yet written behind it.
+        #Letters already written are left to the marshaller, which stops them
+        #itself.
+        priority = send_queue.priority_of(letter)
+        if priority == send_queue.PRIORITY_STOP:
+            self._stop_posted[letter.letter_id()] = time.perf_counter()
+            self.cancel_pending()
+        #the letters of one user command are queued all together or not at
+        #all, so a to_point can't move one axis and leave the other
+        admission = letter.admission()
+        room = 1
+        if admission is not None:
+            if admission.admitted is False:
+                self._reject(letter, report=False)
+                return
+            room = 0 if admission.admitted else admission.size
+        try:
+            self.to_backend_q.put(letter, priority, block=False,
+                                  merge=_merge_moves, room=room)
+        except queue.Full:
+            if admission is not None:
+                admission.admitted = False
+            self._reject(letter)
+            return
+        if admission is not None:
+            admission.admitted = True
+        if priority != send_queue.PRIORITY_NORMAL:
+            with self._in_flight_cond:
+                self._in_flight_cond.notify_all() #writer may be waiting
+        if LATENCY.enabled:
+            letter.stamp(latency_stats.STAGE_QUEUED)
+        if TRACE.enabled:
+            TRACE.record(trace_ring.STAGE_QUEUED, letter.letter_id(),
+                         self.to_backend_q.qsize())
+
+
+    def _reject(self, letter, report=True):
+        """letter found to_backend_q full. Its future fails with queue.Full
+        and, once per user command, commandRejected tells the GUI."""
+        self.letters_rejected += 1
+        future = letter.future()
+        if future is not None and not future.done():
+            future.set_exception(queue.Full("DataLink queue full"))
+        if report:
+            self.commandRejected.emit(letter.content())
 
 
-    def str_bytes(self,s):
-        return s.encode('utf-8')
+    def _pressure_changed(self, under_pressure, depth):
+        """to_backend_q went over its high watermark or back down to its low
+        one. Called on whichever thread put or took the letter.
+
+        Posting never blocks the poster, which is usually the GUI thread.
+        Producers that can wait, e.g. a script player, call wait_clear()
+        before posting instead. While the lane is under pressure a move_rel
+        posted right behind a queued one on the same axis is merged into it
+        (see _merge_moves()), and a letter that still finds it full is
+        rejected."""
+        if under_pressure:
+            self.clear_to_send.clear()
+        else:
+            self.clear_to_send.set()
+        self.backpressureChanged.emit(under_pressure, depth)
+
+
+    def wait_clear(self, timeout=None):
+        """Waits until to_backend_q isn't under pressure. Returns False if
+        it still is after timeout seconds."""
+        return self.clear_to_send.wait(timeout)
 
 
     def uart_receive(self, s):
         if type(s) is str:
-            rtn_str = s
-        else:
-            rtn_str = ""
-            for b in s:
-                rtn_str = rtn_str + chr(b)
-        return( rtn_str)
+            return s
+        return bytes(s).decode('latin-1') #one char per byte, same as chr(b)
                 
            
-    def uart_send(self, s ):
-        print(f"uart sending: {s}")
-        
-
-    def serialize( self, str_list):
-        """ Serializes a list of string elements using json in order to
-        transport over uart"""
-        return json.dumps(str_list)
+    def serialize( self, str_list, seq=None):
+        """ Serializes a list of string elements into the bytes that go over
+        the uart, using the link's protocol."""
+        return self.codec.encode(str_list, seq)
     
  
-    def run(self):
-        """This is the async routine that is used for the thread process. It's
-        job is to manage the serial port and move messages to the appropriate
-        queues so other routines may process them."""
-        
-        self.uart = serial.Serial(port     = '/dev/serial0',
-                           baudrate = 115200,
+    def open_uart(self):
+        """Opens and flushes the serial port. Called from run() so the port
+        belongs to the link thread. pyserial is imported here rather than
+        at the top so it costs nothing until the link actually starts."""
+        import serial
+        self.uart = serial.Serial(port     = self.port,
+                           baudrate = SERIAL_BAUDRATE,
                            parity   = serial.PARITY_NONE,
                            stopbits = serial.STOPBITS_ONE,
                            bytesize = serial.EIGHTBITS,
                            timeout  = SERIAL_TIMEOUT)
         time.sleep(SERIAL_TIMEOUT*1.2)
         self.uart.flushInput()
-        WRITE_TIME_DELAY = 0.5 #seconds
-        start_time = time.perf_counter()
-        
+        self._decoder.reset()
+        self.port_open.set()
+
+
+    def close_uart(self):
+        self.port_open.clear()
+        if self.uart:
+            self.uart.close()
+            self.uart = None
+
+
+    def stop(self):
+        """Asks run() to finish. Safe to call from any thread. In IO_EVENT
+        mode the selector and the writer thread are woken so they can exit
+        right away instead of waiting for the next byte or letter."""
+        self.running = False
+        self.send_gate.cancel()
+        with self._in_flight_cond:
+            self._in_flight_cond.notify_all()
+        if self._wake_w is not None:
+            try:
+                os.write(self._wake_w, b'x')
+            except OSError:
+                pass #pipe already closed, run() is on its way out
+        self.to_backend_q.put_nowait(_STOP_WRITER, send_queue.PRIORITY_STOP)
+
+
+    def cancel_pending(self, priority=send_queue.PRIORITY_STOP):
+        """Cancels every letter less urgent than priority that hasn't been
+        written yet: those queued, the one the batcher is holding and those
+        the writer is holding back. Returns how many were cancelled."""
+        removed = self.to_backend_q.cancel_below(priority)
+        held = [self.batcher.held()] + list(self._waiting or ()) + \
+               list(self._unsent or ())
+        held = [letter for letter in held if letter is not None and
+                letter is not _STOP_WRITER and
+                send_queue.priority_of(letter) > priority]
+        for letter in removed + held:
+            future = letter.future()
+            if future is not None:
+                future.cancel()
+        count = len(removed) + len(held)
+        self.letters_cancelled += count
+        if count:
+            print(f"DataLink: cancelled {count} pending letters")
+        return count
+
+
+    def backend_bytes_received(self, s):
+        """Handles bytes that came in from the backend."""
+        if TRACE.enabled:
+            TRACE.record(trace_ring.STAGE_RX_BYTES, 0, len(s))
+        #one at a time, samples go to telemetry before the frame buffer they
+        #are in is reused
+        for msg in self._decoder.messages(s):
+            self.backend_message_received(msg)
+
+
+    def backend_message_received(self, msg):
+        """Handles one complete message from the backend. Flow control
+        messages are used here, anything else is for the rest of the system."""
+        ctrl = wire_protocol.control_message(msg)
+        if ctrl is not None:
+            if TRACE.enabled:
+                TRACE.record(trace_ring.STAGE_CTRL, 0, ctrl[1])
+            kind, count = ctrl
+            if kind == wire_protocol.CTRL_READY:
+                self._marshaller_is_ready(count)
+            elif self.flow == FLOW_CREDIT:
+                if kind == wire_protocol.CTRL_WINDOW:
+                    self.send_gate.window(count)
+                else:
+                    self.send_gate.ack(count)
+            return
+        #We have letter from backend
+        #Need to send to PO
+        if TRACE.enabled:
+            TRACE.record(trace_ring.STAGE_RX_MSG)
+        #Telemetry goes to the store if there is one. Blocks of samples off
+        #the framed link are copied from the receive buffer straight into its
+        #rings. Without a store, single ["telemetry", ...] samples go in inbox
+        #like anything else and blocks are dropped.
+        if _is_telemetry(msg):
+            if self.telemetry is not None:
+                self.telemetry.add_message(msg)
+                return
+            if msg[0] == wire_protocol.SAMPLES:
+                return #its data goes when the decoder is fed again
+        elif self.replies:
+            reply = wire_protocol.reply_message(msg)
+            if reply is not None:
+                self._reply_received(*reply)
+                return
+        elif self._awaiting_reply:
+            letter = self._awaiting_reply.popleft()
+            if LATENCY.enabled:
+                letter.stamp(latency_stats.STAGE_RESPONSE)
+                LATENCY.letter_done(letter, latency_stats.STAGE_RESPONSE)
+        #The reader only appends and the GUI only takes with take_inbox(), so
+        #no lock or signal is needed per message. The GUI picks them up in
+        #batches on a timer at display rate, see response_view.py.
+        if len(self.inbox) == INBOX_SIZE:
+            self.inbox_dropped += 1
+        self.inbox.append((time.perf_counter(), msg))
+
+
+    def take_inbox(self, max_count=None):
+        """Removes and returns the oldest messages in inbox, all of them or
+        up to max_count, as (perf_counter(), message). Safe to call from
+        any thread while the reader appends."""
+        taken = []
+        inbox = self.inbox
+        while inbox and (max_count is None or len(taken) < max_count):
+            try:
+                taken.append(inbox.popleft())
+            except IndexError:
+                break
+        return taken
+
+
+    def _marshaller_is_ready(self, window):
+        """The marshaller has (re)started and sent ["ready", window], so
+        startup can go on the moment it is up instead of sleeping for a
+        guessed time. Its receive buffer is empty, so the window it gives
+        replaces whatever credit we thought we had."""
+        if self.flow == FLOW_CREDIT and window > 0:
+            self.send_gate.window(window)
+        self.ready_at = time.perf_counter()
+        self.marshaller_ready.set()
+        self.marshallerReady.emit()
+
+
+    def expect_restart(self):
+        """Call before resetting the marshaller. wait_ready() then waits for
+        the ready that follows the reset."""
+        self.marshaller_ready.clear()
+
+
+    def wait_ready(self, timeout=READY_TIMEOUT):
+        """Blocks until the marshaller says it is ready. False on timeout,
+        which is what firmware without the handshake gives."""
+        return self.marshaller_ready.wait(timeout)
+
+
+    def write_letter(self, letter):
+        """Serializes a letter's content and writes it to the uart once the
+        send gate says the marshaller is ready for it."""
+        self.write_letters([letter])
+
+
+    def _reply_received(self, seq, status, result):
+        with self._in_flight_cond:
+            entry = self._in_flight.pop(seq, None)
+            if entry is None:
+                return #late reply to something that already timed out
+            letters, blocking, _ = entry
+            if blocking:
+                self._blocking_in_flight -= 1
+            self._in_flight_cond.notify_all()
+        if LATENCY.enabled:
+            replied = time.perf_counter()
+            for letter in letters:
+                letter.stamp(latency_stats.STAGE_RESPONSE, replied)
+                LATENCY.letter_done(letter, latency_stats.STAGE_RESPONSE)
+        if status == wire_protocol.STATUS_OK:
+            _finish(letters, result)
+        else:
+            _finish(letters, error=CommandFailed(status, result))
+
+
+    def _expire_replies(self):
+        """Drops frames whose reply is overdue. Call holding _in_flight_cond.
+        Returns (letters dropped, seconds to the next deadline or None). The
+        dropped letters are failed by the caller once the lock is let go."""
+        now = time.perf_counter()
+        expired = []
+        next_deadline = None
+        for seq, (letters, blocking, deadline) in list(self._in_flight.items()):
+            if deadline <= now:
+                del self._in_flight[seq]
+                if blocking:
+                    self._blocking_in_flight -= 1
+                self.reply_timeouts += 1
+                print(f"DataLink: no reply to seq {seq} in "
+                      f"{self.reply_timeout}s")
+                expired.extend(letters)
+            elif next_deadline is None or deadline < next_deadline:
+                next_deadline = deadline
+        if next_deadline is not None:
+            next_deadline -= now
+        return expired, next_deadline
+
+
+    def _check_replies(self):
+        """Fails frames whose reply is overdue. Returns how long the reader
+        may sleep before it should check again."""
+        with self._in_flight_cond:
+            expired, until_next = self._expire_replies()
+        if expired:
+            _finish(expired, error=TimeoutError("no reply from marshaller"))
+        if until_next is None:
+            return REPLY_CHECK_INTERVAL
+        return min(until_next, REPLY_CHECK_INTERVAL)
+
+
+    def _wait_for_room(self, letters, wait=True):
+        """Holds letters back until they may be sent with replies on. A
+        blocking frame waits for everything in flight to finish, and nothing
+        goes out behind it until it finishes too. Anything else is pipelined,
+        waiting for one of max_in_flight slots and for any blocking command
+        ahead of it. No reply within reply_timeout fails the future with
+        TimeoutError. Urgent letters (see send_queue.py) don't wait. Returns
+        True when the letters may go, False if the link is stopping or, with
+        wait False, if they can't go yet, and None if they are no longer
+        ours to send: a stop cancelled them, or they have been put back in
+        the queue to make way for something more urgent."""
+        if _cancelled(letters):
+            return None
+        priority = _priority(letters)
+        if not self.replies or priority != send_queue.PRIORITY_NORMAL:
+            return True
+        blocking = _blocking(letters)
+        self._waiting = letters
+        try:
+            while True:
+                with self._in_flight_cond:
+                    expired, until_next = self._expire_replies()
+                    if not expired:
+                        if not self.running:
+                            return False
+                        if _cancelled(letters):
+                            return None
+                        if self.to_backend_q.more_urgent(priority):
+                            self.to_backend_q.requeue(letters, priority)
+                            return None
+                        if blocking:
+                            room = not self._in_flight
+                        else:
+                            room = not self._blocking_in_flight and \
+                                   len(self._in_flight) < self.max_in_flight
+                        if room:
+                            return True
+                        if not wait:
+                            return False
+                        self._in_flight_cond.wait(until_next)
+                        continue
+                _finish(expired, error=TimeoutError("no reply from marshaller"))
+        finally:
+            self._waiting = None
+
+
+    def _next_seq(self):
+        self._seq = self._seq % 0xFFFF + 1 #1 to 65535, 0 is never used
+        return self._seq
+
+
+    def write_letters(self, letters):
+        """Writes letters to the uart as one frame. More than one letter
+        goes out as a batch. A letter whose future was cancelled before now
+        is kept off the wire."""
+        started = []
+        for letter in letters:
+            if _start_future(letter):
+                started.append(letter)
+            elif self._stop_posted:
+                self._stop_posted.pop(letter.letter_id(), None) #never goes out
+        letters = started
+        if not letters:
+            return #all cancelled while they waited in the queue
+        if LATENCY.enabled:
+            for letter in letters:
+                letter.stamp(latency_stats.STAGE_DEQUEUED)
+        content = self.batcher.content_for(letters)
+        if TRACE.enabled:
+            for letter in letters:
+                TRACE.record(trace_ring.STAGE_DEQUEUED, letter.letter_id(),
+                             len(letters))
+        seq = self._next_seq() if self.replies else None
+        wire = letters[0].wire(self.codec.name) if len(letters) == 1 else None
+        if wire is not None:
+            send_bytes = self.codec.with_seq(wire, seq) #encoded ahead of time
+        else:
+            send_bytes = self.serialize(content, seq)
+        #Need to wait so uart can keep up with cmd processing
+        if not self.send_gate.acquire():
+            _finish(letters, error=ConnectionAbortedError("DataLink stopped"))
+            return #stopping
+        if LATENCY.enabled:
+            cleared = time.perf_counter()
+        if self.replies:
+            #Tracked before the write so a quick reply can't beat us to it
+            blocking = _blocking(letters)
+            with self._in_flight_cond:
+                self._in_flight[seq] = (letters, blocking,
+                                        time.perf_counter() + self.reply_timeout)
+                if blocking:
+                    self._blocking_in_flight += 1
+        self.uart.write(send_bytes)
+        if self._stop_posted:
+            self._stop_written(letters)
+        if TRACE.enabled:
+            TRACE.record(trace_ring.STAGE_WRITE, letters[0].letter_id(),
+                         len(send_bytes))
+        if LATENCY.enabled:
+            written = time.perf_counter()
+            for letter in letters:
+                letter.stamp(latency_stats.STAGE_CLEARED, cleared)
+                letter.stamp(latency_stats.STAGE_WRITTEN, written)
+                LATENCY.letter_done(letter, latency_stats.STAGE_WRITTEN)
+        if not self.replies:
+            #A batch is answered once, so it's tracked by its first letter.
+            self._awaiting_reply.append(letters[0])
+            _finish(letters)
+
+ 
+    def _stop_written(self, letters):
+        now = time.perf_counter()
+        for letter in letters:
+            posted = self._stop_posted.pop(letter.letter_id(), None)
+            if posted is not None:
+                self.stop_latencies.append(now - posted)
+                print(f"DataLink: stop written {(now - posted) * 1000.0:.1f} "
+                      f"ms after it was posted")
+
+ 
+    def run(self):
+        """This is the async routine that is used for the thread process. It's
+        job is to manage the serial port and move messages to the appropriate
+        queues so other routines may process them."""
+        try:
+            self.open_uart()
+        except OSError as e: #serial.SerialException is one
+            print(f"DataLink could not open {self.port}: {e}")
+            self.portOpened.emit(False)
+            self._abandon_letters()
+            return
+        self.portOpened.emit(True)
+        if self.io_mode == IO_EVENT:
+            self._run_event_loop()
+        else:
+            self._run_polled_loop()
+        self.close_uart()
+        self._abandon_letters()
+
+
+    def _abandon_letters(self):
+        """Fails the futures of everything still queued or in flight once
+        the link has stopped, so nobody waits on them forever."""
+        unsent = self._unsent or []
+        self._unsent = None
+        self._stop_posted.clear() #none of them will be written now
+        held = self.batcher.take_held()
+        if held is not None and held is not _STOP_WRITER:
+            unsent.append(held)
+        while True:
+            try:
+                letter = self.to_backend_q.get_nowait()
+            except queue.Empty:
+                break
+            if letter is not _STOP_WRITER:
+                unsent.append(letter)
+        for letter in unsent:
+            future = letter.future()
+            if future is not None:
+                future.cancel()
+        with self._in_flight_cond:
+            in_flight, self._in_flight = self._in_flight, {}
+            self._blocking_in_flight = 0
+        stopped = ConnectionAbortedError("DataLink stopped")
+        for letters, _, _ in in_flight.values():
+            _finish(letters, error=stopped)
+
+
+    def _run_polled_loop(self):
+        """Original loop: short timeout read, then check the outgoing queue."""
         while self.running:
             s = self.uart.read(self.uart.in_waiting or 1)
             if s:
-                #We have letter from backend
-                msg = self.uart_receive(s)
-                #Need to send to PO
-                print(f"run got backend message: {msg}")
+                self.backend_bytes_received(s)
+            if self.replies:
+                self._check_replies()
                 
             #Deal with mail addressed to us. Any     
-            if not self.to_backend_q.empty():
-                letter = self.to_backend_q.get()
-                content = letter.content()
-                print(f"in run, content: <{content}>")
-                #tx_data = str(self.to_backend_q.get())
-                send_str = self.serialize(content)
-                print(f"after serialize: <{send_str}>")
-                #Need a timeout so uart can keep up with cmd processing
-                #time.sleep(0.3) #perhaps this should be in the post_office.post
-                current_time = time.perf_counter()
-                elapsed_time = current_time - start_time
-                print(f"st: {start_time}, ct: {current_time}, et = {elapsed_time}")
-                start_time = current_time
-                if elapsed_time < WRITE_TIME_DELAY:
-                    time.sleep( WRITE_TIME_DELAY- elapsed_time)
-                    start_time = time.perf_counter()
-                self.uart.write(self.str_bytes(send_str))
-                
-                
-        if self.uart:
-            self.uart.close()
-            self.uart = None
- 
+            if self._unsent is None and self.send_gate.ready() and \
+               (self.batcher.has_held() or not self.to_backend_q.empty()):
+                letters = self.batcher.next_letters(self.to_backend_q,
+                                                    wait=False,
+                                                    stop_marker=_STOP_WRITER)
+                if letters[0] is not _STOP_WRITER:
+                    self._unsent = letters
+            #With replies on, a letter may have to wait its turn. Checked
+            #without blocking so replies keep being read meanwhile.
+            if self._unsent is not None:
+                room = self._wait_for_room(self._unsent, wait=False)
+                if room is None:
+                    self._unsent = None #cancelled or put back
+                elif room:
+                    letters, self._unsent = self._unsent, None
+                    self.write_letters(letters)
+
+
+    def _run_event_loop(self):
+        """Reader side runs here, blocked in a selector on the serial fd and
+        the wake pipe. Outgoing letters are handled by _writer_loop on its own
+        thread, which sleeps in to_backend_q.get()."""
+        wake_r, self._wake_w = os.pipe()
+        selector = selectors.DefaultSelector()
+        selector.register(self.uart.fileno(), selectors.EVENT_READ, 'uart')
+        selector.register(wake_r, selectors.EVENT_READ, 'wake')
+        writer = threading.Thread(target=self._writer_loop,
+                                  name="DataLink writer", daemon=True)
+        writer.start()
+        
+        timeout = None
+        while self.running:
+            if self.replies:
+                timeout = self._check_replies()
+            for key, _ in selector.select(timeout):
+                if key.data == 'wake':
+                    os.read(wake_r, 64)
+                    continue
+                s = self.uart.read(self.uart.in_waiting or 1)
+                if s:
+                    self.backend_bytes_received(s)
+        
+        writer.join()
+        selector.close()
+        wake_w, self._wake_w = self._wake_w, None
+        os.close(wake_w)
+        os.close(wake_r)
+
+
+    def _writer_loop(self):
+        while self.running:
+            letters = self.batcher.next_letters(self.to_backend_q,
+                                                stop_marker=_STOP_WRITER)
+            if letters[0] is _STOP_WRITER:
+                break
+            room = self.running and self._wait_for_room(letters)
+            if room is None:
+                continue #cancelled or put back
+            if not room:
+                self._unsent = letters #failed by _abandon_letters()
+                break
+            self.write_letters(letters)
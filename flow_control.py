@@ -0,0 +1,129 @@
+"""
+flow_control.py
+
+Decides when DataLink may write the next message to the marshaller.
+
+The original scheme (FLOW_FIXED_DELAY) simply keeps uart writes at least
+WRITE_TIME_DELAY apart, because the marshaller uart is slow to get back to a
+ready state after a write and anything sent too soon gets lost. That is safe
+but caps the link at a couple of commands a second.
+
+With FLOW_CREDIT the marshaller tells us how many messages it can take
+(its receive window) and acks each one once it has room again. DataLink sends
+as long as it holds credit and only waits when the marshaller is full. Until a
+window is advertised the fixed delay is still used, so older marshaller
+firmware that never advertises keeps working exactly as before.
+"""
+import threading
+import time
+
+FLOW_FIXED_DELAY = 'fixed_delay'
+FLOW_CREDIT      = 'credit'
+
+ACK_TIMEOUT = 2.0 #seconds to wait on credit before assuming an ack was lost
+
+
+class CreditGate:
+    """Counts send credits granted by the marshaller. acquire() takes one
+    credit, blocking while there are none. window() and ack() are called
+    from the link's receive side when the marshaller's control messages
+    arrive."""
+
+    def __init__(self, fallback_delay, ack_timeout=ACK_TIMEOUT):
+        self._fallback_delay = fallback_delay
+        self._ack_timeout = ack_timeout
+        self._cond = threading.Condition()
+        self._window = None  #None until the marshaller advertises one
+        self._credits = 0
+        self._cancelled = False
+        self._last_send = time.perf_counter()
+        self.ack_timeouts = 0 #times credit was assumed back after ACK_TIMEOUT
+
+    def advertised(self):
+        """True once the marshaller has told us its receive window."""
+        return self._window is not None
+
+    def window(self, size):
+        """The marshaller advertised a receive window of size messages. This
+        happens at startup and again whenever the marshaller resets, so any
+        credit we thought was outstanding is forgotten."""
+        with self._cond:
+            self._window = max(int(size), 1)
+            self._credits = self._window
+            self._cond.notify_all()
+
+    def ack(self, count=1):
+        """The marshaller has finished with count messages."""
+        with self._cond:
+            if self._window is None:
+                return #acks from firmware that never sent a window
+            self._credits = min(self._credits + int(count), self._window)
+            self._cond.notify_all()
+
+    def cancel(self):
+        """Wakes anyone blocked in acquire() so the link can shut down."""
+        with self._cond:
+            self._cancelled = True
+            self._cond.notify_all()
+
+    def ready(self):
+        """True if acquire() would not block. Used by the polled loop, which
+        can't afford to sit in acquire() since it also reads the acks."""
+        if self._window is None or self._credits > 0:
+            return True
+        return time.perf_counter() - self._last_send >= self._ack_timeout
+
+    def acquire(self):
+        """Takes a credit for the next write. Without an advertised window
+        this sleeps out the rest of the fallback delay instead. Returns False
+        only if cancel() was called."""
+        if self._window is None:
+            self._fixed_delay()
+            return not self._cancelled
+        with self._cond:
+            starved_at = self._last_send + self._ack_timeout
+            if not self._cond.wait_for(lambda: self._credits > 0 or
+                                       self._cancelled,
+                                       max(starved_at - time.perf_counter(), 0)):
+                #Marshaller went quiet on us. Rather than hang forever, assume
+                #an ack got garbled on the way back and carry on.
+                self.ack_timeouts += 1
+                print(f"CreditGate: no ack in {self._ack_timeout}s, "
+                      f"assuming it was lost")
+                self._credits = 1
+            if self._cancelled:
+                return False
+            self._credits -= 1
+            self._last_send = time.perf_counter()
+        return True
+
+    def take(self):
+        """acquire() for callers that can't block, i.e. an asyncio loop.
+        Takes a credit and returns 0, or returns the seconds to wait before
+        trying again. Returns None if cancel() was called."""
+        now = time.perf_counter()
+        with self._cond:
+            if self._cancelled:
+                return None
+            if self._window is None:
+                wait = self._last_send + self._fallback_delay - now
+                if wait > 0:
+                    return wait
+            elif self._credits <= 0:
+                wait = self._last_send + self._ack_timeout - now
+                if wait > 0:
+                    return wait
+                self.ack_timeouts += 1
+                print(f"CreditGate: no ack in {self._ack_timeout}s, "
+                      f"assuming it was lost")
+                self._credits = 1
+            if self._window is not None:
+                self._credits -= 1
+            self._last_send = now
+        return 0
+
+    def _fixed_delay(self):
+        elapsed = time.perf_counter() - self._last_send
+        if elapsed < self._fallback_delay:
+            time.sleep(self._fallback_delay - elapsed)
+        self._last_send = time.perf_counter()
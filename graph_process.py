@@ -0,0 +1,275 @@
+"""
+graph_process.py
+
+Runs the isobar graph (see isobar.py and graph_view.py) in its own process,
+so interpolating and drawing the map doesn't hold the GIL while the GUI and
+the DataLink thread have work to do.
+
+The commander publishes each measurement into a MeasurementRing, a
+multiprocessing.shared_memory block of capacity rows of the
+measurement_store columns (x, y, load, deflection, compliance, timestamp)
+as float64, after a header of two counters:
+
+    written   rows the commander has put in, ever
+    read      rows the graph process has taken, ever
+
+Row n goes in slot n % capacity and written is only bumped once it is
+there, so the graph process copies rows read to written straight out of
+shared memory with no pickling. If it falls more than capacity behind, the
+rows written over are counted as lost and it carries on from the oldest
+one still there.
+
+The notification channel is a Pipe. After publishing, the commander sends
+one byte only if the graph process had already taken everything before
+this row, i.e. it is idle and waiting. Otherwise it is busy and will see
+the new rows when it checks written again before waiting, so however fast
+rows come in there is at most one byte in the pipe. The graph process wakes
+on the pipe (a QSocketNotifier when it shows the graph, poll() when it
+doesn't), takes what's new, updates its IsobarMap and redraws. It runs
+NICENESS below the commander, so where they share a core the GUI and the
+DataLink thread go first and the graph catches up in bigger batches.
+
+Stopping sends b's' down the pipe. The graph process answers with its
+stats as json and exits.
+
+shared_memory is new in Python 3.8. With an older Python, or without NumPy
+in the graph process, graph_available() is False.
+"""
+import json
+import multiprocessing
+import os
+import struct
+import time
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+import isobar
+import measurement_store
+
+RING_ROWS = 4096 #measurements the ring holds, far more than a scan gets ahead
+DEFAULT_X_RANGE = (0.0, 15.0) #inches, about the lower bout of a guitar top
+DEFAULT_Y_RANGE = (0.0, 21.0)
+STOP_TIMEOUT = 5.0 #seconds to wait for the graph process to finish
+NICENESS = 10 #the graph process gives way to the commander for the CPU
+_HEADER = struct.Struct('<QQ') #written, read
+_ROW = struct.Struct('<' + 'd' * len(measurement_store.COLUMNS))
+_NOTIFY = b'n'
+_STOP = b's'
+_IDLE_POLL = 0.5 #seconds, the headless graph process checks written anyway
+
+
+def graph_available():
+    return shared_memory is not None and isobar.numpy_available()
+
+
+class MeasurementRing:
+
+    def __init__(self, capacity=RING_ROWS, name=None):
+        """Makes a new ring of capacity rows, or attaches to the one called
+        name that another process made."""
+        if shared_memory is None:
+            raise ImportError("shared memory needs Python 3.8")
+        self.capacity = capacity
+        if name is None:
+            self.shm = shared_memory.SharedMemory(
+                create=True, size=_HEADER.size + capacity * _ROW.size)
+            _HEADER.pack_into(self.shm.buf, 0, 0, 0)
+            self.owner = True
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.owner = False
+        self.name = self.shm.name
+        self.lost = 0 #rows written over before they were read
+
+    def written(self):
+        return _HEADER.unpack_from(self.shm.buf, 0)[0]
+
+    def read_count(self):
+        return _HEADER.unpack_from(self.shm.buf, 0)[1]
+
+    def publish(self, x, y, load, deflection, timestamp=None):
+        """Puts a measurement in the ring. Returns True if the reader was
+        idle and needs telling."""
+        if timestamp is None:
+            timestamp = time.time()
+        written = self.written()
+        _ROW.pack_into(self.shm.buf,
+                       _HEADER.size + (written % self.capacity) * _ROW.size,
+                       x, y, load, deflection,
+                       measurement_store.compliance_of(load, deflection),
+                       timestamp)
+        struct.pack_into('<Q', self.shm.buf, 0, written + 1)
+        return self.read_count() >= written
+
+    def take(self):
+        """Copies out the rows published since the last take() as a
+        (rows, columns) NumPy array and marks them read."""
+        np = isobar.np
+        read = self.read_count()
+        written = self.written()
+        if written - read > self.capacity:
+            self.lost += written - read - self.capacity
+            read = written - self.capacity
+        rows = np.frombuffer(self.shm.buf, dtype='<f8', offset=_HEADER.size,
+                             count=self.capacity * len(measurement_store.COLUMNS))
+        rows = rows.reshape(self.capacity, -1)
+        start, end = read % self.capacity, written % self.capacity
+        if written == read:
+            taken = rows[:0].copy()
+        elif start < end:
+            taken = rows[start:end].copy()
+        else:
+            taken = np.concatenate((rows[start:], rows[:end]))
+        del rows #let go of the buffer so the block can be closed
+        overwritten = self.written() - self.capacity - read
+        if overwritten > 0:
+            #the writer lapped us while copying, those rows are new ones
+            taken = taken[overwritten:]
+            self.lost += overwritten
+        struct.pack_into('<Q', self.shm.buf, 8, written)
+        return taken
+
+    def close(self):
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class GraphProcess:
+    """The commander's end. start() makes the ring and starts the graph
+    process, publish() sends it measurements, stop() ends it."""
+
+    def __init__(self, x_range=DEFAULT_X_RANGE, y_range=DEFAULT_Y_RANGE,
+                 capacity=RING_ROWS, show=True):
+        self.x_range = x_range
+        self.y_range = y_range
+        self.capacity = capacity
+        self.show = show
+        self.ring = None
+        self.published = 0
+        self.notifications = 0
+        self._conn = None
+        self._process = None
+
+    def start(self):
+        self.ring = MeasurementRing(self.capacity)
+        #spawn, not fork, so the child doesn't inherit the GUI's Qt state
+        context = multiprocessing.get_context('spawn')
+        self._conn, child_conn = context.Pipe()
+        self._process = context.Process(
+            target=_graph_main, name="isobar graph", daemon=True,
+            args=(self.ring.name, self.capacity, child_conn, self.x_range,
+                  self.y_range, self.show))
+        self._process.start()
+        child_conn.close()
+
+    def running(self):
+        return self._process is not None and self._process.is_alive()
+
+    def publish(self, x, y, load, deflection, timestamp=None):
+        """Sends a measurement to the graph. Never waits on the graph
+        process."""
+        self.published += 1
+        if self.ring.publish(x, y, load, deflection, timestamp):
+            self.notifications += 1
+            try:
+                self._conn.send_bytes(_NOTIFY)
+            except (BrokenPipeError, OSError):
+                pass #graph window closed, measurements carry on without it
+
+    def stop(self, timeout=STOP_TIMEOUT):
+        """Ends the graph process and returns its stats, {} if it had
+        already gone."""
+        if self._process is None:
+            return {}
+        stats = {}
+        try:
+            self._conn.send_bytes(_STOP)
+            if self._conn.poll(timeout):
+                stats = json.loads(self._conn.recv_bytes().decode())
+        except (BrokenPipeError, EOFError, OSError):
+            pass
+        self._process.join(timeout)
+        if self._process.is_alive():
+            self._process.terminate()
+            self._process.join()
+        self._conn.close()
+        self.ring.close()
+        self._process = None
+        stats['published'] = self.published
+        stats['notifications'] = self.notifications
+        return stats
+
+
+class _Grapher:
+    """The graph process's end: takes rows off the ring into an
+    IsobarMap."""
+
+    def __init__(self, ring, x_range, y_range):
+        self.ring = ring
+        self.isobars = isobar.IsobarMap(x_range, y_range)
+        self.updates = 0
+        self.update_time = 0.0 #seconds taking rows and redoing contours
+        self.longest_update = 0.0
+
+    def update(self):
+        """Takes everything published, until nothing more comes in while it
+        works. Returns True if there was anything."""
+        took = False
+        while self.ring.written() > self.ring.read_count():
+            began = time.perf_counter()
+            rows = self.ring.take()
+            self.isobars.add_points(rows[:, 0], rows[:, 1], rows[:, 4])
+            self.isobars.contours()
+            spent = time.perf_counter() - began
+            self.update_time += spent
+            self.longest_update = max(self.longest_update, spent)
+            self.updates += 1
+            took = True
+        return took
+
+    def stats(self):
+        stats = self.isobars.stats()
+        stats.update({'updates': self.updates, 'lost': self.ring.lost,
+                      'update_ms': self.update_time * 1000.0,
+                      'longest_update_ms': self.longest_update * 1000.0})
+        return stats
+
+
+def _graph_main(name, capacity, conn, x_range, y_range, show):
+    if hasattr(os, 'nice'):
+        os.nice(NICENESS)
+    ring = MeasurementRing(capacity, name)
+    grapher = _Grapher(ring, x_range, y_range)
+    try:
+        if show:
+            import graph_view
+            graph_view.run(grapher, conn)
+        else:
+            _run_headless(grapher, conn)
+        conn.send_bytes(json.dumps(grapher.stats()).encode())
+    except (BrokenPipeError, EOFError, OSError):
+        pass #the commander has gone
+    finally:
+        ring.close()
+
+
+def _run_headless(grapher, conn):
+    """Updates the map whenever told to until told to stop."""
+    while True:
+        grapher.update()
+        if conn.poll(_IDLE_POLL):
+            if _STOP in conn.recv_bytes():
+                grapher.update()
+                return
+
+
+def wants_stop(conn):
+    """Drains the pipe, True if a stop was in it."""
+    stop = False
+    while conn.poll(0):
+        stop = _STOP in conn.recv_bytes() or stop
+    return stop
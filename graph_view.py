@@ -0,0 +1,76 @@
+"""
+graph_view.py
+
+The isobar graph window, shown by the graph process (see graph_process.py),
+never by the commander itself.
+
+IsobarView draws the contour segments of an IsobarMap, a colour per level
+from blue for the stiffest to red for the most compliant, scaled to fit the
+window with the top's y running up the screen. run() shows it and wakes
+whenever the commander's pipe has something in it, through a
+QSocketNotifier on the pipe, so the process does nothing at all between
+measurements.
+"""
+import sys
+
+from PyQt5.QtCore import QLineF, QSocketNotifier, Qt
+from PyQt5.QtGui import QColor, QPainter, QPen
+from PyQt5.QtWidgets import QApplication, QWidget
+
+import graph_process
+
+MARGIN = 10 #pixels around the map
+
+
+class IsobarView(QWidget):
+
+    def __init__(self, isobars, parent=None):
+        super().__init__(parent)
+        self.isobars = isobars
+        self.setWindowTitle("Compliance isobars")
+        self.resize(450, 600)
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.fillRect(self.rect(), Qt.white)
+        isobars = self.isobars
+        width = isobars.xs[-1] - isobars.x0
+        height = isobars.ys[-1] - isobars.y0
+        if width <= 0 or height <= 0:
+            return
+        scale = min((self.width() - 2 * MARGIN) / width,
+                    (self.height() - 2 * MARGIN) / height)
+        painter.setRenderHint(QPainter.Antialiasing)
+        painter.translate(MARGIN, MARGIN + height * scale)
+        painter.scale(scale, -scale)
+        painter.translate(-isobars.x0, -isobars.y0)
+        contours = isobars.contours()
+        for n, (level, segments) in enumerate(contours):
+            hue = 0.66 * (1.0 - n / max(len(contours) - 1, 1))
+            pen = QPen(QColor.fromHsvF(hue, 1.0, 0.8))
+            pen.setCosmetic(True)
+            painter.setPen(pen)
+            painter.drawLines([QLineF(x1, y1, x2, y2)
+                               for (x1, y1), (x2, y2) in segments.tolist()])
+        painter.end()
+
+
+def run(grapher, conn):
+    """Shows grapher's map until the commander says stop or the window is
+    closed."""
+    app = QApplication.instance() or QApplication(sys.argv[:1])
+    view = IsobarView(grapher.isobars)
+
+    def readable():
+        stop = graph_process.wants_stop(conn)
+        if grapher.update():
+            view.update()
+        if stop:
+            app.quit()
+
+    notifier = QSocketNotifier(conn.fileno(), QSocketNotifier.Read)
+    notifier.activated.connect(readable)
+    view.show()
+    readable() #anything published before the window was up
+    app.exec_()
+    notifier.setEnabled(False)
@@ -0,0 +1,326 @@
+"""
+isobar.py
+
+The graphing module's engine. Works out the isobar (contour) lines of the
+compliance measured over a top, and keeps them up to date point by point
+during a scan rather than redrawing everything after the run.
+
+IsobarMap covers the top with a grid of nodes spacing inches apart and
+interpolates the scattered measurements onto it by inverse distance
+weighting. A point only reaches radius inches, with Shepard's weight
+((radius - d) / (radius * d))^2 falling to nothing at the edge, so each node
+keeps two running sums, sum(w * value) and sum(w), and its value is one over
+the other. Adding a point adds its weights to the nodes within radius of it,
+a small window of the grid worked out in one go with NumPy, and nothing
+else changes. Nodes no point reaches are nan and get no lines.
+
+The lines come from marching squares, run over every cell of a block and
+every level at once: each cell's corners are compared with each level to
+give its case, and the cells with a line through them are found with one
+nonzero() and their segment ends interpolated along the crossed edges.
+Saddle cells go by the value at their centre.
+
+The grid is cut into tiles of TILE_CELLS cells a side and the segments of
+each tile are cached. A new point marks the tiles its window touches, and
+contours() redoes only those, so a point costs a few tiles whatever the
+size of the map. The levels are the ones given, or with levels a count,
+round numbers spread over the range measured so far. All the tiles are
+redone when the levels change, which happens less and less as the range
+settles early in a scan.
+
+contours() gives a list of (level, segments), segments an (n, 2, 2) array of
+line ends in inches, ready to draw as separate lines. Points come from
+add_point(), add_points(), or follow() for the rows a MeasurementSession
+(see measurement_store.py) has committed since it was last followed.
+
+NumPy is needed. Without it numpy_available() is False and IsobarMap can't
+be made.
+"""
+import math
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+DEFAULT_SPACING = 0.125 #inches between grid nodes
+DEFAULT_RADIUS = 1.5 #inches a point's influence reaches
+DEFAULT_LEVELS = 10 #lines about this many when choosing levels
+TILE_CELLS = 16 #grid cells a side per cached tile
+_NEAR = 1e-3 #fraction of spacing, nearer than this counts as on the node
+
+#case (corner a=1, b=2, c=4, d=8 above the level): pairs of crossed edges,
+#edges 0 a-b (bottom), 1 b-c (right), 2 d-c (top), 3 a-d (left)
+_SEGMENTS = {1: ((3, 0),), 2: ((0, 1),), 3: ((3, 1),), 4: ((1, 2),),
+             6: ((0, 2),), 7: ((3, 2),), 8: ((2, 3),), 9: ((0, 2),),
+             11: ((1, 2),), 12: ((3, 1),), 13: ((0, 1),), 14: ((3, 0),),
+             #saddles, going by the centre below the level
+             5: ((3, 0), (1, 2)), 10: ((0, 1), (2, 3)),
+             #and, case + 16, above it
+             21: ((0, 1), (2, 3)), 26: ((3, 0), (1, 2))}
+
+
+def _edge_table(n):
+    """The nth pair of edges of each case, 32 of them, [-1, -1] for none."""
+    table = [[-1, -1] for _ in range(32)]
+    for case, pairs in _SEGMENTS.items():
+        if len(pairs) > n:
+            table[case] = list(pairs[n])
+    return table
+
+
+if np is not None:
+    _FIRST = np.array(_edge_table(0))
+    _SECOND = np.array(_edge_table(1))
+
+
+def numpy_available():
+    return np is not None
+
+
+def nice_levels(lo, hi, count=DEFAULT_LEVELS):
+    """About count round-numbered levels strictly between lo and hi."""
+    if not (math.isfinite(lo) and math.isfinite(hi)) or hi <= lo:
+        return []
+    raw = (hi - lo) / count
+    power = 10.0 ** math.floor(math.log10(raw))
+    for step in (1.0, 2.0, 2.5, 5.0, 10.0):
+        if step * power >= raw:
+            break
+    step *= power
+    first = math.floor(lo / step) + 1
+    levels = []
+    k = first
+    while k * step < hi:
+        levels.append(round(k * step, 12))
+        k += 1
+    return levels
+
+
+def marching_squares(z, levels, x0=0.0, y0=0.0, spacing=1.0):
+    """Contour segments of the grid z (rows y, columns x, node (j, i) at
+    (x0 + i * spacing, y0 + j * spacing)) for each level. Returns a list,
+    one (n, 2, 2) array of segment ends per level. Cells with a nan corner
+    are skipped."""
+    z = np.asarray(z, dtype=np.float64)
+    levels = np.asarray(levels, dtype=np.float64).reshape(-1)
+    if z.shape[0] < 2 or z.shape[1] < 2 or not len(levels):
+        return [np.zeros((0, 2, 2)) for _ in levels]
+    a, b = z[:-1, :-1], z[:-1, 1:]
+    c, d = z[1:, 1:], z[1:, :-1]
+    lv = levels[:, None, None]
+    case = ((a > lv) * 1 | (b > lv) * 2 | (c > lv) * 4 | (d > lv) * 8)
+    valid = np.isfinite(a) & np.isfinite(b) & np.isfinite(c) & np.isfinite(d)
+    case[:, ~valid] = 0
+    case[case == 15] = 0
+    l, j, i = np.nonzero(case)
+    if not len(l):
+        return [np.zeros((0, 2, 2)) for _ in levels]
+    level = levels[l]
+    za, zb, zc, zd = a[j, i], b[j, i], c[j, i], d[j, i]
+    k = case[l, j, i]
+    saddle = (k == 5) | (k == 10)
+    k = k + (saddle & ((za + zb + zc + zd) / 4.0 > level)) * 16
+    #where the level crosses each edge of each cell, in nodes
+    n = len(l)
+    ex, ey = np.empty((4, n)), np.empty((4, n))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ex[0], ey[0] = i + (level - za) / (zb - za), j
+        ex[1], ey[1] = i + 1, j + (level - zb) / (zc - zb)
+        ex[2], ey[2] = i + (level - zd) / (zc - zd), j + 1
+        ex[3], ey[3] = i, j + (level - za) / (zd - za)
+    cells = np.arange(n)
+    first = _FIRST[k]
+    two = np.flatnonzero(_SECOND[k, 0] >= 0)
+    second = _SECOND[k[two]]
+    e1 = np.concatenate((first[:, 0], second[:, 0]))
+    e2 = np.concatenate((first[:, 1], second[:, 1]))
+    at = np.concatenate((cells, two))
+    which = np.concatenate((l, l[two]))
+    ends = np.empty((len(at), 2, 2))
+    ends[:, 0, 0] = x0 + ex[e1, at] * spacing
+    ends[:, 0, 1] = y0 + ey[e1, at] * spacing
+    ends[:, 1, 0] = x0 + ex[e2, at] * spacing
+    ends[:, 1, 1] = y0 + ey[e2, at] * spacing
+    order = np.argsort(which, kind='stable')
+    ends, which = ends[order], which[order]
+    bounds = np.searchsorted(which, np.arange(len(levels) + 1))
+    return [ends[bounds[n]:bounds[n + 1]] for n in range(len(levels))]
+
+
+class IsobarMap:
+
+    def __init__(self, x_range, y_range, spacing=DEFAULT_SPACING,
+                 radius=DEFAULT_RADIUS, levels=DEFAULT_LEVELS):
+        """A map of (x min, x max) by (y min, y max) inches. levels is a
+        list of the levels to draw, or how many to choose from the data."""
+        if np is None:
+            raise ImportError("isobars need numpy")
+        self.x0, self.y0 = float(x_range[0]), float(y_range[0])
+        self.spacing = float(spacing)
+        self.radius = float(radius)
+        self.nx = int(math.ceil((x_range[1] - self.x0) / self.spacing)) + 1
+        self.ny = int(math.ceil((y_range[1] - self.y0) / self.spacing)) + 1
+        self.xs = self.x0 + np.arange(self.nx) * self.spacing
+        self.ys = self.y0 + np.arange(self.ny) * self.spacing
+        self._sum = np.zeros((self.ny, self.nx)) #sum(w * value)
+        self._weight = np.zeros((self.ny, self.nx)) #sum(w)
+        self._values = np.full((self.ny, self.nx), np.nan)
+        self._tiles_x = max((self.nx - 2) // TILE_CELLS + 1, 1)
+        self._tiles_y = max((self.ny - 2) // TILE_CELLS + 1, 1)
+        self._tiles = {} #(tx, ty): [segments per level]
+        self._dirty = set()
+        self._joined = None #contours() result while nothing has changed
+        self._count = levels if isinstance(levels, int) else None
+        self._levels = [] if self._count else [float(v) for v in levels]
+        self._followed = {} #session path: rows added
+        self.lo = math.inf #range of the values measured
+        self.hi = -math.inf
+        self.points = 0
+        self.tiles_redone = 0
+        self.grid_time = 0.0 #seconds spent adding points
+        self.contour_time = 0.0 #seconds spent in contours()
+
+    def add_point(self, x, y, value):
+        """Adds one measurement. nan values (no load) are left out."""
+        value = float(value)
+        if not math.isfinite(value):
+            return
+        began = time.perf_counter()
+        self.points += 1
+        self.lo = min(self.lo, value)
+        self.hi = max(self.hi, value)
+        reach = self.radius / self.spacing
+        fx = (x - self.x0) / self.spacing
+        fy = (y - self.y0) / self.spacing
+        i0 = max(int(math.floor(fx - reach)), 0)
+        i1 = min(int(math.ceil(fx + reach)) + 1, self.nx)
+        j0 = max(int(math.floor(fy - reach)), 0)
+        j1 = min(int(math.ceil(fy + reach)) + 1, self.ny)
+        if i0 >= i1 or j0 >= j1:
+            self.grid_time += time.perf_counter() - began
+            return
+        dx = self.xs[i0:i1] - x
+        dy = self.ys[j0:j1, None] - y
+        dist = np.sqrt(dx * dx + dy * dy)
+        np.maximum(dist, self.spacing * _NEAR, out=dist)
+        w = np.clip(self.radius - dist, 0.0, None) / (self.radius * dist)
+        w *= w
+        window = (slice(j0, j1), slice(i0, i1))
+        self._sum[window] += w * value
+        self._weight[window] += w
+        weight = self._weight[window]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self._values[window] = np.where(weight > 0.0,
+                                            self._sum[window] / weight, np.nan)
+        #cell (j, i) has nodes j..j+1, i..i+1
+        for ty in range(max(j0 - 1, 0) // TILE_CELLS,
+                        min((j1 - 1) // TILE_CELLS, self._tiles_y - 1) + 1):
+            for tx in range(max(i0 - 1, 0) // TILE_CELLS,
+                            min((i1 - 1) // TILE_CELLS, self._tiles_x - 1) + 1):
+                self._dirty.add((tx, ty))
+        self._joined = None
+        self.grid_time += time.perf_counter() - began
+
+    def add_points(self, xs, ys, values):
+        for x, y, value in zip(xs, ys, values):
+            self.add_point(float(x), float(y), value)
+
+    def follow(self, session):
+        """Adds the rows session, a MeasurementSession, has committed since
+        it was last followed. Returns how many rows that was."""
+        start = self._followed.get(session.path, 0)
+        if session.readonly:
+            session.refresh()
+        end = session.count
+        if end <= start:
+            return 0
+        self.add_points(session.column('x')[start:end],
+                        session.column('y')[start:end],
+                        session.column('compliance')[start:end])
+        self._followed[session.path] = end
+        return end - start
+
+    def grid(self):
+        """The interpolated values, rows y and columns x (see xs and ys),
+        nan where no point reaches. The map's own array, don't change it."""
+        return self._values
+
+    def levels(self):
+        if self._count:
+            levels = nice_levels(self.lo, self.hi, self._count)
+            if levels != self._levels:
+                self._levels = levels
+                self._tiles = {}
+                self._joined = None
+        return self._levels
+
+    def set_levels(self, levels):
+        """Draws levels (a list) from now on, or a count of them chosen
+        from the data."""
+        self._count = levels if isinstance(levels, int) else None
+        self._levels = [] if self._count else [float(v) for v in levels]
+        self._tiles = {}
+        self._joined = None
+
+    def _tile(self, tx, ty, levels):
+        i0, j0 = tx * TILE_CELLS, ty * TILE_CELLS
+        block = self._values[j0:j0 + TILE_CELLS + 1, i0:i0 + TILE_CELLS + 1]
+        return marching_squares(block, levels, self.x0 + i0 * self.spacing,
+                                self.y0 + j0 * self.spacing, self.spacing)
+
+    def contours(self):
+        """[(level, segments), ...] for the points so far, redoing only the
+        tiles that have changed since the last call."""
+        levels = self.levels()
+        if self._joined is not None:
+            return self._joined
+        began = time.perf_counter()
+        if not self._tiles:
+            redo = [(tx, ty) for ty in range(self._tiles_y)
+                    for tx in range(self._tiles_x)]
+        else:
+            redo = self._dirty
+        for tile in redo:
+            self._tiles[tile] = self._tile(tile[0], tile[1], levels)
+        self.tiles_redone += len(redo)
+        self._dirty = set()
+        tiles = list(self._tiles.values())
+        self._joined = [(level, np.concatenate([t[n] for t in tiles]))
+                        for n, level in enumerate(levels)]
+        self.contour_time += time.perf_counter() - began
+        return self._joined
+
+    def stats(self):
+        return {'points': self.points, 'tiles_redone': self.tiles_redone,
+                'grid_ms': self.grid_time * 1000.0,
+                'contour_ms': self.contour_time * 1000.0}
+
+
+def map_for(session, margin=DEFAULT_RADIUS, **kwargs):
+    """An IsobarMap big enough for session's points with margin inches
+    around them, following session."""
+    xs, ys = session.column('x'), session.column('y')
+    if len(xs):
+        x_range = (float(xs.min()) - margin, float(xs.max()) + margin)
+        y_range = (float(ys.min()) - margin, float(ys.max()) + margin)
+    else:
+        x_range = y_range = (0.0, 1.0)
+    isobars = IsobarMap(x_range, y_range, **kwargs)
+    isobars.follow(session)
+    return isobars
+
+
+if __name__ == "__main__":
+    import sys
+    import measurement_store
+    if len(sys.argv) != 2:
+        print("usage: python isobar.py session_folder")
+        sys.exit(1)
+    session = measurement_store.MeasurementSession(sys.argv[1], readonly=True)
+    isobars = map_for(session)
+    for level, segments in isobars.contours():
+        print(f"{level:12.6g} {len(segments):6d} segments")
+    print(isobars.stats())
+    session.close()
@@ -0,0 +1,161 @@
+"""
+latency_stats.py
+
+End-to-end command latency, broken down by stage. Each letter carrying a
+command is stamped with the time it reached each stage on its way to the
+marshaller:
+
+    ui          the user pressed send (CmdInputDisplay.send_command_to_client)
+    interpret   CommandInterpreter made the low-level letter
+    post        PostOffice.post() got it
+    queued      DataLink put it in to_backend_q
+    dequeued    the DataLink writer took it off the queue
+    cleared     the send gate let it go (flow control / WRITE_TIME_DELAY)
+    written     uart.write() returned
+    response    the marshaller's reply came back
+
+Stages a letter skips (e.g. no ui stamp for startup commands) are left out.
+The time between each stamp and the one before it is added to a histogram
+kept per command name, axis and stage, along with the total from first to
+last stamp ("total:written" and "total:response"). LATENCY.summary() gives
+p50/p95/p99 for each of them.
+
+Histograms are log-bucketed (BUCKETS_PER_OCTAVE buckets for every doubling)
+so recording is a few arithmetic operations and memory stays fixed however
+many commands are sent. Percentiles are accurate to about 10%.
+"""
+import math
+import threading
+
+STAGE_UI        = 0
+STAGE_INTERPRET = 1
+STAGE_POST      = 2
+STAGE_QUEUED    = 3
+STAGE_DEQUEUED  = 4
+STAGE_CLEARED   = 5
+STAGE_WRITTEN   = 6
+STAGE_RESPONSE  = 7
+
+STAGE_NAMES = ("ui", "interpret", "post", "queued", "dequeued", "cleared",
+               "written", "response")
+TOTAL = "total"
+
+BUCKETS_PER_OCTAVE = 8
+_MIN_LATENCY = 1e-6   #seconds. Bucket 0 holds anything this fast or faster.
+_BUCKETS = BUCKETS_PER_OCTAVE * 28 #up to ~268 s
+_SCALE = BUCKETS_PER_OCTAVE / math.log(2.0)
+
+
+class LatencyHistogram:
+    """Log-bucketed histogram of latencies in seconds."""
+
+    def __init__(self):
+        self._counts = [0] * _BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        if seconds <= _MIN_LATENCY:
+            bucket = 0
+        else:
+            bucket = min(int(math.log(seconds / _MIN_LATENCY) * _SCALE) + 1,
+                         _BUCKETS - 1)
+        self._counts[bucket] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, pct):
+        """Returns the pct (0-100) percentile in seconds, taken as the
+        middle of the bucket it falls in."""
+        if not self.count:
+            return 0.0
+        wanted = pct / 100.0 * self.count
+        seen = 0
+        for bucket, n in enumerate(self._counts):
+            seen += n
+            if seen >= wanted and n:
+                if bucket == 0:
+                    return _MIN_LATENCY
+                mid = math.exp((bucket - 0.5) / _SCALE) * _MIN_LATENCY
+                return min(mid, self.max)
+        return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+
+class LatencyRecorder:
+    """Histograms of per-stage latency keyed by (command, axis, stage)."""
+
+    def __init__(self):
+        self.enabled = True
+        self._hists = {}
+        self._lock = threading.Lock()
+
+    def reset(self):
+        with self._lock:
+            self._hists = {}
+
+    def _record(self, key, seconds):
+        hist = self._hists.get(key)
+        if hist is None:
+            hist = self._hists[key] = LatencyHistogram()
+        hist.record(seconds)
+
+    def letter_done(self, letter, through=STAGE_WRITTEN):
+        """Adds a letter's stage intervals to the histograms. Call with
+        STAGE_WRITTEN once it is on the wire, which records every interval
+        up to there and the total so far, and again with STAGE_RESPONSE if a
+        reply comes, which adds the response interval and the full total."""
+        stamps = letter.stamps()
+        if not stamps or through not in stamps:
+            return
+        name, axis = command_key(letter.content())
+        stages = sorted(stage for stage in stamps if stage <= through)
+        first = stamps[stages[0]]
+        if through == STAGE_RESPONSE:
+            stages = stages[-2:] #the rest was recorded at STAGE_WRITTEN
+        with self._lock:
+            for prev, stage in zip(stages, stages[1:]):
+                self._record((name, axis, STAGE_NAMES[stage]),
+                             stamps[stage] - stamps[prev])
+            self._record((name, axis, TOTAL + ":" + STAGE_NAMES[through]),
+                         stamps[through] - first)
+
+    def summary(self):
+        """Returns [(command, axis, stage, count, p50, p95, p99, max)],
+        latencies in seconds, sorted by command, axis and stage order."""
+        order = {name: i for i, name in enumerate(STAGE_NAMES)}
+        rows = []
+        with self._lock:
+            for (name, axis, stage), hist in self._hists.items():
+                rows.append((name, axis, stage, hist.count,
+                             hist.percentile(50), hist.percentile(95),
+                             hist.percentile(99), hist.max))
+        rows.sort(key=lambda r: (str(r[0]), str(r[1]),
+                                 order.get(r[2], len(order)), r[2]))
+        return rows
+
+    def format_summary(self):
+        """summary() as lines of text, times in ms."""
+        lines = [f"{'cmd':<10}{'ax':<3}{'stage':<16}{'n':>5}"
+                 f"{'p50':>8}{'p95':>8}{'p99':>8}"]
+        for name, axis, stage, count, p50, p95, p99, _ in self.summary():
+            lines.append(f"{str(name)[:9]:<10}{str(axis)[:2]:<3}{stage[:15]:<16}"
+                         f"{count:5d}{p50 * 1e3:8.1f}{p95 * 1e3:8.1f}"
+                         f"{p99 * 1e3:8.1f}")
+        return lines
+
+
+def command_key(content):
+    """(command name, axis) for a piece of letter content."""
+    if type(content) in (list, tuple) and len(content) >= 2:
+        return content[0], content[1]
+    return None, None
+
+
+#The one recorder the whole program uses.
+LATENCY = LatencyRecorder()
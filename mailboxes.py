@@ -0,0 +1,216 @@
+"""
+mailboxes.py
+
+Bounded mailboxes for the post office's asynchronous delivery mode.
+
+In async mode PostOffice.post() doesn't call the registrant's callback. It
+drops the letter in the registrant's Mailbox and returns, and the letter is
+delivered later by whoever drains that mailbox: a MailboxWorker thread, or
+for GUI registrants the Qt event loop (see qt_mailbox.py). A slow registrant
+then only holds up its own mail, and a callback that posts again doesn't
+recurse into the post office.
+
+What happens when a mailbox is full is up to its policy:
+
+    POLICY_BLOCK        post() waits for room. Nothing is ever lost. This is
+                        the one to use for commands. The thread that drains
+                        the mailbox never waits, as nobody else would make
+                        room; its letters go over size instead.
+    POLICY_DROP_OLDEST  the oldest waiting letter is thrown away.
+    POLICY_COALESCE     a new letter replaces a waiting one with the same
+                        key (by default same sender, command name and axis),
+                        so only the latest status of something is kept. If
+                        nothing matches the oldest is dropped.
+
+Each mailbox keeps stats: current and highest depth, letters delivered,
+dropped and coalesced, times a poster had to wait, and how long letters sat
+in the box (mean and max).
+"""
+import collections
+import itertools
+import threading
+import time
+
+POLICY_BLOCK       = 'block'
+POLICY_DROP_OLDEST = 'drop_oldest'
+POLICY_COALESCE    = 'coalesce'
+
+DEFAULT_MAILBOX_SIZE = 100
+
+
+def default_coalesce_key(letter):
+    """Letters from the same sender about the same command and axis."""
+    content = letter.content()
+    if type(content) in (list, tuple) and len(content) >= 2:
+        return (letter.source(), content[0], content[1])
+    return (letter.source(), None, None)
+
+
+class Mailbox:
+    """A bounded FIFO of letters for one registrant. put() is called by the
+    post office on the posting thread; drain() or run() deliver the letters
+    to callback on the draining thread. notify, if given, is called after
+    each put() so an event loop can be told there is mail."""
+
+    def __init__(self, callback, size=DEFAULT_MAILBOX_SIZE,
+                 policy=POLICY_BLOCK, coalesce_key=default_coalesce_key,
+                 notify=None):
+        assert policy in (POLICY_BLOCK, POLICY_DROP_OLDEST, POLICY_COALESCE), \
+               f"unknown mailbox policy {policy}"
+        self._callback = callback
+        self.size = max(int(size), 1)
+        self.policy = policy
+        self._coalesce_key = coalesce_key
+        self._notify = notify
+        #key -> (time put, letter). Keys are a running count unless
+        #coalescing, so an OrderedDict gives FIFO order and in-place replace.
+        self._letters = collections.OrderedDict()
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._drain_thread = None #thread that drains us, must never block in put()
+        #stats
+        self.max_depth = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.blocked = 0
+        self._taken = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def set_notify(self, notify):
+        self._notify = notify
+
+    def set_drain_thread(self, thread):
+        """Tells the mailbox which thread drains it, for an event loop that
+        posts to its own mailbox before it has drained it once."""
+        self._drain_thread = thread
+
+    def depth(self):
+        return len(self._letters)
+
+    def put(self, letter):
+        """Adds a letter, applying the policy if the mailbox is full. Returns
+        False if the mailbox is closed."""
+        now = time.perf_counter()
+        with self._cond:
+            if self._closed:
+                return False
+            key = None
+            if self.policy == POLICY_COALESCE:
+                key = self._coalesce_key(letter)
+                if key in self._letters:
+                    #keep the place in line and the original wait time
+                    self._letters[key] = (self._letters[key][0], letter)
+                    self.coalesced += 1
+                    return True
+            if len(self._letters) >= self.size:
+                if self.policy == POLICY_BLOCK and \
+                   threading.current_thread() is not self._drain_thread:
+                    self.blocked += 1
+                    self._cond.wait_for(lambda: len(self._letters) < self.size
+                                        or self._closed)
+                    if self._closed:
+                        return False
+                elif self.policy != POLICY_BLOCK:
+                    self._letters.popitem(last=False)
+                    self.dropped += 1
+                #else: the draining thread posting to its own full mailbox,
+                #from a callback or from elsewhere on the GUI thread. Let it
+                #go over size rather than deadlock.
+            if key is None:
+                key = next(self._seq)
+            self._letters[key] = (now, letter)
+            if len(self._letters) > self.max_depth:
+                self.max_depth = len(self._letters)
+            self._cond.notify_all()
+        if self._notify is not None:
+            self._notify()
+        return True
+
+    def _take(self):
+        """Removes the oldest letter. Caller holds the lock."""
+        _, (put_time, letter) = self._letters.popitem(last=False)
+        waited = time.perf_counter() - put_time
+        self._taken += 1
+        self._wait_total += waited
+        if waited > self._wait_max:
+            self._wait_max = waited
+        self._cond.notify_all()
+        return letter
+
+    def _deliver(self, letter):
+        try:
+            self._callback(letter)
+        except Exception as e:
+            #One bad letter shouldn't kill the thread draining this mailbox.
+            print(f"Mailbox: callback failed on letter from "
+                  f"{letter.source()}: {e!r}")
+        with self._cond:
+            self.delivered += 1
+
+    def drain(self, limit=None):
+        """Delivers the letters waiting now (at most limit of them) on the
+        calling thread. Returns the number delivered. For event loops.
+        Only this thread can make room, so from now on a put() from it never
+        waits, even between drains."""
+        self._drain_thread = threading.current_thread()
+        count = 0
+        while limit is None or count < limit:
+            with self._cond:
+                if not self._letters:
+                    break
+                letter = self._take()
+            self._deliver(letter)
+            count += 1
+        return count
+
+    def run(self):
+        """Delivers letters as they arrive until close() is called. For a
+        worker thread."""
+        self._drain_thread = threading.current_thread()
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._letters or self._closed)
+                if self._closed:
+                    return
+                letter = self._take()
+            self._deliver(letter)
+
+    def close(self):
+        """Stops run() and wakes any blocked posters. Undelivered letters are
+        left where they are."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            taken = self._taken
+            return {'depth': len(self._letters),
+                    'max_depth': self.max_depth,
+                    'delivered': self.delivered,
+                    'dropped': self.dropped,
+                    'coalesced': self.coalesced,
+                    'blocked': self.blocked,
+                    'mean_wait': self._wait_total / taken if taken else 0.0,
+                    'max_wait': self._wait_max}
+
+
+class MailboxWorker:
+    """Drains one mailbox on its own daemon thread."""
+
+    def __init__(self, mailbox, name):
+        self.mailbox = mailbox
+        self._thread = threading.Thread(target=mailbox.run,
+                                        name=f"mailbox {name}", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self, timeout=1.0):
+        self.mailbox.close()
+        if self._thread.is_alive() and \
+           self._thread is not threading.current_thread():
+            self._thread.join(timeout)
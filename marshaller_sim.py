@@ -0,0 +1,445 @@
+"""
+marshaller_sim.py
+
+A stand-in for the marshaller esp32 so DataLink can be exercised on a plain
+Linux box. MarshallerSim opens a pseudo-terminal and DataLink is pointed at
+the slave side (MarshallerSim.port) instead of /dev/serial0. The simulator
+reads the master side on its own thread, splits the byte stream back into
+messages and records when each one arrived so benchmarks can measure how
+long a letter took to get onto the wire.
+
+The real marshaller uart is slow to get back to ready after it takes in a
+message. That is modelled with ready_delay: each message ties up one of the
+simulator's receive slots for that long, and a message that arrives while
+every slot is busy is lost (counted in dropped). Old firmware has a single
+slot and says nothing about it. Give the simulator a window and it behaves
+like firmware that does flow control: announce() advertises the window and
+an ack goes back each time a slot frees up.
+
+Once a message has been taken in, its low-level commands are handed to the
+axis controllers. exec_time is how long one command takes, either one number
+for every axis or a dict of seconds per axis (axes not in it take no time).
+Each axis runs its commands one after another and different axes run at the
+same time, except that nothing starts until the last blocking command has
+finished. The commands of a barrier group (see command_batcher.py) all start
+together, once every one of their axes is free, and the group finishes with
+its slowest command. A message is done when the last of its commands is.
+Every finished command goes in completed.
+
+With replies=True the simulator answers each message when it is done. A
+message that came with a sequence id gets ["reply", seq, STATUS_OK, result];
+one without (older firmware, or json) gets [name, axis, result, False] back,
+in the order the messages were sent. result is a string of response_size
+characters, or None when response_size is 0.
+
+A stop command (wire_protocol.STOP) is acted on the moment it arrives rather
+than waiting for a receive slot. Messages waiting for a slot are thrown
+away, commands not yet finished are cut short (counted in stopped) and every
+axis is free at once. Sequenced messages thrown away or cut short are
+answered with STATUS_STOPPED. The slots freed, and the one the stop itself
+used, are acked. stops records when each stop arrived.
+
+With telemetry_rate the simulator also streams that many samples a second of
+the channels in wire_protocol.TELEMETRY_CHANNELS, whatever else it is doing.
+The load is a 1 Hz sine and the deflection follows it through
+SIM_COMPLIANCE, each with a little noise. Over json each sample is a
+["telemetry", t, deflection, load] message. Over the framed protocol they go
+telemetry_block at a time in a FRAME_SAMPLES frame. telemetry_sent counts
+samples. stop_telemetry() ends the stream.
+
+Line noise: drop_rate and garble_rate are the chance that any one byte, in
+either direction, is lost or has a bit flipped. seed makes a run repeatable.
+
+restart() is the reset pin. The simulator forgets what it was doing and
+ignores the uart for boot_delay, losing anything sent meanwhile (counted in
+lost_booting), then says ["ready", window] unless made with
+says_ready=False like older firmware.
+
+The simulator speaks either wire protocol (wire_protocol.PROTOCOL_JSON or
+PROTOCOL_FRAMED). It has to match the DataLink it is talking to.
+"""
+import collections
+import heapq
+import itertools
+import math
+import os
+import pty
+import random
+import selectors
+import struct
+import threading
+import time
+import tty
+
+import command_batcher
+import wire_protocol
+
+SIM_LOAD = 5.0 #lbf, amplitude of the simulated load
+SIM_COMPLIANCE = 0.004 #inches of deflection per lbf
+
+
+class MarshallerSim:
+    """pty-backed marshaller stand-in. Call start() before pointing a DataLink
+    at self.port and stop() when done."""
+
+    def __init__(self, ready_delay=0.0, window=None,
+                 protocol=wire_protocol.PROTOCOL_JSON, replies=False,
+                 exec_time=0.0, boot_delay=1.0, says_ready=True,
+                 response_size=0, drop_rate=0.0, garble_rate=0.0, seed=None,
+                 telemetry_rate=0, telemetry_block=50):
+        self._master_fd, self._slave_fd = pty.openpty()
+        tty.setraw(self._slave_fd)
+        self.port = os.ttyname(self._slave_fd)
+        self.ready_delay = ready_delay
+        self.window = window #None means old firmware, no flow control
+        self.codec = wire_protocol.codec(protocol)
+        self._decoder = self.codec.new_decoder(with_seq=True)
+        self.replies = replies
+        self.exec_time = exec_time #seconds, or {axis: seconds}
+        self.boot_delay = boot_delay
+        self.says_ready = says_ready
+        self.response_size = response_size
+        self.drop_rate = drop_rate
+        self.garble_rate = garble_rate
+        self.telemetry_rate = telemetry_rate
+        self.telemetry_block = telemetry_block
+        self.telemetry_sent = 0
+        self._streaming = False
+        self._random = random.Random(seed)
+        self.lost_booting = 0
+        self.bytes_dropped = 0
+        self.bytes_garbled = 0
+        self._booted_at = 0.0 #perf_counter() when the last restart is over
+        self._arrived = threading.Condition()
+        self.arrivals = [] #(perf_counter time, message) for each message seen
+        self.processed = [] #(perf_counter time, message) once slot frees up
+        self.completed = [] #(perf_counter time, command) as each one finishes
+        self.dropped = 0
+        self.stops = [] #perf_counter() time each stop arrived
+        self.stopped = 0 #low-level commands thrown away or cut short
+        self._busy = collections.deque() #(message, seq) holding a slot
+        self._axis_free = {} #axis: perf_counter() its current command ends
+        self._barrier = 0.0 #perf_counter() the last blocking command ends
+        self._running_jobs = [] #heap of (done time, n, reply, commands)
+        self._job_numbers = itertools.count()
+        self._write_lock = threading.Lock()
+        self._running = False
+        self._threads = []
+
+    def start(self):
+        self._running = True
+        for target, name in ((self._run, "MarshallerSim rx"),
+                             (self._process, "MarshallerSim proc"),
+                             (self._execute, "MarshallerSim exec")):
+            t = threading.Thread(target=target, name=name, daemon=True)
+            t.start()
+            self._threads.append(t)
+        if self.telemetry_rate:
+            self._streaming = True
+            t = threading.Thread(target=self._stream, name="MarshallerSim tm",
+                                 daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def stop(self):
+        self._running = False
+        with self._arrived:
+            self._arrived.notify_all()
+        for t in self._threads:
+            t.join()
+        self._threads = []
+        os.close(self._master_fd)
+        os.close(self._slave_fd)
+
+    def slots(self):
+        return self.window or 1
+
+    def announce(self):
+        """Advertises the receive window, as flow-control firmware does once
+        it is up. Does nothing for old firmware."""
+        if self.window is not None:
+            self.send_message([wire_protocol.CTRL_WINDOW, self.window])
+
+    def restart(self):
+        """Simulates a pulse on the reset pin."""
+        with self._arrived:
+            self._busy.clear()
+            self._running_jobs = []
+            self._axis_free = {}
+            self._barrier = 0.0
+            self._booted_at = time.perf_counter() + self.boot_delay
+        if self.says_ready:
+            timer = threading.Timer(self.boot_delay, self._send_quietly,
+                                    ([wire_protocol.CTRL_READY,
+                                      self.window or 0],))
+            timer.daemon = True
+            timer.start()
+
+    def send_message(self, msg):
+        self.send(self.codec.encode(msg))
+
+    def commands_processed(self):
+        """Low-level commands processed, counting each one in a batch."""
+        with self._arrived:
+            return sum(command_batcher.command_count(msg)
+                       for _, msg in self.processed)
+
+    def wait_processed(self, count, timeout=None):
+        with self._arrived:
+            return self._arrived.wait_for(
+                lambda: len(self.processed) + self.dropped >= count, timeout)
+
+    def wait_completed(self, count, timeout=None):
+        """Blocks until count low-level commands have finished."""
+        with self._arrived:
+            return self._arrived.wait_for(lambda: len(self.completed) >= count,
+                                          timeout)
+
+    def message_count(self):
+        with self._arrived:
+            return len(self.arrivals)
+
+    def wait_for(self, count, timeout=None):
+        """Blocks until at least count messages have arrived. Returns False if
+        the timeout ran out first."""
+        with self._arrived:
+            return self._arrived.wait_for(lambda: len(self.arrivals) >= count,
+                                          timeout)
+
+    def stats(self):
+        with self._arrived:
+            return {'arrived': len(self.arrivals),
+                    'completed': len(self.completed),
+                    'dropped': self.dropped,
+                    'stopped': self.stopped,
+                    'bad_frames': getattr(self._decoder, 'bad_frames', 0),
+                    'bytes_dropped': self.bytes_dropped,
+                    'bytes_garbled': self.bytes_garbled}
+
+    def send(self, data):
+        """Writes raw bytes from the "marshaller" to the commander."""
+        data = self._noisy(data)
+        with self._write_lock:
+            os.write(self._master_fd, data)
+
+    def _noisy(self, data):
+        """data after the line noise has had its way with it."""
+        if not self.drop_rate and not self.garble_rate:
+            return data
+        out = bytearray()
+        rand = self._random.random
+        for b in data:
+            r = rand()
+            if r < self.drop_rate:
+                self.bytes_dropped += 1
+                continue
+            if r < self.drop_rate + self.garble_rate:
+                b ^= 1 << self._random.randrange(8)
+                self.bytes_garbled += 1
+            out.append(b)
+        return bytes(out)
+
+    def _send_quietly(self, msg):
+        if self._running:
+            try:
+                self.send_message(msg)
+            except OSError:
+                pass #stopped while the message was pending
+
+    def stop_telemetry(self):
+        self._streaming = False
+
+    def _stream(self):
+        """Sends telemetry samples telemetry_rate times a second."""
+        dt = 1.0 / self.telemetry_rate
+        framed = self.codec.name == wire_protocol.PROTOCOL_FRAMED
+        per_send = 1
+        if framed:
+            most = (wire_protocol.MAX_BODY - 16) // (2 * wire_protocol.SAMPLE_SIZE)
+            per_send = min(max(int(self.telemetry_block), 1), most)
+        start = time.perf_counter()
+        sample = 0
+        while self._running and self._streaming:
+            due = start + (sample + per_send - 1) * dt
+            now = time.perf_counter()
+            if now < due:
+                time.sleep(due - now)
+                continue
+            values = []
+            for i in range(sample, sample + per_send):
+                load = math.sin(2.0 * math.pi * i * dt) * SIM_LOAD + \
+                       self._random.gauss(0.0, 0.02)
+                values += [load * SIM_COMPLIANCE +
+                           self._random.gauss(0.0, 1e-4), load]
+            if framed:
+                self._send_quietly([wire_protocol.SAMPLES, sample * dt, dt, 2,
+                                    struct.pack(f'<{len(values)}f', *values)])
+            else:
+                self._send_quietly([wire_protocol.TELEMETRY,
+                                    round(sample * dt, 6),
+                                    round(values[0], 6), round(values[1], 4)])
+            sample += per_send
+            self.telemetry_sent += per_send
+
+    def _run(self):
+        selector = selectors.DefaultSelector()
+        selector.register(self._master_fd, selectors.EVENT_READ)
+        while self._running:
+            if not selector.select(timeout=0.05):
+                continue
+            try:
+                data = os.read(self._master_fd, 4096)
+            except OSError:
+                break #slave side went away
+            now = time.perf_counter()
+            messages = self._decoder.feed(self._noisy(data))
+            answers = []
+            if messages:
+                with self._arrived:
+                    for seq, msg in messages:
+                        if now < self._booted_at:
+                            self.lost_booting += 1 #still booting
+                            continue
+                        self.arrivals.append((now, msg))
+                        if type(msg) is list and msg and \
+                           msg[0] == wire_protocol.STOP:
+                            answers += self._halt(now, seq)
+                        elif len(self._busy) >= self.slots():
+                            self.dropped += 1 #uart wasn't ready for it
+                        else:
+                            self._busy.append((msg, seq))
+                    self._arrived.notify_all()
+            for answer in answers:
+                self._send_quietly(answer)
+        selector.close()
+
+    def _halt(self, now, seq):
+        """Acts on a stop. Call holding _arrived. Returns the messages to
+        send back."""
+        self.stops.append(now)
+        answers = []
+        stopped = wire_protocol.STATUS_STOPPED
+        freed = len(self._busy)
+        for msg, busy_seq in self._busy:
+            self.stopped += command_batcher.command_count(msg)
+            if self.replies and busy_seq is not None:
+                answers.append([wire_protocol.REPLY, busy_seq, stopped, None])
+        self._busy.clear()
+        for _, _, reply, cmds in self._running_jobs:
+            self.stopped += len(cmds)
+            if reply is not None and reply[0] == wire_protocol.REPLY:
+                answers.append([wire_protocol.REPLY, reply[1], stopped, None])
+        self._running_jobs = []
+        self._axis_free = {}
+        self._barrier = now
+        if self.replies and seq is not None:
+            answers.append([wire_protocol.REPLY, seq, wire_protocol.STATUS_OK,
+                            None])
+        if self.window is not None:
+            answers.append([wire_protocol.CTRL_ACK, freed + 1])
+        return answers
+
+    def _process(self):
+        """Frees receive slots one at a time, ready_delay after each, and
+        hands the message to the axes."""
+        while True:
+            with self._arrived:
+                self._arrived.wait_for(lambda: self._busy or not self._running)
+                if not self._running:
+                    return
+            time.sleep(self.ready_delay)
+            with self._arrived:
+                if not self._busy:
+                    continue #restart() threw it away
+                msg, seq = self._busy.popleft()
+                now = time.perf_counter()
+                self.processed.append((now, msg))
+                self._schedule(now, msg, seq)
+                self._arrived.notify_all()
+            if self.window is not None:
+                try:
+                    self.send_message([wire_protocol.CTRL_ACK, 1])
+                except OSError:
+                    return #stopped underneath us
+
+    def _exec_time(self, axis):
+        if type(self.exec_time) is dict:
+            return self.exec_time.get(axis, 0.0)
+        return self.exec_time
+
+    def _schedule(self, now, msg, seq):
+        """Works out when msg's commands finish on their axes. Call holding
+        _arrived."""
+        if command_batcher.is_group(msg):
+            cmds = msg[2]
+            done = self._start_together(now, cmds, bool(msg[3]))
+        else:
+            cmds = msg[2] if command_batcher.is_batch(msg) else [msg]
+            done = now
+            for cmd in cmds:
+                block = command_batcher.is_blocking(cmd)
+                done = max(done, self._start_together(now, [cmd], block))
+        reply = None
+        if self.replies:
+            result = "r" * self.response_size if self.response_size else None
+            if seq is not None:
+                reply = [wire_protocol.REPLY, seq, wire_protocol.STATUS_OK,
+                         result]
+            elif type(msg) is list and len(msg) > 1:
+                reply = [msg[0], msg[1], result, False]
+        heapq.heappush(self._running_jobs,
+                       (done, next(self._job_numbers), reply, cmds))
+
+    def _start_together(self, now, cmds, block):
+        """Starts cmds at the same moment, as soon as all their axes are free
+        and any blocking command before them is done. Returns when the last
+        of them finishes."""
+        axes = [cmd[1] if type(cmd) is list and len(cmd) > 1 else None
+                for cmd in cmds]
+        start = max([now, self._barrier] +
+                    [self._axis_free.get(axis, now) for axis in axes])
+        done = start
+        for axis in axes:
+            finish = start + self._exec_time(axis)
+            self._axis_free[axis] = finish
+            done = max(done, finish)
+        if block:
+            self._barrier = done
+        return done
+
+    def _execute(self):
+        """Finishes commands as their time comes and sends the replies."""
+        while True:
+            with self._arrived:
+                while self._running:
+                    if self._running_jobs:
+                        wait = self._running_jobs[0][0] - time.perf_counter()
+                        if wait <= 0:
+                            break
+                        self._arrived.wait(wait)
+                    else:
+                        self._arrived.wait()
+                if not self._running:
+                    return
+                done, _, reply, cmds = heapq.heappop(self._running_jobs)
+                for cmd in cmds:
+                    self.completed.append((done, cmd))
+                self._arrived.notify_all()
+            if reply is not None:
+                self._send_quietly(reply)
+
+
+if __name__ == "__main__":
+    sim = MarshallerSim()
+    sim.start()
+    print(f"marshaller stand-in listening on {sim.port}. Ctrl-C to quit.")
+    shown = 0
+    try:
+        while True:
+            time.sleep(1.0)
+            for t, msg in sim.arrivals[shown:]:
+                print(f"{t:.3f}: {msg}")
+                shown += 1
+    except KeyboardInterrupt:
+        pass
+    sim.stop()
@@ -0,0 +1,315 @@
+"""
+measurement_store.py
+
+Keeps the compliance values measured in a session on disk, so the graphing
+module and later analyses can open the history of a top without parsing
+text.
+
+A session is a folder under the store's root, named for when it was
+started. It has one file per column, each value a fixed-width little endian
+float64:
+
+    x, y         inches, where the probe was
+    load         lbf
+    deflection   inches
+    compliance   deflection / load, inches per lbf (nan for no load)
+    timestamp    time.time() the measurement was taken
+
+plus meta.json (the columns and the grid spacing) and "rows", the number
+of rows committed, as 8 bytes. Only whole rows that have been committed
+count.
+
+Appends are crash safe. The values go on the end of each column file and
+are fsynced, and only then is the new row count written to a temporary
+file and renamed over rows. A crash part way through leaves rows as it
+was, and whatever was written past it is cut off the next time the session
+is opened for appending. Each append costs a few fsyncs, which is nothing
+at the rate points are measured, and append_rows() commits many at once.
+
+Reading maps the column files into memory. column() gives a NumPy array
+over the map when NumPy is installed, otherwise a memoryview of doubles,
+and nothing is read until it is used. Opening a session only reads
+meta.json and rows, so opening every session of a top is quick whatever
+their size.
+
+The grid index groups rows by the grid cell they were measured in, the
+cell being (x, y) rounded to the session's grid spacing. It is built from
+the x and y columns the first time it is asked for and kept up to date by
+appends. rows_at() gives the rows measured at a point. history() does the
+same across sessions.
+"""
+import json
+import math
+import mmap
+import os
+import struct
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+COLUMNS = ('x', 'y', 'load', 'deflection', 'compliance', 'timestamp')
+DEFAULT_ROOT = "measurements"
+DEFAULT_GRID = 0.25 #inches between grid points
+_VALUE = struct.Struct('<d')
+_ROWS = struct.Struct('<Q')
+_META = "meta.json"
+_ROWS_FILE = "rows"
+
+
+def compliance_of(load, deflection):
+    """Inches of deflection per lbf of load, nan when there's no load."""
+    if not load:
+        return math.nan
+    return deflection / load
+
+
+def _fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class MeasurementSession:
+
+    def __init__(self, path, grid=DEFAULT_GRID, readonly=False):
+        """Opens the session in folder path, making a new one there (with
+        grid spacing grid) unless readonly or it already exists."""
+        self.path = path
+        self.readonly = readonly
+        meta_path = os.path.join(path, _META)
+        if not os.path.exists(meta_path):
+            if readonly:
+                raise FileNotFoundError(f"no measurement session in {path}")
+            self._create(grid)
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if tuple(meta['columns']) != COLUMNS:
+            raise ValueError(f"{path}: unknown columns {meta['columns']}")
+        self.grid = meta['grid']
+        self.count = self._committed()
+        self._maps = {} #column: (rows mapped, mmap)
+        self._files = None #column: file, for appending
+        self._index = None #grid cell: [row, ...]
+        if not readonly:
+            self._open_for_append()
+
+    def _create(self, grid):
+        """meta.json goes last, it is what makes the folder a session. A
+        crash before it leaves a folder that is made afresh next time."""
+        os.makedirs(self.path, exist_ok=True)
+        for name in COLUMNS:
+            open(self._column_path(name), 'wb').close()
+        self._commit(0)
+        self._write_meta({'columns': list(COLUMNS), 'grid': grid,
+                          'created': time.time()})
+        _fsync_dir(self.path)
+
+    def _column_path(self, name):
+        return os.path.join(self.path, name)
+
+    def _write_meta(self, meta):
+        tmp = os.path.join(self.path, _META + ".tmp")
+        with open(tmp, 'w') as f:
+            json.dump(meta, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, os.path.join(self.path, _META))
+
+    def _committed(self):
+        with open(os.path.join(self.path, _ROWS_FILE), 'rb') as f:
+            return _ROWS.unpack(f.read(_ROWS.size))[0]
+
+    def _commit(self, count):
+        tmp = os.path.join(self.path, _ROWS_FILE + ".tmp")
+        with open(tmp, 'wb') as f:
+            f.write(_ROWS.pack(count))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, os.path.join(self.path, _ROWS_FILE))
+        _fsync_dir(self.path)
+
+    def _open_for_append(self):
+        """Cuts off anything written past the last commit."""
+        self._files = {}
+        size = self.count * _VALUE.size
+        for name in COLUMNS:
+            f = open(self._column_path(name), 'r+b')
+            if os.fstat(f.fileno()).st_size != size:
+                f.truncate(size)
+            f.seek(size)
+            self._files[name] = f
+
+    def __len__(self):
+        return self.count
+
+    def append(self, x, y, load, deflection, timestamp=None):
+        """Adds one measurement and commits it. Returns its row number."""
+        return self.append_rows([(x, y, load, deflection, timestamp)])
+
+    def append_rows(self, rows):
+        """Adds (x, y, load, deflection[, timestamp]) rows and commits them
+        together. Returns the row number of the first."""
+        if self.readonly:
+            raise PermissionError(f"{self.path} was opened read only")
+        first = self.count
+        now = time.time()
+        columns = {name: bytearray() for name in COLUMNS}
+        for row in rows:
+            x, y, load, deflection = row[:4]
+            timestamp = row[4] if len(row) > 4 and row[4] is not None else now
+            values = (x, y, load, deflection, compliance_of(load, deflection),
+                      timestamp)
+            for name, value in zip(COLUMNS, values):
+                columns[name] += _VALUE.pack(value)
+        added = len(columns['x']) // _VALUE.size
+        if not added:
+            return first
+        for name in COLUMNS:
+            f = self._files[name]
+            f.write(columns[name])
+            f.flush()
+            os.fsync(f.fileno())
+        self._commit(first + added)
+        self.count = first + added
+        if self._index is not None:
+            self._index_rows(first, self.count)
+        return first
+
+    def column(self, name):
+        """The committed values of a column, over a memory map of its file:
+        a NumPy float64 array, or a memoryview of doubles without NumPy."""
+        if name not in COLUMNS:
+            raise KeyError(name)
+        rows, mapped = self._maps.get(name, (0, None))
+        if rows != self.count or mapped is None:
+            #an old map stays open while anyone still has an array over it
+            mapped = None
+            if self.count:
+                with open(self._column_path(name), 'rb') as f:
+                    mapped = mmap.mmap(f.fileno(), self.count * _VALUE.size,
+                                       access=mmap.ACCESS_READ)
+            self._maps[name] = (self.count, mapped)
+        if mapped is None:
+            return np.zeros(0) if np is not None else memoryview(b'').cast('d')
+        if np is not None:
+            return np.frombuffer(mapped, dtype='<f8')
+        return memoryview(mapped).cast('d')
+
+    def row(self, i):
+        """Row i as a dict of column: value."""
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        return {name: float(self.column(name)[i]) for name in COLUMNS}
+
+    def cell(self, x, y):
+        """The grid cell (x, y) falls in."""
+        return (math.floor(float(x) / self.grid + 0.5),
+                math.floor(float(y) / self.grid + 0.5))
+
+    def _cells(self, start, end):
+        """Grid cell columns (cx, cy) of rows start to end, NumPy only."""
+        xs, ys = self.column('x')[start:end], self.column('y')[start:end]
+        return (np.floor(xs / self.grid + 0.5).astype(np.int64),
+                np.floor(ys / self.grid + 0.5).astype(np.int64))
+
+    def _index_rows(self, start, end):
+        index = self._index
+        if np is None:
+            xs, ys = self.column('x'), self.column('y')
+            for i in range(start, end):
+                index.setdefault(self.cell(xs[i], ys[i]), []).append(i)
+            return
+        if end <= start:
+            return
+        cx, cy = self._cells(start, end)
+        order = np.lexsort((cy, cx)) #by cell, rows in order within one
+        cx, cy = cx[order], cy[order]
+        breaks = np.flatnonzero((cx[1:] != cx[:-1]) | (cy[1:] != cy[:-1])) + 1
+        rows = (order + start).tolist()
+        bounds = [0] + breaks.tolist() + [len(rows)]
+        for lo, hi in zip(bounds, bounds[1:]):
+            index.setdefault((int(cx[lo]), int(cy[lo])), []).extend(rows[lo:hi])
+
+    def grid_index(self):
+        """{grid cell: [row, ...]} for every row, oldest row first."""
+        if self._index is None:
+            self._index = {}
+            self._index_rows(0, self.count)
+        return self._index
+
+    def rows_at(self, x, y):
+        """Rows measured in the grid cell of (x, y)."""
+        if self._index is None and np is not None:
+            #one point doesn't need the whole index built
+            cx, cy = self._cells(0, self.count)
+            c0, c1 = self.cell(x, y)
+            return np.flatnonzero((cx == c0) & (cy == c1)).tolist()
+        return self.grid_index().get(self.cell(x, y), [])
+
+    def refresh(self):
+        """Picks up rows committed since the session was opened, for a read
+        only session that another program is appending to."""
+        count = self._committed()
+        if count != self.count:
+            self.count = count
+            if self._index is not None:
+                self._index = None #rebuilt when next asked for
+
+    def close(self):
+        for _, mapped in self._maps.values():
+            if mapped is not None:
+                try:
+                    mapped.close()
+                except BufferError:
+                    pass #someone still has a column, it closes with them
+        self._maps = {}
+        if self._files is not None:
+            for f in self._files.values():
+                f.close()
+            self._files = None
+
+
+def new_session(root=DEFAULT_ROOT, grid=DEFAULT_GRID):
+    """Starts a session in a new folder under root named for the time."""
+    name = time.strftime("%Y%m%d-%H%M%S")
+    path = os.path.join(root, name)
+    suffix = 1
+    while os.path.exists(path):
+        suffix += 1
+        path = os.path.join(root, f"{name}-{suffix}")
+    return MeasurementSession(path, grid)
+
+
+def session_paths(root=DEFAULT_ROOT):
+    """Folders under root holding a session, oldest first."""
+    if not os.path.isdir(root):
+        return []
+    return [os.path.join(root, name) for name in sorted(os.listdir(root))
+            if os.path.exists(os.path.join(root, name, _META))]
+
+
+def open_sessions(root=DEFAULT_ROOT):
+    """Every session under root, read only, oldest first."""
+    return [MeasurementSession(path, readonly=True)
+            for path in session_paths(root)]
+
+
+def history(sessions, x, y):
+    """Every measurement made in the grid cell of (x, y) across sessions,
+    oldest first, as (session, row)."""
+    return [(session, i) for session in sessions
+            for i in session.rows_at(x, y)]
+
+
+if __name__ == "__main__":
+    import sys
+    root = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_ROOT
+    for session in open_sessions(root):
+        print(f"{session.path}: {len(session)} measurements in "
+              f"{len(session.grid_index())} grid cells")
+        session.close()
@@ -18,24 +18,180 @@ which for now is a json string made from the actual content.
 
 class Letter
 The Letter class is used to send information through the post office to other
-entities.
+entities. Letters are small slotted objects. Their addresses are interned and
+each address gets a small code, so pack_into() can write a letter into a
+preallocated buffer (2 byte codes plus the compact content encoding from
+wire_protocol.py) and unpack_from() can read one back from a memoryview
+without going through lists or json strings.
+
+Delivery is synchronous by default: post() calls the destination's callback
+on the posting thread. A PostOffice made with async_delivery=True instead
+gives each registrant a bounded mailbox (see mailboxes.py) drained by a
+worker thread, so post() returns as soon as the letter is in the box. A
+registrant can also bring its own mailbox to register(), e.g. one drained by
+the Qt event loop for GUI objects.
+
+Besides registrants, any number of subscribers can listen on an address with
+subscribe(). The address can be a topic, e.g. "backend.response", and the
+pattern subscribed to may use shell-style wildcards ("backend.*", "*"), so a
+letter posted once reaches every subscriber whose pattern matches its
+destination. The subscribers for a destination are worked out the first
+time something is posted to it and kept in a route table, so a post is a
+single lookup however many subscribers there are. Any register, subscribe or
+unsubscribe clears the table.
 """
+import fnmatch
+import itertools
+import re
+import struct
+import sys
+import threading
+import time
+
+import mailboxes
+import wire_protocol
+from trace_ring import TRACE, STAGE_POST
+import latency_stats
+from latency_stats import LATENCY
+
 print("importing post_office.py")
 
+#Address book. Every address used in a letter is interned and given a small
+#code the first time it is seen. Code 0 is no address. Codes are only good
+#within one run of the program.
+_address_codes = {None: 0}
+_addresses = [None]
+_address_lock = threading.Lock()
+_ADDRESS_CODES = struct.Struct('<HH') #destination, source
+_letter_ids = itertools.count(1) #every letter gets a number, for tracing
+
+
+def intern_address(address):
+    """Returns the one shared copy of address, adding it to the address book
+    if it is new."""
+    code = _address_codes.get(address)
+    if code is None:
+        with _address_lock:
+            code = _address_codes.get(address)
+            if code is None:
+                if type(address) is str:
+                    address = sys.intern(address)
+                code = len(_addresses)
+                assert code <= 0xFFFF, "address book is full"
+                _addresses.append(address)
+                _address_codes[address] = code
+    return _addresses[code]
+
+
+def address_code(address):
+    """Returns the code for an address, adding it if needed."""
+    code = _address_codes.get(address)
+    if code is None:
+        intern_address(address)
+        code = _address_codes[address]
+    return code
+
+
+def address_from_code(code):
+    if code >= len(_addresses):
+        raise ValueError(f"unknown address code {code}")
+    return _addresses[code]
+
+
 def letter_from_list( letter_as_list):
     """Can be used to get a letter object from a list in the form
     ['desintation id', 'source id', 'content']. Returns a letter object that
     contains the list values"""
     return Letter(letter_as_list[0], letter_as_list[1], letter_as_list[2])
 
+class _LetterExtras:
+    """The parts of a letter most letters never use, made the first time
+    one of them is set."""
+
+    __slots__ = ('id', 'stamps', 'wire', 'priority', 'admission')
+
+    def __init__(self):
+        self.id = None
+        self.stamps = None
+        self.wire = None
+        self.priority = None
+        self.admission = None
+
+
 class Letter:
     """ used to send information from one entity to another. It consists of
     a return address, recipient address, and information"""
+
+    #every command carries a future, the rest is in _extra when it's used
+    __slots__ = ('_to', '_from', '_content', '_future', '_extra')
     
     def __init__( self, destination_id=None, source_id=None, info=None):
-        self._to = destination_id
-        self._from = source_id
+        self._to = intern_address(destination_id)
+        self._from = intern_address(source_id)
         self._content = info
+        self._future = None
+        self._extra = None
+
+    def _extras(self):
+        if self._extra is None:
+            self._extra = _LetterExtras()
+        return self._extra
+        
+    def letter_id(self):
+        """The letter's number, for tracing. Given out the first time it is
+        asked for."""
+        extra = self._extras()
+        if extra.id is None:
+            extra.id = next(_letter_ids)
+        return extra.id
+
+    def stamp(self, stage, t=None):
+        """Notes the time (perf_counter, default now) the letter reached a
+        stage. See latency_stats.py for the stages."""
+        extra = self._extras()
+        if extra.stamps is None:
+            extra.stamps = {}
+        extra.stamps[stage] = time.perf_counter() if t is None else t
+
+    def stamps(self):
+        """{stage: time} for the stages the letter has been stamped at."""
+        return self._extra.stamps if self._extra is not None else None
+
+    def set_future(self, future):
+        """Attaches a concurrent.futures.Future for whoever delivers the
+        letter to complete, e.g. DataLink once the marshaller replies."""
+        self._future = future
+
+    def future(self):
+        return self._future
+
+    def set_wire(self, protocol, data):
+        """Attaches the content already encoded for protocol, so the
+        DataLink can write it without encoding it again."""
+        self._extras().wire = (protocol, data)
+
+    def wire(self, protocol):
+        """The encoded content if it was encoded for protocol, else None."""
+        wire = self._extra.wire if self._extra is not None else None
+        if wire is not None and wire[0] == protocol:
+            return wire[1]
+        return None
+
+    def set_priority(self, priority):
+        """How urgently the DataLink should send the letter, see
+        send_queue.py. Without one it goes by the content."""
+        self._extras().priority = priority
+
+    def priority(self):
+        return self._extra.priority if self._extra is not None else None
+
+    def set_admission(self, admission):
+        """A send_queue.Admission shared with the other letters of the same
+        user command, so the DataLink queues all of them or none."""
+        self._extras().admission = admission
+
+    def admission(self):
+        return self._extra.admission if self._extra is not None else None
         
     def source(self):
         return self._from
@@ -56,10 +212,61 @@ class Letter:
         contains the list values. There must be a better way, but one can
         create an empty letter to use to call this: l=Letter(); l.letter_..."""
         return Letter(letter_as_list[0], letter_as_list[1], letter_as_list[2])
+
+
+    def pack_into(self, buffer, offset=0):
+        """Writes the letter into a writable buffer (bytearray, memoryview...)
+        at offset. Returns the offset just past it."""
+        _ADDRESS_CODES.pack_into(buffer, offset, address_code(self._to),
+                                 address_code(self._from))
+        return wire_protocol.pack_content_into(buffer,
+                                               offset + _ADDRESS_CODES.size,
+                                               self._content)
+
+
+    @staticmethod
+    def unpack_from(buffer, offset=0):
+        """Reads a letter written by pack_into(). Returns (letter, offset
+        just past it)."""
+        to_code, from_code = _ADDRESS_CODES.unpack_from(buffer, offset)
+        content, end = wire_protocol.unpack_content_from(
+            buffer, offset + _ADDRESS_CODES.size)
+        letter = Letter.__new__(Letter)
+        letter._to = address_from_code(to_code)
+        letter._from = address_from_code(from_code)
+        letter._content = content
+        letter._future = None
+        letter._extra = None
+        return letter, end
     
- #   def unpack(self, packed_letter):
-  #      return Letter(packed_letter[0],packed_letter[1], packed_letter[2])
-    
+
+class Subscription:
+    """One listener on the post office: the pattern it listens on and how
+    letters get to it. Returned by subscribe() for use with unsubscribe()."""
+
+    __slots__ = ('pattern', 'callback', 'mailbox', '_match')
+
+    def __init__(self, pattern, callback, mailbox=None):
+        self.pattern = pattern
+        self.callback = callback
+        self.mailbox = mailbox
+        if any(c in pattern for c in '*?['):
+            self._match = re.compile(fnmatch.translate(pattern)).match
+        else:
+            self._match = None
+
+    def matches(self, destination):
+        if self._match is None:
+            return destination == self.pattern
+        return destination is not None and \
+               self._match(destination) is not None
+
+    def deliverer(self):
+        """The one call that gets a letter to this subscriber."""
+        if self.mailbox is not None:
+            return self.mailbox.put
+        return self.callback
+
 
 class PostOffice:
     """Contains the class PostOffice that is used to send "letters" to objects
@@ -68,29 +275,142 @@ class PostOffice:
     """
    
    
-    def __init__(self, msg):
-        """initialization. There are no passed-in parms"""
-        self._registrants = {}
+    def __init__(self, msg, async_delivery=False,
+                 mailbox_size=mailboxes.DEFAULT_MAILBOX_SIZE,
+                 mailbox_policy=mailboxes.POLICY_BLOCK):
+        """msg identifies the post office in debug output. With
+        async_delivery True, registrants get a mailbox of mailbox_size
+        letters with the given full-mailbox policy, each drained by its own
+        worker thread."""
+        self._registrants = {}   #id -> Subscription
+        self._subscriptions = [] #Subscriptions made with subscribe()
+        self._routes = {}        #destination -> tuple of deliverers
+        self._route_lock = threading.Lock()
+        self._workers = {}       #Subscription -> MailboxWorker
         self.id_msg = msg
+        self.async_delivery = async_delivery
+        self._mailbox_size = mailbox_size
+        self._mailbox_policy = mailbox_policy
 
 
-    def register( self, id=None, callback=None):
+    def register( self, id=None, callback=None, mailbox=None, direct=False):
         """Register with the po so you can send and receive mail. Id is a string
         that identifies the registree. It will be altered if not unique within
         the dictionary key that stores registrant info. callback is a function
-        responsible for receiving messages sent to the registrant."""
-        self._registrants[id] = callback
+        responsible for receiving messages sent to the registrant.
+        mailbox, if given, is a mailboxes.Mailbox that letters for this
+        registrant are put in instead; whoever supplies it drains it. In
+        async mode a registrant without one gets a worker-drained mailbox,
+        unless direct is True. That is for a callback that only queues the
+        letter somewhere thread safe, e.g. DataLink, where a mailbox would
+        just be a second queue in front of it."""
+        with self._route_lock:
+            old = self._registrants.get(id)
+            if old is not None:
+                self._stop_worker(old)
+            sub = self._new_subscription(id, callback, mailbox, direct)
+            self._registrants[id] = sub
+            self._routes = {}
+
+
+    def subscribe( self, pattern, callback, mailbox=None):
+        """Listen for letters posted to any destination matching pattern,
+        which is an address, a topic or a wildcard pattern. Any number of
+        subscribers may share a pattern. callback and mailbox are as for
+        register(). Returns the Subscription."""
+        with self._route_lock:
+            sub = self._new_subscription(pattern, callback, mailbox)
+            self._subscriptions.append(sub)
+            self._routes = {}
+        return sub
+
+
+    def unsubscribe( self, subscription):
+        with self._route_lock:
+            if subscription in self._subscriptions:
+                self._subscriptions.remove(subscription)
+                self._stop_worker(subscription)
+                self._routes = {}
+
+
+    def _new_subscription(self, pattern, callback, mailbox, direct=False):
+        sub = Subscription(pattern, callback, mailbox)
+        if mailbox is None and self.async_delivery and not direct:
+            sub.mailbox = mailboxes.Mailbox(callback, self._mailbox_size,
+                                            self._mailbox_policy)
+            worker = mailboxes.MailboxWorker(sub.mailbox, pattern)
+            self._workers[sub] = worker
+            worker.start()
+        return sub
+
+
+    def _stop_worker(self, sub):
+        worker = self._workers.pop(sub, None)
+        if worker is not None:
+            worker.stop()
+
+
+    def _route(self, destination):
+        """Works out and caches who gets letters sent to destination: the
+        registrant with that id, then matching subscribers in the order they
+        subscribed."""
+        with self._route_lock:
+            targets = []
+            registrant = self._registrants.get(destination)
+            if registrant is not None:
+                targets.append(registrant.deliverer())
+            for sub in self._subscriptions:
+                if sub.matches(destination):
+                    targets.append(sub.deliverer())
+            targets = tuple(targets)
+            self._routes[destination] = targets
+        return targets
 
     
     def post( self, letter=None):
         """send a letter through the post office."""
         if letter != None:
-            cb = self._registrants[letter.destination()]
-            print(f"PO is sending a a letter to {letter.destination()}")
-            cb(letter)
+            if TRACE.enabled:
+                TRACE.record(STAGE_POST, letter.letter_id())
+            if LATENCY.enabled:
+                letter.stamp(latency_stats.STAGE_POST)
+            targets = self._routes.get(letter.destination())
+            if targets is None:
+                targets = self._route(letter.destination())
+            if not targets:
+                print(f"PO has no route to {letter.destination()}")
+            for deliver in targets:
+                deliver(letter)
         else:
             print("Letter not supplied! it is None")
 
+
+    def mailbox_stats(self):
+        """Returns {registrant id or subscription pattern: stats dict} for
+        every mailbox. See mailboxes.Mailbox.stats(). Subscribers sharing a
+        pattern get #2, #3... added."""
+        stats = {}
+        subs = list(self._registrants.values()) + self._subscriptions
+        for sub in subs:
+            if sub.mailbox is None:
+                continue
+            name = sub.pattern
+            n = 2
+            while name in stats:
+                name = f"{sub.pattern}#{n}"
+                n += 1
+            stats[name] = sub.mailbox.stats()
+        return stats
+
+
+    def shutdown(self):
+        """Stops the mailbox worker threads. Letters still in mailboxes are
+        not delivered."""
+        with self._route_lock:
+            for worker in self._workers.values():
+                worker.stop()
+            self._workers = {}
+
 if __name__ == "__main__":
     
     class LetterWriter1:
@@ -126,6 +446,23 @@ if __name__ == "__main__":
 
     po.register(lw1.my_id(), lw1.callback1)
     po.register(lw2.my_id(), lw2.callback2)
+    po.post(Letter(lw2.my_id(), lw1.my_id(), "hello from LW1"))
+
+    #same again, delivered by mailbox worker threads
+    import time
+    apo = PostOffice('async module test', async_delivery=True)
+    apo.register(lw1.my_id(), lw1.callback1)
+    apo.register(lw2.my_id(), lw2.callback2)
+    apo.post(Letter(lw1.my_id(), lw2.my_id(), "hello from LW2"))
+    time.sleep(0.1)
+    print(apo.mailbox_stats())
+    apo.shutdown()
+
+    #one post, every matching subscriber gets it
+    po.subscribe("status.*", lw1.callback1)
+    po.subscribe("status.x", lw2.callback2)
+    po.post(Letter("status.x", "module test", "x is done"))
+    po.post(Letter("status.y", "module test", "y is done"))
 
 
         
\ No newline at end of file
@@ -0,0 +1,40 @@
+"""
+qt_mailbox.py
+
+Lets the Qt event loop drain a post office mailbox, so letters for GUI
+objects are delivered on the GUI thread no matter which thread posted them.
+Kept apart from mailboxes.py so the post office doesn't need PyQt5.
+"""
+import threading
+
+from PyQt5.QtCore import QObject, Qt, pyqtSignal
+
+
+class QtMailboxPump(QObject):
+    """Drains a mailboxes.Mailbox from the event loop of the thread the pump
+    was created on. Create it on the GUI thread. A put() from any thread
+    queues one wake-up; any mail that arrives before the wake-up is handled
+    rides along with it."""
+
+    _wake = pyqtSignal()
+
+    def __init__(self, mailbox, max_per_pass=None):
+        super().__init__()
+        self._mailbox = mailbox
+        self._max_per_pass = max_per_pass #None drains everything each pass
+        self._scheduled = False
+        self._wake.connect(self._drain, Qt.QueuedConnection)
+        mailbox.set_notify(self.wake)
+        #posting from this thread mustn't wait for room only it can make
+        mailbox.set_drain_thread(threading.current_thread())
+
+    def wake(self):
+        if not self._scheduled:
+            self._scheduled = True
+            self._wake.emit()
+
+    def _drain(self):
+        self._scheduled = False
+        self._mailbox.drain(self._max_per_pass)
+        if self._mailbox.depth():
+            self.wake() #let other events in before doing the rest
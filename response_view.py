@@ -0,0 +1,130 @@
+"""
+response_view.py
+
+Shows what the marshaller sends back, at however many messages a second it
+sends them, without flooding the Qt event loop.
+
+DataLink puts inbound messages in its inbox (see data_link.py) without
+telling anyone. ResponseFeed takes whatever has piled up there on a QTimer,
+REFRESH_MS apart (about 30 frames a second), and adds the lot to a
+ResponseModel in one go. So the GUI thread does one model update per frame
+whether one message came in or a few hundred, and nothing at all is queued
+on the event loop per message.
+
+ResponseModel is a list model of the last `limit` messages, oldest dropped
+first, for a QListView. The view only asks for the rows it is showing, and
+with uniformItemSizes set it doesn't measure the others either, so a full
+model costs no more to draw than a nearly empty one. The view follows new
+messages as they come in unless the user has scrolled up to look at older
+ones.
+"""
+import collections
+import time
+
+from PyQt5.QtCore import QAbstractListModel, QModelIndex, QObject, Qt, QTimer
+
+REFRESH_MS     = 33   #between batches, about 30 frames a second
+RESPONSE_LIMIT = 2000 #messages the view keeps
+MAX_PER_BATCH  = RESPONSE_LIMIT #more than this at once would scroll off anyway
+
+
+def format_message(t, msg, t0=0.0):
+    """One line for a message received at perf_counter() time t."""
+    return f"{t - t0:10.3f}  {msg}"
+
+
+class ResponseModel(QAbstractListModel):
+    """The last limit lines, oldest first."""
+
+    def __init__(self, limit=RESPONSE_LIMIT, parent=None):
+        super().__init__(parent)
+        self.limit = limit
+        self._lines = collections.deque()
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self._lines)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole or not index.isValid():
+            return None
+        row = index.row()
+        if 0 <= row < len(self._lines):
+            return self._lines[row]
+        return None
+
+    def append_lines(self, lines):
+        """Adds lines at the end, dropping the oldest to stay within limit.
+        One remove and one insert however many lines there are."""
+        if not lines:
+            return
+        lines = lines[-self.limit:]
+        overflow = len(self._lines) + len(lines) - self.limit
+        if overflow > 0:
+            self.beginRemoveRows(QModelIndex(), 0, overflow - 1)
+            for _ in range(overflow):
+                self._lines.popleft()
+            self.endRemoveRows()
+        first = len(self._lines)
+        self.beginInsertRows(QModelIndex(), first, first + len(lines) - 1)
+        self._lines.extend(lines)
+        self.endInsertRows()
+
+    def clear(self):
+        self.beginResetModel()
+        self._lines.clear()
+        self.endResetModel()
+
+
+class ResponseFeed(QObject):
+    """Moves messages from take(), DataLink.take_inbox say, into a
+    ResponseModel shown in view every interval_ms. Create it on the GUI
+    thread."""
+
+    def __init__(self, view, take, interval_ms=REFRESH_MS,
+                 limit=RESPONSE_LIMIT):
+        super().__init__(view)
+        self.view = view
+        self.take = take
+        self.model = ResponseModel(limit, self)
+        self._t0 = time.perf_counter()
+        self.messages = 0 #shown so far
+        self.batches = 0
+        self.longest_batch = 0.0 #seconds, the slowest refresh
+        view.setModel(self.model)
+        view.setUniformItemSizes(True)
+        self._timer = QTimer(self)
+        self._timer.timeout.connect(self.refresh)
+        self._timer.start(interval_ms)
+
+    def stop(self):
+        self._timer.stop()
+
+    def note(self, text):
+        """Shows a line from the commander itself, e.g. a command that
+        wasn't sent, among the marshaller's messages."""
+        self.model.append_lines([format_message(time.perf_counter(), text,
+                                                self._t0)])
+        self.view.scrollToBottom()
+
+    def refresh(self):
+        """Takes what has come in since the last refresh and shows it."""
+        batch = self.take(MAX_PER_BATCH)
+        if not batch:
+            return
+        began = time.perf_counter()
+        bar = self.view.verticalScrollBar()
+        following = bar.value() >= bar.maximum()
+        self.model.append_lines([format_message(t, msg, self._t0)
+                                 for t, msg in batch])
+        if following:
+            self.view.scrollToBottom()
+        self.messages += len(batch)
+        self.batches += 1
+        self.longest_batch = max(self.longest_batch,
+                                 time.perf_counter() - began)
+
+    def stats(self):
+        return {'messages': self.messages, 'batches': self.batches,
+                'longest_batch_ms': self.longest_batch * 1000.0}
@@ -0,0 +1,330 @@
+"""
+scan_planner.py
+
+Orders the measurement points of a scan so the gantry spends as little time
+travelling between them as it can, and turns them into the commands for the
+scan.
+
+A compliance map visits dozens to hundreds of (x, y) points, lifting z before
+each move and putting it down to measure. The z work is the same whatever
+the order, but the travel isn't. ScanPlanner times a move between two points
+with the axis models from axis_model.py, x and y one after the other as
+to_point sends them (or whichever is slower, for concurrent=True), then
+
+- builds a tour from the start position by always going to the nearest
+  unvisited point, finding it through a grid of buckets rather than by
+  looking at every point
+- improves the tour with 2-opt: whenever swapping two legs of the path for
+  two others saves time, the stretch in between is reversed. Only the few
+  nearest neighbours of each point are tried, so a pass is quick.
+
+The path is open, it starts at the start position and ends wherever the last
+point is. 2-opt stops when nothing more can be gained or after max_time
+seconds, so planning 1000 points takes a fraction of a second.
+
+plan() returns the scan as user commands (name, axes, parm_list, block):
+
+    z_up, then for each point: to_point x&y, z_down, z_up
+
+ready for CommandInterpreter.stream_contents() or a script file (run this
+module with a csv of points to write one). send() posts them straight away,
+a few letters ahead of the marshaller, and also waits whenever the DataLink
+is under backpressure if it is given the link.
+With the command optimizer on, a z_up that wouldn't move z is dropped on the
+way out.
+"""
+import math
+import threading
+import time
+
+import axis_model
+
+DEFAULT_NEIGHBOURS = 8 #nearest points tried for each point in 2-opt
+DEFAULT_MAX_TIME = 0.5 #seconds of 2-opt at most
+DEFAULT_LOOKAHEAD = 8 #letters of a scan posted but not finished
+
+
+class ScanPlanner:
+
+    def __init__(self, concurrent=False, neighbours=DEFAULT_NEIGHBOURS,
+                 max_time=DEFAULT_MAX_TIME):
+        """concurrent True if x and y move together during a to_point, so a
+        move takes as long as the slower axis."""
+        self.concurrent = concurrent
+        self.neighbours = neighbours
+        self.max_time = max_time
+        self._x_time = axis_model.axis_model('x').move_time
+        self._y_time = axis_model.axis_model('y').move_time
+        self.plan_time = 0.0 #seconds the last order() took
+        self.improvements = 0 #2-opt moves made by the last order()
+
+    def travel_time(self, p, q):
+        """Estimated seconds to get from point p to point q."""
+        tx = self._x_time(p[0] - q[0])
+        ty = self._y_time(p[1] - q[1])
+        if self.concurrent:
+            return max(tx, ty)
+        return tx + ty
+
+    def path_time(self, points, start=(0.0, 0.0)):
+        """Seconds of travel visiting points in the order given."""
+        total = 0.0
+        here = start
+        for p in points:
+            total += self.travel_time(here, p)
+            here = p
+        return total
+
+    def order(self, points, start=(0.0, 0.0)):
+        """Returns points in the order to visit them, starting from start."""
+        began = time.perf_counter()
+        points = [(float(x), float(y)) for x, y in points]
+        self.improvements = 0
+        if len(points) < 2:
+            self.plan_time = time.perf_counter() - began
+            return points
+        nodes = points + [(float(start[0]), float(start[1]))]
+        grid = _Grid(nodes, len(points), self.travel_time)
+        neighbours = [grid.nearest(i, self.neighbours)
+                      for i in range(len(points))]
+        tour = self._nearest_neighbour_tour(grid)
+        self._two_opt(nodes, tour, neighbours, began + self.max_time)
+        self.plan_time = time.perf_counter() - began
+        return [points[i] for i in tour[1:]]
+
+    def plan(self, points, start=(0.0, 0.0)):
+        """Returns the user commands for a scan of points."""
+        cmds = [("z_up", "z", [], True)]
+        for x, y in self.order(points, start):
+            cmds.append(("to_point", "x&y", [_parm(x), _parm(y)], True))
+            cmds.append(("z_down", "z", [], True))
+            cmds.append(("z_up", "z", [], True))
+        return cmds
+
+    def send(self, interpreter, points, start=(0.0, 0.0), link=None,
+             lookahead=DEFAULT_LOOKAHEAD):
+        """Plans a scan of points and posts it through interpreter, a
+        CommandInterpreter. Returns the letters' futures. At most lookahead
+        letters are posted and not finished, and with link, a DataLink, each
+        command also waits until the link is clear to send, so a big scan
+        doesn't overflow its queue. A to_point's letters are queued both or
+        neither (see CommandInterpreter.post_group()). Once a letter fails
+        nothing more is posted, the probe may not be where the scan thinks.
+        This blocks, so call it off the GUI thread."""
+        futures = []
+        room = threading.Condition()
+        unfinished = [0]
+        failed = []
+
+        def finished(future):
+            with room:
+                unfinished[0] -= 1
+                if future.cancelled() or future.exception() is not None:
+                    failed.append(future)
+                room.notify()
+
+        for group in interpreter.stream_groups(self.plan(points, start)):
+            if failed:
+                break
+            if link is not None:
+                link.wait_clear()
+            with room:
+                #a command bigger than lookahead goes once the rest are done
+                room.wait_for(lambda: failed or not unfinished[0] or
+                              unfinished[0] + len(group) <= lookahead)
+                if failed:
+                    break
+                unfinished[0] += len(group)
+            for future in interpreter.post_group(group):
+                futures.append(future)
+                future.add_done_callback(finished)
+        return futures
+
+    def _nearest_neighbour_tour(self, grid):
+        """Tour of node numbers starting at the start node, always moving on
+        to the nearest point not yet visited."""
+        here = grid.start
+        tour = [here]
+        for _ in range(grid.count):
+            nearest = grid.nearest(here, 1)[0]
+            grid.remove(nearest)
+            tour.append(nearest)
+            here = nearest
+        return tour
+
+    def _two_opt(self, nodes, tour, neighbours, deadline):
+        """Improves tour in place. tour[0] is the start and stays put."""
+        cost = lambda a, b: self.travel_time(nodes[a], nodes[b])
+        last = len(tour) - 1
+        pos = [0] * len(tour)
+        for i, node in enumerate(tour):
+            pos[node] = i
+
+        def reverse(lo, hi):
+            tour[lo:hi + 1] = tour[lo:hi + 1][::-1]
+            for k in range(lo, hi + 1):
+                pos[tour[k]] = k
+            self.improvements += 1
+
+        improved = True
+        while improved and time.perf_counter() < deadline:
+            improved = False
+            for i in range(1, last + 1):
+                a = tour[i]
+                #new leg a-c in place of a's leg to its successor b
+                moved = False
+                if i < last:
+                    b = tour[i + 1]
+                    ab = cost(a, b)
+                    for c in neighbours[a]:
+                        ac = cost(a, c)
+                        if ac >= ab:
+                            break
+                        j = pos[c]
+                        if j > i + 1:
+                            d = tour[j + 1] if j < last else None
+                            delta = ac - ab
+                            if d is not None:
+                                delta += cost(b, d) - cost(c, d)
+                            if delta < -1e-9:
+                                reverse(i + 1, j)
+                                moved = True
+                                break
+                        elif j < i - 1:
+                            e = tour[j + 1]
+                            delta = ac + cost(e, b) - cost(c, e) - ab
+                            if delta < -1e-9:
+                                reverse(j + 1, i)
+                                moved = True
+                                break
+                    if moved:
+                        improved = True
+                        continue
+                #new leg c-a in place of a's leg from its predecessor p
+                p = tour[i - 1]
+                pa = cost(p, a)
+                for c in neighbours[a]:
+                    ac = cost(a, c)
+                    if ac >= pa:
+                        break
+                    j = pos[c]
+                    if j < i - 1:
+                        q = tour[j - 1]
+                        delta = cost(q, p) + ac - cost(q, c) - pa
+                        if delta < -1e-9:
+                            reverse(j, i - 1)
+                            improved = True
+                            break
+                    elif j > i + 1:
+                        q = tour[j - 1]
+                        delta = cost(p, q) + ac - pa - cost(q, c)
+                        if delta < -1e-9:
+                            reverse(i, j - 1)
+                            improved = True
+                            break
+
+
+class _Grid:
+    """Buckets the scan points by position so the nearest ones to a point
+    can be found without looking at all of them. Node count (one past the
+    last point) is the start position, which is never a bucket member."""
+
+    def __init__(self, nodes, count, travel_time):
+        self.nodes = nodes
+        self.count = count
+        self.start = count
+        self._time = travel_time
+        xs = [p[0] for p in nodes]
+        ys = [p[1] for p in nodes]
+        self._x0 = min(xs)
+        self._y0 = min(ys)
+        span = max(max(xs) - self._x0, max(ys) - self._y0, 1e-9)
+        self._size = span / max(math.sqrt(count), 1.0) #about 1 point a cell
+        self._cells = {}
+        for i in range(count):
+            self._cells.setdefault(self._cell(nodes[i]), []).append(i)
+        self._reach = int(span / self._size) + 1 #rings covering everything
+
+    def _cell(self, p):
+        return (int((p[0] - self._x0) / self._size),
+                int((p[1] - self._y0) / self._size))
+
+    def remove(self, i):
+        cell = self._cell(self.nodes[i])
+        members = self._cells[cell]
+        members.remove(i)
+        if not members:
+            del self._cells[cell]
+
+    def nearest(self, i, k):
+        """Up to k points nearest to node i by travel time, nearest first,
+        not counting i itself."""
+        p = self.nodes[i]
+        cx, cy = self._cell(p)
+        found = [] #(time, node)
+        for ring in range(self._reach + 1):
+            for cell in _ring(cx, cy, ring):
+                for j in self._cells.get(cell, ()):
+                    if j != i:
+                        found.append((self._time(p, self.nodes[j]), j))
+            if len(found) >= k:
+                #anything in a further ring is at least ring cells away
+                gap = ring * self._size
+                bound = min(self._time(p, (p[0] + gap, p[1])),
+                            self._time(p, (p[0], p[1] + gap)))
+                found.sort()
+                if found[k - 1][0] <= bound:
+                    break
+        found.sort()
+        return [j for _, j in found[:k]]
+
+
+def _ring(cx, cy, ring):
+    """The cells ring cells away from (cx, cy), the square around it."""
+    if ring == 0:
+        yield (cx, cy)
+        return
+    for dx in range(-ring, ring + 1):
+        yield (cx + dx, cy - ring)
+        yield (cx + dx, cy + ring)
+    for dy in range(-ring + 1, ring):
+        yield (cx - ring, cy + dy)
+        yield (cx + ring, cy + dy)
+
+
+def _parm(value):
+    return str(round(value, 4))
+
+
+def read_points(path):
+    """Reads x, y pairs, one to a line, from a csv file. Lines that don't
+    start with two numbers (a header, say) are skipped."""
+    points = []
+    with open(path) as f:
+        for line in f:
+            fields = line.replace(',', ' ').split()
+            try:
+                points.append((float(fields[0]), float(fields[1])))
+            except (IndexError, ValueError):
+                continue
+    return points
+
+
+if __name__ == "__main__":
+    import sys
+    import command_script
+    if len(sys.argv) != 3:
+        print("usage: python scan_planner.py points.csv script.jsonl")
+        sys.exit(1)
+    points = read_points(sys.argv[1])
+    planner = ScanPlanner()
+    cmds = planner.plan(points)
+    ordered = [(float(c[2][0]), float(c[2][1])) for c in cmds
+               if c[0] == "to_point"]
+    print(f"{len(points)} points planned in {planner.plan_time * 1000.0:.1f} ms,"
+          f" travel {planner.path_time(points):.1f}s as given, "
+          f"{planner.path_time(ordered):.1f}s planned")
+    recorder = command_script.ScriptRecorder(sys.argv[2], append=False)
+    for cmd in cmds:
+        recorder.record(*cmd)
+    recorder.close()
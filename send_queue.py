@@ -0,0 +1,215 @@
+"""
+send_queue.py
+
+The DataLink's outgoing queue. Letters wait in a lane by priority and get()
+always takes from the most urgent lane that has anything in it:
+
+    PRIORITY_STOP     stop commands
+    PRIORITY_CONTROL  safety and control commands, e.g. set_axis_mac_ids or
+                      a z_up the user asks for in the middle of a script
+    PRIORITY_NORMAL   everything else, in the order it was posted
+
+A letter's priority is the one set with Letter.set_priority(), or else goes
+by its content (see priority_of()). Within a lane it is first in, first out.
+
+Only the normal lane is bounded. put() waits for room there just as
+queue.Queue does (or raises queue.Full when told not to block), but the
+urgent lanes never make anyone wait, so a stop can always get in however
+much is queued ahead of it.
+
+The normal lane also has watermarks so producers can see it filling up and
+back off before it is full. Once it reaches high the queue is under pressure
+until it drains down to low, and on_pressure(under_pressure, depth) is
+called at each change. Under pressure put() offers each new letter to its
+merge function along with the one at the back of the lane, and if they can
+be made into one letter that replaces the one queued.
+
+A user command can be several letters, one per axis. They share an
+Admission so they are queued all together or not at all: put() is given
+room=n for the first of them and only takes it if there is room for all n,
+and the rest go in with room=0 whatever the lane holds.
+
+cancel_below() takes everything less urgent than a priority out of the queue
+and returns it, which is how a stop throws away pending work. requeue() puts
+letters back at the head of their lane, for a writer that took them and then
+had to make way for something more urgent.
+
+Otherwise the interface is queue.Queue's, so it stands in for the plain
+queue DataLink used to have.
+"""
+import collections
+import queue
+import threading
+import time
+
+import wire_protocol
+
+PRIORITY_STOP    = 0
+PRIORITY_CONTROL = 1
+PRIORITY_NORMAL  = 2
+_LANES = 3
+
+#commands that are control rather than motion, sent ahead of the rest
+CONTROL_COMMANDS = ("set_axis_mac_ids",)
+
+
+def priority_of(letter):
+    """The lane a letter goes in."""
+    priority = letter.priority()
+    if priority is not None:
+        return priority
+    content = letter.content()
+    if type(content) is list and content:
+        if content[0] == wire_protocol.STOP:
+            return PRIORITY_STOP
+        if content[0] in CONTROL_COMMANDS:
+            return PRIORITY_CONTROL
+    return PRIORITY_NORMAL
+
+
+class Admission:
+    """Shared by the letters of one user command. admitted is None until
+    the first of them is put, then whether they all go or none do."""
+
+    __slots__ = ('size', 'admitted')
+
+    def __init__(self, size):
+        self.size = size
+        self.admitted = None
+
+
+class SendQueue:
+
+    def __init__(self, maxsize=0, high=None, low=None, on_pressure=None):
+        """maxsize bounds the normal lane, 0 for no bound. high and low are
+        the watermarks, by default 4/5 and 1/5 of maxsize."""
+        self.maxsize = maxsize
+        self.high = high if high is not None else maxsize * 4 // 5
+        self.low = low if low is not None else maxsize // 5
+        self.on_pressure = on_pressure
+        self.under_pressure = False
+        self.merged = 0 #letters merged into one already queued
+        self._lanes = [collections.deque() for _ in range(_LANES)]
+        self._cond = threading.Condition()
+
+    def depth(self):
+        """Letters in the normal lane."""
+        return len(self._lanes[PRIORITY_NORMAL])
+
+    def _pressure_changed(self):
+        """Checks the watermarks. Call holding _cond. Returns the
+        on_pressure call to make once the lock is let go, or None."""
+        if not self.high:
+            return None
+        depth = len(self._lanes[PRIORITY_NORMAL])
+        if not self.under_pressure and depth >= self.high:
+            self.under_pressure = True
+        elif self.under_pressure and depth <= self.low:
+            self.under_pressure = False
+        else:
+            return None
+        return (self.under_pressure, depth)
+
+    def _tell(self, change):
+        if change is not None and self.on_pressure is not None:
+            self.on_pressure(*change)
+
+    def qsize(self):
+        with self._cond:
+            return sum(len(lane) for lane in self._lanes)
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def lane_sizes(self):
+        with self._cond:
+            return [len(lane) for lane in self._lanes]
+
+    def put(self, item, priority=PRIORITY_NORMAL, block=True, timeout=None,
+            merge=None, room=1):
+        """Adds item to the back of its lane. Only the normal lane can be
+        full, and then this waits for room like queue.Queue.put(). merge,
+        if given, is called as merge(queued, item) under pressure and
+        returns the one item to queue in place of both, or None. room is
+        how many places must be free, more than 1 to keep them for items
+        that follow, 0 to go in over maxsize."""
+        lane = self._lanes[priority]
+        with self._cond:
+            if priority == PRIORITY_NORMAL:
+                if merge is not None and self.under_pressure and lane:
+                    merged = merge(lane[-1], item)
+                    if merged is not None:
+                        lane[-1] = merged
+                        self.merged += 1
+                        return
+                if self.maxsize > 0 and room > 0:
+                    full = lambda: len(lane) + room > self.maxsize
+                    if full():
+                        if not block:
+                            raise queue.Full
+                        if not self._cond.wait_for(lambda: not full(),
+                                                   timeout):
+                            raise queue.Full
+            lane.append(item)
+            self._cond.notify_all()
+            change = self._pressure_changed()
+        self._tell(change)
+
+    def put_nowait(self, item, priority=PRIORITY_NORMAL, merge=None):
+        self.put(item, priority, block=False, merge=merge)
+
+    def get(self, block=True, timeout=None):
+        """Removes and returns the oldest item of the most urgent lane."""
+        with self._cond:
+            if not block:
+                timeout = 0
+            if timeout is not None:
+                deadline = time.perf_counter() + timeout
+            while True:
+                for lane in self._lanes:
+                    if lane:
+                        item = lane.popleft()
+                        self._cond.notify_all() #there's room for a put()
+                        change = self._pressure_changed()
+                        break
+                else:
+                    lane = None
+                if lane is not None:
+                    break
+                if timeout is None:
+                    self._cond.wait()
+                else:
+                    remaining = deadline - time.perf_counter()
+                    if remaining <= 0:
+                        raise queue.Empty
+                    self._cond.wait(remaining)
+        self._tell(change)
+        return item
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def more_urgent(self, priority):
+        """True if anything more urgent than priority is waiting."""
+        with self._cond:
+            return any(self._lanes[p] for p in range(priority))
+
+    def requeue(self, items, priority=PRIORITY_NORMAL):
+        """Puts items back at the head of their lane, keeping their order.
+        The lane may go over maxsize for a while."""
+        with self._cond:
+            self._lanes[priority].extendleft(reversed(items))
+            self._cond.notify_all()
+
+    def cancel_below(self, priority):
+        """Removes and returns everything less urgent than priority, most
+        urgent first."""
+        with self._cond:
+            removed = []
+            for lane in self._lanes[priority + 1:]:
+                removed.extend(lane)
+                lane.clear()
+            self._cond.notify_all()
+            change = self._pressure_changed()
+        self._tell(change)
+        return removed
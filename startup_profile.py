@@ -0,0 +1,32 @@
+"""
+startup_profile.py
+
+Times the phases of program startup. Each call to mark(name) closes the phase
+that has been running since the previous mark (or since the timer was made)
+and report() prints how long each one took. command_main.py makes its timer
+before its imports and prints the report when run with --startup-profile.
+"""
+import time
+
+
+class PhaseTimer:
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self._last = self.started
+        self.phases = [] #(name, seconds)
+
+    def mark(self, name):
+        now = time.perf_counter()
+        self.phases.append((name, now - self._last))
+        self._last = now
+
+    def total(self):
+        return self._last - self.started
+
+    def report(self):
+        lines = ["startup profile:"]
+        for name, seconds in self.phases:
+            lines.append(f"  {name:<28}{seconds * 1000.0:9.1f} ms")
+        lines.append(f"  {'total':<28}{self.total() * 1000.0:9.1f} ms")
+        return lines
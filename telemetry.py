@@ -0,0 +1,194 @@
+"""
+telemetry.py
+
+Keeps the deflection and load samples the marshaller streams, thousands a
+second, in preallocated NumPy ring buffers.
+
+TelemetryStore has one ring of sample times (float64, the marshaller's
+clock) and one ring of values (float32, a column per channel), both
+capacity samples long. Once full, the oldest samples are written over. A
+block of samples off the framed link (["samples", t0, dt, channels, data],
+see wire_protocol.py) is copied from the receive buffer into the value ring
+with one slice assignment, or two where it wraps, and its times are filled
+in from t0 and dt the same way. No Python object is made per sample, so
+nothing piles up for the garbage collector however fast samples come in.
+Single ["telemetry", t, value, ...] messages from the json link are written
+one row at a time, which is fine at the rates json can manage.
+
+The link's reader thread writes and the GUI reads, so both go through one
+lock. It is taken once per block, not per sample.
+
+For display, envelope() cuts the last n samples of a channel into buckets
+and gives the min and max of each, so a plot a few hundred pixels wide
+still shows every spike in a hundred thousand samples while drawing only
+twice as many points as it has pixels. latest() gives the samples
+themselves.
+
+NumPy is needed. Without it numpy_available() is False and TelemetryStore
+can't be made, and the rest of the commander runs without telemetry.
+"""
+import threading
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import wire_protocol
+
+DEFAULT_CAPACITY = 1 << 18 #samples per ring, about 50 s at 5 kHz
+DEFAULT_BUCKETS = 500 #min/max pairs for a plot about that many pixels wide
+_MAX_BLOCK = wire_protocol.MAX_BODY // wire_protocol.SAMPLE_SIZE #samples a frame can hold
+
+
+def numpy_available():
+    return np is not None
+
+
+def _is_number(value):
+    return type(value) in (int, float)
+
+
+def min_max(values, buckets):
+    """Splits values (1-D) into buckets runs of equal length and returns
+    (lo, hi), the min and max of each. Samples that don't divide evenly are
+    left off the front. Fewer values than buckets gives one bucket each."""
+    buckets = max(min(int(buckets), len(values)), 1)
+    per = len(values) // buckets
+    if per == 0:
+        return values.copy(), values.copy()
+    runs = values[len(values) - per * buckets:].reshape(buckets, per)
+    return runs.min(axis=1), runs.max(axis=1)
+
+
+class TelemetryStore:
+
+    def __init__(self, channels=wire_protocol.TELEMETRY_CHANNELS,
+                 capacity=DEFAULT_CAPACITY):
+        if np is None:
+            raise ImportError("telemetry needs numpy")
+        self.channels = tuple(channels)
+        self.capacity = int(capacity)
+        self._times = np.zeros(self.capacity, dtype=np.float64)
+        self._values = np.zeros((self.capacity, len(self.channels)),
+                                dtype=np.float32)
+        self._steps = np.arange(_MAX_BLOCK, dtype=np.float64) #0, 1, 2...
+        self._lock = threading.Lock()
+        self.count = 0 #samples ever written, the next one goes at count % capacity
+        self.blocks = 0
+        self.bad_blocks = 0 #wrong number of channels, or partial samples
+        self.bad_messages = 0 #not a samples or telemetry message at all
+
+    def add_message(self, msg):
+        """Takes a ["samples", ...] or ["telemetry", ...] message from the
+        link. Returns the number of samples added. Anything not shaped like
+        one is counted in bad_messages and dropped, the link's reader thread
+        mustn't die on a garbled message."""
+        if len(msg) == 5 and msg[0] == wire_protocol.SAMPLES:
+            _, t0, dt, channels, data = msg
+            if _is_number(t0) and _is_number(dt) and type(channels) is int:
+                return self.add_block(t0, dt, channels, data)
+        elif len(msg) >= 2 and msg[0] == wire_protocol.TELEMETRY and \
+             all(_is_number(value) for value in msg[1:]):
+            return self.add_sample(msg[1], msg[2:])
+        self.bad_messages += 1
+        return 0
+
+    def add_block(self, t0, dt, channels, data):
+        """Copies a block of f32 samples, channels values each, out of data
+        (any buffer, usually a memoryview into the link's receive buffer)."""
+        if channels != len(self.channels):
+            self.bad_blocks += 1
+            return 0
+        try:
+            block = np.frombuffer(data, dtype='<f4').reshape(-1, channels)
+        except (TypeError, ValueError):
+            self.bad_blocks += 1 #not a buffer, or not whole samples
+            return 0
+        n = len(block)
+        if n == 0:
+            return 0
+        skipped = 0
+        if n > self.capacity:
+            #only the newest capacity samples would survive anyway
+            skipped = n - self.capacity
+            t0 += dt * skipped
+            block = block[skipped:]
+            n = self.capacity
+        if n > len(self._steps):
+            self._steps = np.arange(n, dtype=np.float64)
+        with self._lock:
+            self.count += skipped
+            start = self.count % self.capacity
+            first = min(n, self.capacity - start)
+            times = self._times[start:start + first]
+            np.multiply(self._steps[:first], dt, out=times)
+            times += t0
+            self._values[start:start + first] = block[:first]
+            if first < n:
+                rest = n - first
+                np.multiply(self._steps[first:n], dt, out=self._times[:rest])
+                self._times[:rest] += t0
+                self._values[:rest] = block[first:]
+            self.count += n
+            self.blocks += 1
+        return n
+
+    def add_sample(self, t, values):
+        if len(values) != len(self.channels):
+            self.bad_blocks += 1
+            return 0
+        with self._lock:
+            i = self.count % self.capacity
+            self._times[i] = t
+            self._values[i] = values
+            self.count += 1
+        return 1
+
+    def available(self):
+        """Samples held, at most capacity."""
+        return min(self.count, self.capacity)
+
+    def latest(self, n=None, channel=None):
+        """Copies of the last n samples (all held if None), oldest first, as
+        (times, values). values has a column per channel, or is just the one
+        channel (by name) if channel is given."""
+        column = slice(None) if channel is None else \
+                 self.channels.index(channel)
+        with self._lock:
+            held = min(self.count, self.capacity)
+            n = held if n is None else min(int(n), held)
+            end = self.count % self.capacity
+            if n <= end:
+                times = self._times[end - n:end].copy()
+                values = self._values[end - n:end, column].copy()
+            else:
+                wrap = n - end
+                times = np.concatenate((self._times[-wrap:],
+                                        self._times[:end]))
+                values = np.concatenate((self._values[-wrap:, column],
+                                         self._values[:end, column]))
+        return times, values
+
+    def envelope(self, channel, n=None, buckets=DEFAULT_BUCKETS):
+        """Min/max decimation of the last n samples of channel for display.
+        Returns (times, lo, hi), one entry per bucket, times being the time
+        at the end of each bucket."""
+        times, values = self.latest(n, channel)
+        lo, hi = min_max(values, buckets)
+        per = len(values) // max(len(lo), 1)
+        if per:
+            times = times[len(times) - per * len(lo) + per - 1::per]
+        return times, lo, hi
+
+    def reset(self):
+        with self._lock:
+            self.count = 0
+            self.blocks = 0
+            self.bad_blocks = 0
+            self.bad_messages = 0
+
+    def stats(self):
+        return {'samples': self.count, 'held': self.available(),
+                'blocks': self.blocks, 'bad_blocks': self.bad_blocks,
+                'bad_messages': self.bad_messages}
@@ -0,0 +1,26 @@
+import argparse
+
+import pytest
+
+pytest.importorskip("PyQt5.QtCore")
+
+import benchmarks
+import graph_process
+
+
+@pytest.mark.skipif(not graph_process.graph_available(),
+                    reason="the graph process needs Python 3.8 and numpy")
+def test_graph_rows_line_up_with_the_header(capsys):
+    benchmarks.run_graph(argparse.Namespace(step=7.5, interval=0.001))
+    lines = capsys.readouterr().out.splitlines()
+    header = lines.index(next(l for l in lines if l.split()[:1] == ['isobars']))
+    columns = lines[header].split()
+    assert columns == ['isobars', 'p50', 'ms', 'p99', 'ms', 'max', 'ms']
+    rows = [l for l in lines[header + 1:]
+            if l.split()[:1] in (['in'], ['separate'])]
+    assert len(rows) == 2
+    for row in rows:
+        numbers = row.split()[-3:]
+        assert len(numbers) == 3
+        assert all(float(n) >= 0.0 for n in numbers)
+        assert len(row) == len(lines[header])
@@ -0,0 +1,23 @@
+from command_batcher import CommandBatcher
+from post_office import Letter
+from send_queue import PRIORITY_STOP, SendQueue
+
+
+def _letter(content):
+    return Letter("datalink", "test", content)
+
+
+def test_stop_goes_out_ahead_of_a_held_letter():
+    q = SendQueue()
+    batcher = CommandBatcher(max_batch=4, window=0)
+    move = _letter(["to_point", "x", "1.0", True])
+    group = _letter(["group", "m", [["to_point", "y", "2.0", True]], True])
+    q.put(move)
+    q.put(group)
+    assert batcher.next_letters(q, wait=False) == [move]
+    assert batcher.held() is group #didn't fit in the batch
+    stop = _letter(["stop", "m", [], True])
+    q.put(stop, PRIORITY_STOP)
+    assert batcher.next_letters(q, wait=False) == [stop]
+    assert batcher.next_letters(q, wait=False) == [group]
+    assert not batcher.has_held()
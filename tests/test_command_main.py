@@ -0,0 +1,143 @@
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+pytest.importorskip("PyQt5.QtCore")
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_app = None #the QCoreApplication timers need, once one is made
+
+
+def _run(code):
+    """Runs code in a fresh interpreter, so command_main is imported anew,
+    and returns the last line it printed."""
+    env = dict(os.environ, QT_QPA_PLATFORM="offscreen", PYTHONPATH=REPO)
+    out = subprocess.run([sys.executable, "-c", code], cwd=REPO, env=env,
+                         capture_output=True, text=True, check=True).stdout
+    return out.strip().splitlines()[-1]
+
+
+def test_heavy_modules_are_not_imported_at_load():
+    names = ["telemetry", "graph_process", "numpy", "RPi", "serial"]
+    assert _run("import sys, command_main\n"
+                f"print([n for n in {names!r} if n in sys.modules])") == "[]"
+
+
+def test_link_features_that_need_trying_on_the_marshaller_start_off():
+    assert _run("import command_main as m\n"
+                "print(m.ASYNC_POST_OFFICE, m.COALESCE_COMMANDS, "
+                "m.OPTIMIZE_COMMANDS)") == "False False False"
+
+
+class _FakeGPIO:
+    BCM, OUT, LOW, HIGH = "bcm", "out", 0, 1
+
+    def __init__(self):
+        self.levels = []
+
+    def setmode(self, mode):
+        pass
+
+    def setwarnings(self, on):
+        pass
+
+    def setup(self, pin, mode, initial):
+        pass
+
+    def output(self, pin, level):
+        self.levels.append(level)
+
+
+class _FakeLink:
+
+    def __init__(self, calls):
+        self.calls = calls
+
+    def expect_restart(self):
+        self.calls.append("expect_restart")
+
+
+class _FakeLabel:
+
+    def __init__(self):
+        self.text = None
+
+    def setText(self, text):
+        self.text = text
+
+
+class _FakeFeed:
+
+    def __init__(self):
+        self.notes = []
+
+    def note(self, text):
+        self.notes.append(text)
+
+
+@pytest.fixture
+def startup(monkeypatch):
+    """command_main with a fake RPi.GPIO, and a dialog that has only what
+    on_port_opened uses. Returns (command_main, dialog, link calls, gpio,
+    ready timers started)."""
+    global _app
+    from PyQt5.QtCore import QCoreApplication
+    _app = QCoreApplication.instance() or QCoreApplication([]) #kept alive
+    gpio = _FakeGPIO()
+    rpi = type(sys)("RPi")
+    rpi.GPIO = gpio
+    monkeypatch.setitem(sys.modules, "RPi", rpi)
+    monkeypatch.setitem(sys.modules, "RPi.GPIO", gpio)
+    import command_main
+    cls = command_main.CmdInputDisplay
+    calls = []
+    timers = []
+    link = _FakeLink(calls)
+    link.port = "/dev/nothing"
+    monkeypatch.setattr(cls, "data_link", link, raising=False)
+    monkeypatch.setattr(cls, "lbl_status", _FakeLabel(), raising=False)
+    monkeypatch.setattr(cls, "response_feed", _FakeFeed(), raising=False)
+    monkeypatch.setattr(cls, "on_marshaller_ready_timeout",
+                        lambda self: timers.append("fired"))
+    monkeypatch.setattr(cls, "_status", cls.START_UP, raising=False)
+    dialog = cls.__new__(cls)
+    real_single_shot = command_main.QTimer.singleShot
+
+    class _Timer:
+        @staticmethod
+        def singleShot(ms, slot):
+            if ms == int(command_main.MARSHALLER_READY_TIMEOUT * 1000):
+                timers.append(ms)
+            else:
+                real_single_shot(ms, slot)
+    monkeypatch.setattr(command_main, "QTimer", _Timer)
+    return command_main, dialog, calls, gpio, timers
+
+
+def test_reset_follows_the_port_opening_without_blocking(startup):
+    from PyQt5.QtCore import QEventLoop, QTimer
+    command_main, dialog, calls, gpio, timers = startup
+    began = time.perf_counter()
+    command_main.CmdInputDisplay.on_port_opened(dialog, True)
+    assert time.perf_counter() - began < command_main.MARSHALLER_RESET_PULSE
+    assert calls == ["expect_restart"]
+    assert timers == [int(command_main.MARSHALLER_READY_TIMEOUT * 1000)]
+    assert gpio.levels == [gpio.LOW] #EN is held low...
+    loop = QEventLoop()
+    QTimer.singleShot(int(command_main.MARSHALLER_RESET_PULSE * 1000) + 100,
+                      loop.quit)
+    loop.exec_()
+    assert gpio.levels == [gpio.LOW, gpio.HIGH] #...and let go by the timer
+    assert command_main.MARSHALLER_RESET_PULSE == 0.25
+
+
+def test_port_that_did_not_open_leaves_the_dialog_not_ready(startup):
+    command_main, dialog, calls, gpio, timers = startup
+    command_main.CmdInputDisplay.on_port_opened(dialog, False)
+    assert calls == [] and gpio.levels == [] and timers == []
+    assert dialog._status == command_main.CmdInputDisplay.NO_PORT
+    assert dialog.lbl_status.text == command_main.CmdInputDisplay.NO_PORT
+    assert dialog.response_feed.notes == ["could not open /dev/nothing"]
@@ -0,0 +1,52 @@
+import axis_model
+from command_optimizer import CommandOptimizer
+
+
+def test_increments_become_one_move():
+    opt = CommandOptimizer(0.5)
+    out = opt.optimize([["inc_right", "x", "", False]] * 5)
+    assert out == [["move_rel", "x", "2.5", False]]
+    assert opt.stats()['commands_saved'] == 4
+    assert opt.stats()['seconds_saved'] > 0.0
+
+
+def test_set_inc_gives_the_increment():
+    opt = CommandOptimizer()
+    unknown = ["inc_away", "y", "", True]
+    assert opt.optimize([unknown]) == [unknown] #no increment known yet
+    out = opt.optimize([["set_inc", "y", "0.25", True], unknown, unknown])
+    assert out == [["set_inc", "y", "0.25", True],
+                   ["move_rel", "y", "0.5", True]]
+
+
+def test_moves_that_cancel_are_dropped():
+    opt = CommandOptimizer()
+    out = opt.optimize([["move_rel", "x", "0.5", True],
+                        ["move_rel", "x", "-0.5", True]])
+    assert out == []
+    assert opt.stats()['commands_out'] == 0
+
+
+def test_only_neighbouring_moves_on_one_axis_merge():
+    opt = CommandOptimizer()
+    cmds = [["move_rel", "x", "1.0", True], ["move_rel", "y", "1.0", True],
+            ["move_rel", "x", "1.0", True]]
+    assert opt.optimize(cmds) == cmds
+
+
+def test_repeated_z_toggle_is_dropped_until_forgotten():
+    opt = CommandOptimizer()
+    up, down = ["z_up", "z", "", True], ["z_down", "z", "", True]
+    assert opt.optimize([up, up, down, down, up]) == [up, down, up]
+    assert opt.seconds_saved == 2 * axis_model.Z_TOGGLE_TIME
+    opt.forget()
+    assert opt.optimize([up]) == [up]
+
+
+def test_feed_holds_a_move_until_something_else_comes():
+    opt = CommandOptimizer()
+    move = ["move_rel", "x", "1.0", True]
+    assert opt.feed(move) == []
+    assert opt.feed(["z_up", "z", "", True]) == [move,
+                                                 ["z_up", "z", "", True]]
+    assert opt.flush() == []
@@ -0,0 +1,217 @@
+import concurrent.futures
+import queue
+
+import pytest
+
+pytest.importorskip("PyQt5.QtCore")
+
+import data_link
+from post_office import Letter, PostOffice
+import send_queue
+
+
+@pytest.fixture
+def link():
+    po = PostOffice("test")
+    link = data_link.DataLink(po)
+    link.posted = po
+    return link
+
+
+def _post(link, axis, admission=None):
+    letter = Letter(link.MY_PO_ID, "test", ["to_point", axis, "1.0", True])
+    letter.set_future(concurrent.futures.Future())
+    if admission is not None:
+        letter.set_admission(admission)
+    link.posted.post(letter)
+    return letter.future()
+
+
+def _fill(link, leave):
+    for _ in range(data_link.TO_BACKEND_Q_SIZE - leave):
+        link.to_backend_q.put(Letter(link.MY_PO_ID, "test",
+                                     ["z_up", "z", [], True]))
+
+
+def test_multi_axis_command_is_rejected_whole(link):
+    rejected = []
+    link.commandRejected.connect(rejected.append)
+    _fill(link, 1)
+    admission = send_queue.Admission(2)
+    futures = [_post(link, "x", admission), _post(link, "y", admission)]
+    assert all(isinstance(f.exception(0), queue.Full) for f in futures)
+    assert link.to_backend_q.depth() == data_link.TO_BACKEND_Q_SIZE - 1
+    assert link.letters_rejected == 2
+    assert rejected == [["to_point", "x", "1.0", True]]
+
+
+def test_multi_axis_command_is_queued_whole(link):
+    _fill(link, 2)
+    admission = send_queue.Admission(2)
+    futures = [_post(link, "x", admission), _post(link, "y", admission)]
+    assert not any(f.done() for f in futures)
+    assert link.to_backend_q.depth() == data_link.TO_BACKEND_Q_SIZE
+
+
+def test_rest_of_an_admitted_command_gets_in_over_a_full_queue(link):
+    _fill(link, 2)
+    admission = send_queue.Admission(2)
+    first = _post(link, "x", admission)
+    link.to_backend_q.put(Letter(link.MY_PO_ID, "test", ["z_up", "z", [], True]))
+    second = _post(link, "y", admission)
+    assert not first.done() and not second.done()
+    assert link.to_backend_q.depth() == data_link.TO_BACKEND_Q_SIZE + 1
+
+
+def test_interpreter_sends_a_multi_axis_command_as_one_admission(link):
+    import commands
+    interpreter = commands.CommandInterpreter(link.posted)
+    futures = interpreter.send_command("to_point", "x&y", ["1.0", "2.0"], True)
+    assert len(futures) == 2
+    first, second = link.to_backend_q.get_nowait(), link.to_backend_q.get_nowait()
+    assert first.admission() is second.admission()
+    assert first.admission().admitted is True
+
+
+def test_malformed_telemetry_does_not_kill_the_reader():
+    pytest.importorskip("numpy")
+    import telemetry
+    store = telemetry.TelemetryStore(capacity=4)
+    link = data_link.DataLink(PostOffice("test"), telemetry=store)
+    link.backend_message_received(["telemetry"])
+    link.backend_message_received(["samples", 0.0])
+    assert store.stats()['bad_messages'] == 2
+
+
+def test_port_that_will_not_open_is_reported(link, monkeypatch):
+    def no_port():
+        raise OSError("no such port")
+    monkeypatch.setattr(link, "open_uart", no_port)
+    opened = []
+    link.portOpened.connect(opened.append)
+    future = _post(link, "x")
+    link.run()
+    assert opened == [False]
+    assert future.cancelled()
+
+
+def test_samples_in_one_read_reach_telemetry_intact():
+    np = pytest.importorskip("numpy")
+    import struct
+    import telemetry
+    import wire_protocol
+    channels = len(wire_protocol.TELEMETRY_CHANNELS)
+    store = telemetry.TelemetryStore(capacity=2000)
+    link = data_link.DataLink(PostOffice("test"),
+                              protocol=data_link.PROTOCOL_FRAMED,
+                              telemetry=store)
+    read = b"".join(wire_protocol.encode_message(
+        [wire_protocol.SAMPLES, float(n), 0.001, channels,
+         struct.pack(f'<{50 * channels}f', *[float(n)] * 50 * channels)])
+        for n in range(20))
+    link.backend_bytes_received(read)
+    _, values = store.latest()
+    assert store.blocks == 20
+    assert np.array_equal(values[:, 0], np.repeat(np.arange(20.0), 50))
+
+
+def _queued(link):
+    contents = []
+    while True:
+        try:
+            contents.append(link.to_backend_q.get_nowait().content())
+        except queue.Empty:
+            return contents
+
+
+def test_optimizer_never_drops_a_command_sent_from_the_dialog(link):
+    import commands
+    interpreter = commands.CommandInterpreter(link.posted, optimize=True)
+    interpreter.send_command("z_up", "z", [], True)
+    interpreter.send_command("z_up", "z", [], True) #the user's retry
+    assert _queued(link) == [["z_up", "z", [], True]] * 2
+
+
+def test_optimizer_still_runs_over_a_stream(link):
+    import commands
+    interpreter = commands.CommandInterpreter(link.posted, optimize=True)
+    contents = list(interpreter.stream_contents(
+        [("z_up", "z", [], True), ("z_up", "z", [], True)]))
+    assert contents == [["z_up", "z", [], True]]
+    assert interpreter.optimizer.stats()['commands_saved'] == 1
+
+
+def test_scan_queues_a_to_point_whole_and_stops_when_it_cannot(link):
+    import commands
+    import scan_planner
+    interpreter = commands.CommandInterpreter(link.posted)
+    _fill(link, 2) #room for the z_up and one axis of the to_point
+    futures = scan_planner.ScanPlanner().send(interpreter, [(1.0, 2.0)])
+    assert len(futures) == 3 #nothing after the rejected to_point
+    for future in futures[1:]:
+        with pytest.raises(queue.Full):
+            future.result(0)
+    contents = _queued(link)
+    assert contents[-1] == ["z_up", "z", [], True]
+    assert not any(c[0] == "to_point" for c in contents)
+
+
+def test_scan_keeps_lookahead_letters_unfinished_without_a_link(link):
+    import threading
+    import commands
+    import scan_planner
+    interpreter = commands.CommandInterpreter(link.posted)
+    sender = threading.Thread(target=scan_planner.ScanPlanner().send,
+                              args=(interpreter, [(1.0, 2.0), (2.0, 2.0)]),
+                              kwargs={'lookahead': 3}, daemon=True)
+    sender.start()
+    sent = []
+    while sender.is_alive() or link.to_backend_q.depth():
+        try:
+            letter = link.to_backend_q.get(timeout=0.2)
+        except queue.Empty:
+            continue
+        assert link.to_backend_q.depth() < 3
+        sent.append(letter.content()[:2])
+        letter.future().set_result(None)
+    assert sent == [["z_up", "z"], ["to_point", "x"], ["to_point", "y"],
+                    ["z_down", "z"], ["z_up", "z"], ["to_point", "x"],
+                    ["to_point", "y"], ["z_down", "z"], ["z_up", "z"]]
+
+
+def test_script_queues_a_to_point_whole(link, tmp_path):
+    import commands
+    import command_script
+    path = str(tmp_path / "script.jsonl")
+    recorder = command_script.ScriptRecorder(path, append=False)
+    recorder.record("z_up", "z", [], True)
+    recorder.record("to_point", "x&y", ["1.0", "2.0"], True)
+    recorder.close()
+    interpreter = commands.CommandInterpreter(link.posted)
+    player = command_script.ScriptPlayer(interpreter, link.codec)
+    _fill(link, 2) #room for the z_up and one axis of the to_point
+    assert not player.play(path)
+    assert isinstance(player.error, queue.Full)
+    assert player.letters_sent == 3
+    contents = _queued(link)
+    assert contents[-1] == ["z_up", "z", [], True]
+    assert not any(c[0] == "to_point" for c in contents)
+
+
+def test_stop_that_never_goes_out_is_forgotten(link):
+    stop = Letter(link.MY_PO_ID, "test", ["stop", "m", [], True])
+    stop.set_future(concurrent.futures.Future())
+    link.posted.post(stop)
+    assert stop.letter_id() in link._stop_posted
+    stop.future().cancel()
+    link.write_letters([link.to_backend_q.get_nowait()])
+    assert link._stop_posted == {}
+    link.posted.post(Letter(link.MY_PO_ID, "test", ["stop", "m", [], True]))
+    link._abandon_letters()
+    assert link._stop_posted == {}
+
+
+def test_only_write_letters_writes_to_the_uart():
+    #the print-only helpers from before the I/O rewrite are gone
+    assert not hasattr(data_link.DataLink, "uart_send")
+    assert not hasattr(data_link.DataLink, "str_bytes")
@@ -0,0 +1,70 @@
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("multiprocessing.shared_memory")
+
+import graph_process
+import measurement_store
+from graph_process import MeasurementRing
+
+
+@pytest.fixture
+def ring():
+    ring = MeasurementRing(4)
+    yield ring
+    ring.close()
+
+
+def test_take_gets_what_was_published(ring):
+    assert ring.publish(1.0, 2.0, 10.0, 0.5, timestamp=7.0) #reader idle
+    assert not ring.publish(3.0, 4.0, 10.0, 0.25, timestamp=8.0)
+    rows = ring.take()
+    assert rows.shape == (2, len(measurement_store.COLUMNS))
+    assert rows[0].tolist() == [1.0, 2.0, 10.0, 0.5,
+                                measurement_store.compliance_of(10.0, 0.5), 7.0]
+    assert rows[1, 0] == 3.0
+    assert ring.take().shape[0] == 0
+    assert ring.publish(5.0, 6.0, 10.0, 0.5) #caught up, so idle again
+
+
+def test_take_wraps_round_the_ring(ring):
+    for n in range(3):
+        ring.publish(n, 0.0, 1.0, 1.0)
+    ring.take()
+    for n in range(3, 6):
+        ring.publish(n, 0.0, 1.0, 1.0)
+    assert ring.take()[:, 0].tolist() == [3.0, 4.0, 5.0]
+    assert ring.lost == 0
+
+
+def test_lapped_reader_counts_what_it_lost(ring):
+    for n in range(10):
+        ring.publish(n, 0.0, 1.0, 1.0)
+    assert ring.take()[:, 0].tolist() == [6.0, 7.0, 8.0, 9.0]
+    assert ring.lost == 6
+
+
+def test_second_ring_attaches_by_name(ring):
+    other = MeasurementRing(4, ring.name)
+    try:
+        ring.publish(1.0, 1.0, 1.0, 1.0)
+        assert other.take()[:, 0].tolist() == [1.0]
+        assert ring.read_count() == 1
+    finally:
+        other.close()
+
+
+def test_grapher_takes_rows_into_the_map():
+    ring = MeasurementRing(32)
+    try:
+        grapher = graph_process._Grapher(ring, (0.0, 4.0), (0.0, 4.0))
+        assert not grapher.update()
+        for x in range(4):
+            for y in range(4):
+                ring.publish(x, y, 10.0, 0.1 * (1 + x + y))
+        assert grapher.update()
+        stats = grapher.stats()
+        assert stats['updates'] == 1
+        assert stats['lost'] == 0
+    finally:
+        ring.close()
@@ -0,0 +1,54 @@
+import threading
+
+import pytest
+
+import mailboxes
+from post_office import Letter
+
+
+def _letter(n):
+    return Letter("test", "gui", ["status", "x", n])
+
+
+def _put_without_deadlock(mailbox, letter):
+    #a put() stuck waiting is woken by close() and returns False
+    rescue = threading.Timer(2.0, mailbox.close)
+    rescue.start()
+    try:
+        return mailbox.put(letter)
+    finally:
+        rescue.cancel()
+
+
+def test_blocking_mailbox_waits_for_room():
+    delivered = []
+    mailbox = mailboxes.Mailbox(delivered.append, size=1)
+    assert mailbox.put(_letter(0))
+    poster = threading.Thread(target=mailbox.put, args=(_letter(1),))
+    poster.start()
+    poster.join(0.1)
+    assert poster.is_alive() #waiting for room
+    mailbox.drain(1)
+    poster.join(1.0)
+    assert not poster.is_alive()
+    assert mailbox.depth() == 1
+    assert mailbox.stats()['blocked'] == 1
+
+
+def test_draining_thread_never_waits_on_its_own_mailbox():
+    mailbox = mailboxes.Mailbox(lambda letter: None, size=1)
+    mailbox.drain()
+    assert mailbox.put(_letter(0))
+    assert _put_without_deadlock(mailbox, _letter(1))
+    assert mailbox.depth() == 2
+
+
+def test_gui_thread_never_waits_on_a_pumped_mailbox():
+    pytest.importorskip("PyQt5.QtCore")
+    import qt_mailbox
+    mailbox = mailboxes.Mailbox(lambda letter: None, size=1)
+    pump = qt_mailbox.QtMailboxPump(mailbox)
+    assert mailbox.put(_letter(0))
+    assert _put_without_deadlock(mailbox, _letter(1))
+    assert mailbox.depth() == 2
+    del pump
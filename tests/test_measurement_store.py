@@ -0,0 +1,95 @@
+import math
+import os
+
+import pytest
+
+import measurement_store
+from measurement_store import MeasurementSession
+
+
+def test_append_and_read_back(tmp_path):
+    session = MeasurementSession(str(tmp_path / "s"))
+    assert session.append(1.0, 2.0, 10.0, 0.5, timestamp=3.0) == 0
+    assert session.append_rows([(1.5, 2.0, 10.0, 0.25),
+                                (2.0, 2.0, 0.0, 0.0)]) == 1
+    assert len(session) == 3
+    assert session.row(0) == {'x': 1.0, 'y': 2.0, 'load': 10.0,
+                              'deflection': 0.5, 'compliance': 0.05,
+                              'timestamp': 3.0}
+    assert list(session.column('x')) == [1.0, 1.5, 2.0]
+    assert math.isnan(session.row(2)['compliance'])
+    session.close()
+    again = MeasurementSession(str(tmp_path / "s"), readonly=True)
+    assert len(again) == 3
+    with pytest.raises(PermissionError):
+        again.append(0.0, 0.0, 1.0, 1.0)
+    again.close()
+
+
+def test_torn_append_is_cut_off(tmp_path):
+    path = str(tmp_path / "s")
+    session = MeasurementSession(path)
+    session.append(1.0, 1.0, 1.0, 1.0)
+    session.close()
+    #a crash after the values went out but before the row count did
+    with open(os.path.join(path, 'x'), 'ab') as f:
+        f.write(b'\1' * 12)
+    session = MeasurementSession(path)
+    assert len(session) == 1
+    assert os.path.getsize(os.path.join(path, 'x')) == 8
+    session.append(2.0, 1.0, 1.0, 1.0)
+    assert list(session.column('x')) == [1.0, 2.0]
+    session.close()
+
+
+def test_readonly_session_picks_up_new_rows(tmp_path):
+    path = str(tmp_path / "s")
+    writer = MeasurementSession(path)
+    reader = MeasurementSession(path, readonly=True)
+    writer.append(1.0, 1.0, 1.0, 1.0)
+    assert len(reader) == 0
+    reader.refresh()
+    assert len(reader) == 1
+    assert list(reader.column('x')) == [1.0]
+    writer.close()
+    reader.close()
+
+
+def test_rows_at_and_history_go_by_grid_cell(tmp_path):
+    root = str(tmp_path)
+    first = MeasurementSession(os.path.join(root, "1"), grid=0.5)
+    first.append_rows([(1.0, 1.0, 1.0, 1.0), (1.1, 0.9, 1.0, 1.0),
+                       (3.0, 1.0, 1.0, 1.0)])
+    assert first.rows_at(1.0, 1.0) == [0, 1]
+    assert first.grid_index()[first.cell(3.0, 1.0)] == [2]
+    first.append(0.95, 1.05, 1.0, 1.0)
+    assert first.rows_at(1.0, 1.0) == [0, 1, 3] #index kept up by appends
+    second = MeasurementSession(os.path.join(root, "2"), grid=0.5)
+    second.append(1.0, 1.2, 1.0, 1.0)
+    first.close()
+    second.close()
+    sessions = measurement_store.open_sessions(root)
+    found = measurement_store.history(sessions, 1.0, 1.0)
+    assert [(os.path.basename(s.path), i) for s, i in found] == \
+           [("1", 0), ("1", 1), ("1", 3), ("2", 0)]
+    for session in sessions:
+        session.close()
+
+
+def test_crash_while_creating_leaves_no_session(tmp_path, monkeypatch):
+    path = str(tmp_path / "s")
+
+    def crash(self, meta):
+        raise OSError("power went")
+    monkeypatch.setattr(MeasurementSession, "_write_meta", crash)
+    with pytest.raises(OSError):
+        MeasurementSession(path)
+    #the rows file is there, meta.json isn't, so it isn't a session yet
+    assert os.path.exists(os.path.join(path, "rows"))
+    assert measurement_store.session_paths(str(tmp_path)) == []
+    with pytest.raises(FileNotFoundError):
+        MeasurementSession(path, readonly=True)
+    monkeypatch.undo()
+    session = MeasurementSession(path)
+    assert len(session) == 0
+    session.close()
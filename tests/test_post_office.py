@@ -0,0 +1,75 @@
+import pytest
+
+import post_office
+from post_office import Letter, PostOffice
+import send_queue
+
+
+def _round_trip(letter):
+    buffer = bytearray(256)
+    end = letter.pack_into(buffer)
+    back, back_end = Letter.unpack_from(memoryview(buffer))
+    assert back_end == end
+    return back
+
+
+def test_pack_round_trip_keeps_addresses_and_content():
+    content = ["move_rel", "x", 1.5, True]
+    back = _round_trip(Letter("DataLink_1", "Commander", content))
+    assert back.destination() == "DataLink_1"
+    assert back.source() == "Commander"
+    assert back.content() == content
+
+
+def test_unpacked_letter_is_a_whole_letter():
+    back = _round_trip(Letter("DataLink_1", "Commander",
+                              ["move_rel", "x", 1.5, True]))
+    assert back.future() is None
+    assert back.wire("framed") is None
+    assert back.priority() is None
+    assert back.stamps() is None
+    assert send_queue.priority_of(back) == send_queue.PRIORITY_NORMAL
+
+
+def test_unpacked_letter_posts_to_the_link():
+    pytest.importorskip("PyQt5.QtCore")
+    import data_link
+    po = PostOffice("test")
+    link = data_link.DataLink(po)
+    back = _round_trip(Letter(link.MY_PO_ID, "Commander",
+                              ["move_rel", "x", 1.5, True]))
+    po.post(back)
+    assert link.to_backend_q.get_nowait() is back
+
+
+def test_post_reaches_registrant_and_wildcard_subscriber():
+    po = PostOffice("test")
+    got, heard = [], []
+    po.register("a", got.append)
+    po.subscribe("*", heard.append)
+    letter = Letter("a", "b", {"hello": 1})
+    po.post(letter)
+    assert got == [letter]
+    assert heard == [letter]
+
+
+def test_addresses_are_interned():
+    name = "".join(["Data", "Link_1"])
+    assert post_office.intern_address(name) is \
+           post_office.intern_address("DataLink_1")
+
+
+def test_rarely_used_fields_are_made_when_first_set():
+    letter = Letter("a", "b", None)
+    assert letter._extra is None
+    letter.set_future(object())
+    assert letter._extra is None
+    letter.set_priority(send_queue.PRIORITY_STOP)
+    assert letter.priority() == send_queue.PRIORITY_STOP
+    assert letter.wire("framed") is None
+
+
+def test_letter_ids_are_unique_and_stable():
+    a, b = Letter("a", "b", None), Letter("a", "b", None)
+    assert a.letter_id() != b.letter_id()
+    assert a.letter_id() == a.letter_id()
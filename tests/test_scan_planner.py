@@ -0,0 +1,53 @@
+import random
+
+import scan_planner
+from scan_planner import ScanPlanner
+
+
+def _grid(n, step=0.5):
+    return [(i * step, j * step) for i in range(n) for j in range(n)]
+
+
+def test_order_visits_every_point_once():
+    points = _grid(6)
+    random.Random(1).shuffle(points)
+    ordered = ScanPlanner().order(points)
+    assert sorted(ordered) == sorted(points)
+
+
+def test_order_is_no_slower_than_given():
+    points = _grid(8)
+    random.Random(2).shuffle(points)
+    planner = ScanPlanner()
+    ordered = planner.order(points)
+    assert planner.path_time(ordered) <= planner.path_time(points)
+    assert planner.plan_time < 5.0
+
+
+def test_concurrent_moves_take_the_slower_axis():
+    serial, together = ScanPlanner(), ScanPlanner(concurrent=True)
+    p, q = (0.0, 0.0), (2.0, 3.0)
+    assert together.travel_time(p, q) < serial.travel_time(p, q)
+    assert together.travel_time(p, q) == max(
+        together.travel_time(p, (2.0, 0.0)), together.travel_time(p, (0.0, 3.0)))
+
+
+def test_few_points():
+    planner = ScanPlanner()
+    assert planner.order([]) == []
+    assert planner.order([(1, 2)]) == [(1.0, 2.0)]
+
+
+def test_plan_lifts_z_and_measures_each_point():
+    cmds = ScanPlanner().plan([(1.0, 0.0), (0.5, 0.0)])
+    assert cmds[0] == ("z_up", "z", [], True)
+    assert cmds[1:] == [("to_point", "x&y", ["0.5", "0.0"], True),
+                        ("z_down", "z", [], True), ("z_up", "z", [], True),
+                        ("to_point", "x&y", ["1.0", "0.0"], True),
+                        ("z_down", "z", [], True), ("z_up", "z", [], True)]
+
+
+def test_read_points_skips_what_isnt_a_point(tmp_path):
+    path = tmp_path / "points.csv"
+    path.write_text("x,y\n1,2\n3 4\n\nnot,a point\n")
+    assert scan_planner.read_points(str(path)) == [(1.0, 2.0), (3.0, 4.0)]
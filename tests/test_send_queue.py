@@ -0,0 +1,100 @@
+import queue
+
+import pytest
+
+import send_queue
+from send_queue import (PRIORITY_CONTROL, PRIORITY_NORMAL, PRIORITY_STOP,
+                        SendQueue)
+
+
+def test_most_urgent_lane_first_fifo_within_a_lane():
+    q = SendQueue()
+    q.put("a")
+    q.put("b")
+    q.put("ctrl", PRIORITY_CONTROL)
+    q.put("stop", PRIORITY_STOP)
+    assert [q.get_nowait() for _ in range(4)] == ["stop", "ctrl", "a", "b"]
+    with pytest.raises(queue.Empty):
+        q.get_nowait()
+
+
+def test_only_the_normal_lane_is_bounded():
+    q = SendQueue(2)
+    q.put("a")
+    q.put("b")
+    with pytest.raises(queue.Full):
+        q.put("c", block=False)
+    q.put("stop", PRIORITY_STOP, block=False)
+    assert q.lane_sizes() == [1, 0, 2]
+
+
+def test_room_keeps_places_for_the_rest_of_a_command():
+    q = SendQueue(3)
+    q.put("a")
+    q.put("b")
+    with pytest.raises(queue.Full):
+        q.put("x", block=False, room=2)
+    q.put("x", block=False, room=1)
+    q.put("y", block=False, room=0) #over maxsize, the rest of a command
+    assert q.depth() == 4
+
+
+def test_watermarks_report_pressure_once_each_way():
+    changes = []
+    q = SendQueue(10, high=3, low=1,
+                  on_pressure=lambda on, depth: changes.append((on, depth)))
+    for item in range(4):
+        q.put(item)
+    for _ in range(3):
+        q.get_nowait()
+    assert changes == [(True, 3), (False, 1)]
+
+
+def test_merge_only_under_pressure():
+    q = SendQueue(10, high=2, low=0)
+    add = lambda queued, item: queued + item
+    q.put(1, merge=add)
+    q.put(2, merge=add) #reaches high
+    q.put(3, merge=add) #merged into the 2
+    assert q.depth() == 2
+    assert q.merged == 1
+    assert [q.get_nowait(), q.get_nowait()] == [1, 5]
+
+
+def test_cancel_below_keeps_more_urgent_lanes():
+    q = SendQueue()
+    q.put("a")
+    q.put("ctrl", PRIORITY_CONTROL)
+    q.put("stop", PRIORITY_STOP)
+    assert q.cancel_below(PRIORITY_STOP) == ["ctrl", "a"]
+    assert q.qsize() == 1
+
+
+def test_requeue_goes_back_to_the_head():
+    q = SendQueue()
+    q.put("c")
+    q.requeue(["a", "b"])
+    assert [q.get_nowait() for _ in range(3)] == ["a", "b", "c"]
+
+
+class _Letter:
+    def __init__(self, content, priority=None):
+        self._content, self._priority = content, priority
+
+    def content(self):
+        return self._content
+
+    def priority(self):
+        return self._priority
+
+
+def test_priority_of_goes_by_content_unless_set():
+    assert send_queue.priority_of(_Letter(["stop", "m", [], False])) == \
+           PRIORITY_STOP
+    assert send_queue.priority_of(_Letter(["set_axis_mac_ids", "m", [],
+                                           False])) == PRIORITY_CONTROL
+    assert send_queue.priority_of(_Letter(["move_rel", "x", 1, True])) == \
+           PRIORITY_NORMAL
+    assert send_queue.priority_of(_Letter(["move_rel", "x", 1, True],
+                                          PRIORITY_CONTROL)) == \
+           PRIORITY_CONTROL
@@ -0,0 +1,83 @@
+import struct
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+import telemetry
+import wire_protocol
+from telemetry import TelemetryStore
+
+CHANNELS = len(wire_protocol.TELEMETRY_CHANNELS)
+
+
+def _block(samples):
+    values = [float(n) for n in range(samples * CHANNELS)]
+    return memoryview(struct.pack(f'<{len(values)}f', *values))
+
+
+def test_block_is_copied_in_with_its_times():
+    store = TelemetryStore(capacity=8)
+    assert store.add_message([wire_protocol.SAMPLES, 1.0, 0.5, CHANNELS,
+                              _block(3)]) == 3
+    times, values = store.latest()
+    assert times.tolist() == [1.0, 1.5, 2.0]
+    assert values[2, 0] == 2.0 * CHANNELS
+
+
+def test_blocks_wrap_round_the_ring():
+    store = TelemetryStore(capacity=4)
+    store.add_block(0.0, 1.0, CHANNELS, _block(3))
+    store.add_block(3.0, 1.0, CHANNELS, _block(3))
+    times, _ = store.latest()
+    assert times.tolist() == [2.0, 3.0, 4.0, 5.0]
+    assert store.count == 6
+
+
+def test_single_sample_message():
+    store = TelemetryStore(capacity=4)
+    values = [1.0] * CHANNELS
+    assert store.add_message([wire_protocol.TELEMETRY, 2.0] + values) == 1
+    assert store.latest()[0].tolist() == [2.0]
+
+
+@pytest.mark.parametrize("msg", [
+    ["telemetry"],
+    ["samples"],
+    ["samples", 0.0, 1.0, CHANNELS],
+    ["samples", 0.0, 1.0, CHANNELS, b"", "extra"],
+    ["samples", "0.0", 1.0, CHANNELS, b""],
+    ["samples", 0.0, 1.0, None, b""],
+    ["telemetry", "now", 1.0],
+    ["telemetry", 1.0, None],
+    ["something else", 1.0],
+])
+def test_malformed_message_is_dropped_and_counted(msg):
+    store = TelemetryStore(capacity=4)
+    assert store.add_message(msg) == 0
+    assert store.count == 0
+    assert store.stats()['bad_messages'] == 1
+
+
+def test_block_that_isnt_whole_samples_is_counted():
+    store = TelemetryStore(capacity=4)
+    assert store.add_block(0.0, 1.0, CHANNELS, b"\0" * 5) == 0
+    assert store.add_block(0.0, 1.0, CHANNELS, [1.0, 2.0]) == 0
+    assert store.add_block(0.0, 1.0, CHANNELS + 1, _block(1)) == 0
+    assert store.add_sample(0.0, [1.0] * (CHANNELS + 1)) == 0
+    assert store.stats()['bad_blocks'] == 4
+    assert store.count == 0
+
+
+def test_envelope_keeps_the_extremes():
+    store = TelemetryStore(capacity=16)
+    for n in range(8):
+        store.add_sample(float(n), [float(n % 4)] * CHANNELS)
+    _, lo, hi = store.envelope(wire_protocol.TELEMETRY_CHANNELS[0], None, 2)
+    assert lo.tolist() == [0.0, 0.0]
+    assert hi.tolist() == [3.0, 3.0]
+
+
+def test_min_max_with_fewer_values_than_buckets():
+    lo, hi = telemetry.min_max(np.array([1.0, 2.0]), 10)
+    assert lo.tolist() == [1.0, 2.0] and hi.tolist() == [1.0, 2.0]
@@ -0,0 +1,105 @@
+import struct
+
+import wire_protocol
+from wire_protocol import FrameDecoder, FramedMessageDecoder
+
+
+def _moves(count):
+    return [["move_rel", "x", float(i), True] for i in range(count)]
+
+
+def _stream(contents):
+    return b"".join(wire_protocol.encode_message(c) for c in contents)
+
+
+def test_command_round_trip():
+    content = ["move_rel", "y", 1.5, False]
+    decoder = FramedMessageDecoder()
+    assert decoder.feed(wire_protocol.encode_message(content)) == [content]
+
+
+def test_json_and_control_round_trip():
+    contents = [{"note": "hello"}, ["window", 8], ["ack", 2], ["ready", 4]]
+    decoder = FramedMessageDecoder()
+    assert decoder.feed(_stream(contents)) == contents
+
+
+def test_seq_round_trip():
+    frame = wire_protocol.encode_message(["move_rel", "x", 2.0, True], seq=7)
+    decoder = FramedMessageDecoder(with_seq=True)
+    assert decoder.feed(frame) == [(7, ["move_rel", "x", 2.0, True])]
+
+
+def test_partial_frames_across_feeds():
+    contents = _moves(20)
+    stream = _stream(contents)
+    decoder = FramedMessageDecoder()
+    got = []
+    for i in range(0, len(stream), 7):
+        got += decoder.feed(stream[i:i + 7])
+    assert got == contents
+
+
+def test_garbage_and_bad_crc_are_skipped():
+    good = wire_protocol.encode_message(["move_rel", "x", 1.0, True])
+    bad = bytearray(good)
+    bad[-1] ^= 0xFF
+    decoder = FramedMessageDecoder()
+    got = decoder.feed(b"\x00junk" + bytes(bad) + good)
+    assert got == [["move_rel", "x", 1.0, True]]
+    assert decoder.frames.crc_errors == 1
+
+
+def test_chunk_larger_than_buffer_decodes_every_frame():
+    contents = _moves(1000)
+    stream = _stream(contents)
+    decoder = FramedMessageDecoder()
+    assert len(stream) > len(decoder.frames._buf)
+    assert decoder.feed(stream) == contents
+    assert decoder.frames.bytes_skipped == 0
+
+
+def test_raw_feed_larger_than_buffer_keeps_frames():
+    stream = _stream(_moves(1000))
+    frames = FrameDecoder()
+    frames.feed(stream)
+    assert sum(1 for _ in frames.frames()) == 1000
+    assert frames.bytes_skipped == 0
+
+
+def test_pack_content_round_trip():
+    buffer = bytearray(256)
+    content = ["batch", "m", _moves(3), True]
+    end = wire_protocol.pack_content_into(buffer, 0, content)
+    assert wire_protocol.unpack_content_from(buffer) == (content, end)
+
+
+def _samples(blocks, count=50):
+    """samples messages, every value in block n being n."""
+    channels = len(wire_protocol.TELEMETRY_CHANNELS)
+    return [[wire_protocol.SAMPLES, float(n), 0.5, channels,
+             struct.pack(f'<{count * channels}f', *[float(n)] * count * channels)]
+            for n in range(blocks)]
+
+
+def _values(data):
+    return set(struct.unpack(f'<{len(data) // 4}f', bytes(data)))
+
+
+def test_samples_from_one_read_are_all_intact():
+    blocks = _samples(20)
+    decoder = FramedMessageDecoder()
+    decoded = decoder.feed(_stream(blocks))
+    assert len(decoded) == 20
+    for n, msg in enumerate(decoded):
+        assert msg[:4] == blocks[n][:4]
+        assert _values(msg[4]) == {float(n)}
+
+
+def test_samples_from_messages_are_good_until_the_next():
+    decoder = FramedMessageDecoder()
+    count = 0
+    for n, msg in enumerate(decoder.messages(_stream(_samples(20)))):
+        assert _values(msg[4]) == {float(n)}
+        count += 1
+    assert count == 20
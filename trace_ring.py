@@ -0,0 +1,134 @@
+"""
+trace_ring.py
+
+Low overhead tracing for the message path. Instead of printing every letter
+as it goes by, the post office and the DataLink record fixed-size binary
+events (time, stage, letter id, size) into a preallocated ring buffer. The
+newest events overwrite the oldest. Nothing is formatted until someone asks
+for it with events() or dump().
+
+Tracing is off by default and can be switched at any time with enable() and
+disable(). Hot paths check TRACE.enabled before calling record(), so it costs
+next to nothing when off. Setting the environment variable COMMANDER_TRACE=1
+turns it on at startup.
+
+A dump file is a small header followed by the events, oldest first. Run this
+module on a dump file to print it:
+
+    python trace_ring.py commander_trace.bin
+"""
+import itertools
+import os
+import struct
+import sys
+import time
+
+#stages
+STAGE_POST      = 1  #PostOffice.post() got a letter
+STAGE_QUEUED    = 2  #DataLink put a letter in to_backend_q
+STAGE_DEQUEUED  = 3  #DataLink took letters off to_backend_q to send
+STAGE_WRITE     = 4  #bytes written to the uart, size is the byte count
+STAGE_RX_BYTES  = 5  #bytes read from the uart, size is the byte count
+STAGE_RX_MSG    = 6  #a complete message decoded from the backend
+STAGE_CTRL      = 7  #a flow control message from the backend
+
+STAGE_NAMES = {
+    STAGE_POST: "post",
+    STAGE_QUEUED: "queued",
+    STAGE_DEQUEUED: "dequeued",
+    STAGE_WRITE: "write",
+    STAGE_RX_BYTES: "rx_bytes",
+    STAGE_RX_MSG: "rx_msg",
+    STAGE_CTRL: "ctrl",
+    }
+
+DEFAULT_CAPACITY = 16384 #events, must be a power of 2
+
+_EVENT  = struct.Struct('<QBxxxII') #time ns, stage, letter id, size
+_HEADER = struct.Struct('<8sII')    #magic, event size, event count
+_MAGIC  = b'CMDTRACE'
+_EVENT_SIZE = _EVENT.size
+
+
+class TraceRing:
+    """Fixed-size ring of trace events. record() may be called from any
+    thread; each call gets its own slot."""
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        assert capacity > 0 and capacity & (capacity - 1) == 0, \
+               "trace capacity must be a power of 2"
+        self.capacity = capacity
+        self._mask = capacity - 1
+        self._buf = bytearray(capacity * _EVENT.size)
+        self._slots = itertools.count()
+        self._recorded = 0
+        self.enabled = False
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def clear(self):
+        self._slots = itertools.count()
+        self._recorded = 0
+
+    def record(self, stage, letter_id=0, size=0,
+               _pack=_EVENT.pack_into, _now=time.perf_counter_ns):
+        slot = next(self._slots)
+        _pack(self._buf, (slot & self._mask) * _EVENT_SIZE, _now(), stage,
+              letter_id, size)
+        self._recorded = slot + 1
+
+    def _ordered(self):
+        """The buffer contents oldest event first, and the event count."""
+        count = min(self._recorded, self.capacity)
+        if self._recorded <= self.capacity:
+            return bytes(self._buf[:count * _EVENT.size]), count
+        split = (self._recorded % self.capacity) * _EVENT.size
+        return bytes(self._buf[split:] + self._buf[:split]), count
+
+    def events(self):
+        """Returns the events as (time ns, stage, letter id, size) tuples,
+        oldest first."""
+        data, count = self._ordered()
+        return list(_EVENT.iter_unpack(data))
+
+    def dump(self, path):
+        """Writes the events to path. Returns the number written."""
+        data, count = self._ordered()
+        with open(path, 'wb') as f:
+            f.write(_HEADER.pack(_MAGIC, _EVENT.size, count))
+            f.write(data)
+        return count
+
+
+def load(path):
+    """Reads a dump file back into a list of event tuples."""
+    with open(path, 'rb') as f:
+        magic, size, count = _HEADER.unpack(f.read(_HEADER.size))
+        if magic != _MAGIC or size != _EVENT.size:
+            raise ValueError(f"{path} is not a trace dump")
+        return list(_EVENT.iter_unpack(f.read(size * count)))
+
+
+def format_events(events):
+    """One line per event, times in ms relative to the first event."""
+    if not events:
+        return []
+    t0 = events[0][0]
+    return [f"{(t - t0) / 1e6:12.3f} ms  {STAGE_NAMES.get(stage, stage):>9}"
+            f"  letter {letter_id:<8d} size {size}"
+            for t, stage, letter_id, size in events]
+
+
+#The one ring everything records into.
+TRACE = TraceRing()
+if os.environ.get('COMMANDER_TRACE') == '1':
+    TRACE.enable()
+
+
+if __name__ == "__main__":
+    for line in format_events(load(sys.argv[1])):
+        print(line)
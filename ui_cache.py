@@ -0,0 +1,84 @@
+"""
+ui_cache.py
+
+Loads Qt Designer .ui files through a cache of compiled Python modules.
+
+uic.loadUi() parses the XML and builds the widgets by reflection on every
+launch, which is slow on the Pi. load_ui() instead compiles the .ui file once
+with uic.compileUi() into CACHE_DIR next to it and just imports the result
+after that. The first line of the cached module records the mtime of the .ui
+file it was made from, and it is rebuilt whenever that changes, so editing
+the form in Designer needs no extra step. PyQt5.uic itself is only imported
+when a rebuild is needed.
+
+If the cache can't be written or used (read-only install, say) the form is
+loaded with uic.loadUi() as before.
+"""
+import importlib.util
+import os
+
+CACHE_DIR = "__uicache__"
+_MTIME_TAG = "#ui mtime: "
+
+
+def cached_module_path(ui_path):
+    """Where the compiled form for ui_path lives."""
+    folder, name = os.path.split(os.path.abspath(ui_path))
+    return os.path.join(folder, CACHE_DIR, os.path.splitext(name)[0] + "_ui.py")
+
+
+def _cached_mtime(py_path):
+    try:
+        with open(py_path) as f:
+            first = f.readline()
+    except OSError:
+        return None
+    if first.startswith(_MTIME_TAG):
+        return first[len(_MTIME_TAG):].strip()
+    return None
+
+
+def compile_ui(ui_path, py_path, mtime):
+    """Compiles ui_path to py_path, tagged with the .ui file's mtime. The
+    file is written under another name and moved into place so a crash
+    can't leave half a module behind."""
+    from PyQt5 import uic
+    os.makedirs(os.path.dirname(py_path), exist_ok=True)
+    tmp_path = py_path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(f"{_MTIME_TAG}{mtime}\n")
+        uic.compileUi(ui_path, f)
+    os.replace(tmp_path, py_path)
+    print(f"ui_cache: compiled {ui_path}")
+
+
+def _form_class(py_path):
+    """Imports the compiled module and returns its Ui_ class."""
+    name = "_ui_cache_" + os.path.splitext(os.path.basename(py_path))[0]
+    spec = importlib.util.spec_from_file_location(name, py_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    for attr, value in vars(module).items():
+        if attr.startswith("Ui_") and isinstance(value, type):
+            return value
+    raise ImportError(f"no Ui_ class in {py_path}")
+
+
+def load_ui(ui_path, widget):
+    """Does what uic.loadUi(ui_path, widget) does: builds the form onto
+    widget and makes each named child an attribute of it."""
+    mtime = str(os.stat(ui_path).st_mtime_ns)
+    py_path = cached_module_path(ui_path)
+    try:
+        if _cached_mtime(py_path) != mtime:
+            compile_ui(ui_path, py_path, mtime)
+        form_class = _form_class(py_path)
+    except Exception as e:
+        print(f"ui_cache: not using the cache for {ui_path}, {e}")
+        from PyQt5 import uic
+        uic.loadUi(ui_path, widget)
+        return
+    form = form_class()
+    form.setupUi(widget)
+    for name, value in vars(form).items():
+        setattr(widget, name, value)
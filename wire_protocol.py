@@ -0,0 +1,672 @@
+"""
+wire_protocol.py
+
+Contains what is needed to turn letter content into bytes for the serial link
+to the marshaller and to turn bytes from the link back into messages.
+
+The original protocol is simply json.dumps() of the letter content written to
+the uart with no delimiter. JsonStreamDecoder is used on the receiving end to
+find where one json message stops and the next one starts, since nothing on
+the wire says so.
+
+Flow control messages from the marshaller (see flow_control.py) are two
+element lists: ["window", n] advertises a receive window of n messages and
+["ack", n] says n messages have been dealt with. ["ready", n] is sent once
+the marshaller has (re)started and can take commands, n being its receive
+window or 0 if it doesn't do flow control.
+
+The framed protocol (PROTOCOL_FRAMED) puts every message in a frame:
+
+    SYNC(0xA5) | LEN u16 | TYPE u8 | PAYLOAD (LEN-1 bytes) | CRC u16
+
+All integers are little endian. CRC is CRC-16/CCITT (binascii.crc_hqx, seed
+0xFFFF) over LEN, TYPE and PAYLOAD. A receiver that loses its place skips
+ahead to the next SYNC byte whose frame checks out.
+
+Frame types:
+    FRAME_CMD   a low-level command [name, axis, parm, block] packed as
+                opcode u8 | axis u8 | flags u8 | [parm f32]. Flags bit 0 is
+                blocking, bit 1 says a parm follows.
+    FRAME_JSON  utf-8 json, for content that has no compact form.
+    FRAME_CTRL  flow control, kind u8 (1 window, 2 ack, 3 ready) | count u16.
+    FRAME_BATCH several low-level commands for the marshaller to fan out,
+                ["batch", "m", [cmd, ...], block] packed as flags u8 |
+                count u8 | count FRAME_CMD payloads back to back. Flags
+                bit 0 is blocking. Bit 1 makes it a barrier group,
+                ["group", "m", [cmd, ...], block], whose commands start
+                together on their axes and finish as one.
+    FRAME_REPLY the marshaller finished a command, seq u16 | status u8 |
+                [utf-8 json result]. Decodes to ["reply", seq, status,
+                result], result None when there isn't one.
+    FRAME_SAMPLES a block of telemetry samples, t0 f64 | dt f32 |
+                channels u8 | count u16 | count x channels f32, sample by
+                sample. t0 is the time of the first sample on the
+                marshaller's clock and dt the time between samples. Decodes
+                to ["samples", t0, dt, channels, data], data being a
+                memoryview of the f32 values straight out of the receive
+                buffer. Like the frame payloads it is only good until the
+                decoder is fed again, so copy it out before then.
+
+A command or batch frame may carry a sequence id so its reply can be matched
+up with it: bit 7 of TYPE (FLAG_SEQ) is set and the payload starts with
+seq u16. Old firmware never sees it unless DataLink is asked for replies.
+
+The codecs at the bottom give DataLink (and the marshaller simulator) one
+interface for either protocol: encode(content, seq=None) returns the bytes to
+write and new_decoder() returns an object whose feed(data) returns the list of
+complete messages, with control frames turned back into the ["window", n]
+form. new_decoder(with_seq=True) gives (seq, message) pairs instead, seq None
+for messages that didn't carry one. Json has nowhere to put a seq, so the
+json codec ignores it. The decoder's messages(data) yields the same messages
+one at a time, and the data of a samples message from it is a view into the
+frame buffer that is only good until the next one is asked for. feed() copies
+that data out, since the buffer is reused while the rest of a read is parsed.
+"""
+import binascii
+import codecs
+import json
+import math
+import struct
+
+PROTOCOL_JSON   = 'json'
+PROTOCOL_FRAMED = 'framed'
+
+_JSON_STARTS = '[{"'  #first character of any message we expect to see
+_MAX_PENDING = 4096   #a "partial" message longer than this is really garbage
+
+#flow control message kinds sent by the marshaller
+CTRL_WINDOW = 'window'
+CTRL_ACK    = 'ack'
+CTRL_READY  = 'ready'
+_CTRL_KINDS = (CTRL_WINDOW, CTRL_ACK, CTRL_READY)
+
+#reply to a sequenced command, ["reply", seq, status, result]
+REPLY          = 'reply'
+STATUS_OK      = 0
+STATUS_STOPPED = 1 #thrown away or cut short by a stop command
+
+#["stop", "m", [], False] halts every axis and makes the marshaller throw away
+#whatever it hasn't done yet
+STOP = 'stop'
+
+#["telemetry", t, value, ...] is a sample the marshaller streams on its own,
+#t being its clock in seconds and one value per channel. Over the framed
+#protocol samples come in blocks instead, ["samples", ...], see FRAME_SAMPLES.
+TELEMETRY = 'telemetry'
+SAMPLES   = 'samples'
+TELEMETRY_CHANNELS = ("deflection", "load") #inches, lbf
+
+
+class CommandFailed(Exception):
+    """Set on a command's future when the marshaller replies with a status
+    other than STATUS_OK. args are (status, result)."""
+
+
+def control_message(msg):
+    """Returns (kind, count) if msg is a flow control message from the
+    marshaller, otherwise None."""
+    if type(msg) is list and len(msg) == 2 and msg[0] in _CTRL_KINDS:
+        try:
+            return msg[0], int(msg[1])
+        except (TypeError, ValueError):
+            return None
+    return None
+
+
+def reply_message(msg):
+    """Returns (seq, status, result) if msg is the marshaller's reply to a
+    sequenced command, otherwise None."""
+    if type(msg) is list and len(msg) == 4 and msg[0] == REPLY:
+        try:
+            return int(msg[1]), int(msg[2]), msg[3]
+        except (TypeError, ValueError):
+            return None
+    return None
+
+
+class JsonStreamDecoder:
+    """Splits a stream of concatenated json messages back into messages.
+    Bytes are fed in as they arrive. Complete messages are returned from
+    feed(), anything incomplete is kept until the next call. With with_seq
+    they come back as (None, message) pairs, json carries no seq."""
+
+    def __init__(self, with_seq=False):
+        self._with_seq = with_seq
+        self._utf8 = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self._decoder = json.JSONDecoder()
+        self._pending = ''
+
+    def feed(self, data):
+        """Adds the bytes in data to the stream and returns a list of the
+        messages that are now complete."""
+        self._pending += self._utf8.decode(data)
+        messages = []
+        text = self._pending
+        pos = 0
+        end = len(text)
+        while pos < end:
+            if text[pos].isspace():
+                pos += 1
+                continue
+            if text[pos] not in _JSON_STARTS:
+                pos += 1 #garbage between messages, skip it
+                continue
+            try:
+                msg, pos = self._decoder.raw_decode(text, pos)
+            except json.JSONDecodeError:
+                if end - pos > _MAX_PENDING:
+                    pos += 1 #never going to parse, resync on the next start
+                    continue
+                break #not all here yet
+            messages.append((None, msg) if self._with_seq else msg)
+        self._pending = text[pos:]
+        return messages
+
+    def messages(self, data):
+        yield from self.feed(data)
+
+    def reset(self):
+        self._utf8.reset()
+        self._pending = ''
+
+
+#---------------------------------------------------------------------------
+#Framed protocol
+
+SYNC = 0xA5
+FRAME_CMD  = 0x01
+FRAME_JSON = 0x02
+FRAME_CTRL = 0x03
+FRAME_BATCH = 0x04
+FRAME_REPLY = 0x05
+FRAME_SAMPLES = 0x06
+FLAG_SEQ   = 0x80 #set in TYPE when the payload starts with a seq u16
+
+MAX_BODY = 1024 #largest LEN we accept. Anything bigger is a corrupt header.
+
+_HEADER = struct.Struct('<BHB') #sync, len, type
+_CRC    = struct.Struct('<H')
+_OVERHEAD = _HEADER.size + _CRC.size
+_CRC_SEED = 0xFFFF
+
+#Opcodes for FRAME_CMD. These must match the marshaller firmware, so only ever
+#add to the end. Every command in commands.CommandList should be here.
+COMMAND_NAMES = (
+    None,  #0 is not used
+    "move_rel",
+    "move_abs",
+    "z_down",
+    "z_up",
+    "to_point",
+    "set_inc",
+    "inc_left",
+    "inc_right",
+    "inc_away",
+    "inc_towards",
+    "set_axis_mac_ids",
+    "batch",
+    "group",
+    "stop",
+    )
+COMMAND_OPCODES = {name: op for op, name in enumerate(COMMAND_NAMES) if name}
+
+_CMD_BLOCKING = 0x01
+_CMD_HAS_PARM = 0x02
+_BATCH_GROUP  = 0x02 #FRAME_BATCH flag, a barrier group rather than a batch
+_BATCH_NAMES  = ("batch", "group")
+_CMD   = struct.Struct('<BBB')
+_PARM  = struct.Struct('<f')
+_CTRL  = struct.Struct('<BH')
+_BATCH = struct.Struct('<BB')
+_SEQ   = struct.Struct('<H')
+_REPLY = struct.Struct('<HB') #seq, status
+_SAMPLES = struct.Struct('<dfBH') #t0, dt, channels, count
+SAMPLE_SIZE = 4 #bytes, one f32 value
+MAX_BATCH = 255
+_CTRL_CODES = {CTRL_WINDOW: 1, CTRL_ACK: 2, CTRL_READY: 3}
+_CTRL_NAMES = {code: kind for kind, code in _CTRL_CODES.items()}
+
+
+def encode_frame(ftype, payload):
+    """Returns the bytes for one frame holding payload."""
+    header = _HEADER.pack(SYNC, len(payload) + 1, ftype)
+    crc = binascii.crc_hqx(payload, binascii.crc_hqx(header[1:], _CRC_SEED))
+    return header + payload + _CRC.pack(crc)
+
+
+def _compact_parm(parm):
+    """Returns the parm as a float if it can go in a FRAME_CMD, [] for no
+    parm, or None if it needs json."""
+    if type(parm) is list and not parm:
+        return parm
+    if type(parm) in (int, float, str):
+        try:
+            value = float(parm)
+        except ValueError:
+            return None
+        if math.isfinite(value):
+            return value
+    return None
+
+
+def _command_fields(content):
+    """Returns (opcode, axis code, flags, parm) for a low-level command that
+    has a compact form, else None. parm is None when there isn't one."""
+    if type(content) is not list or len(content) != 4:
+        return None
+    name, axis, parm, block = content
+    op = COMMAND_OPCODES.get(name)
+    if op is None or type(axis) is not str or len(axis) != 1 or ord(axis) > 127:
+        return None
+    value = _compact_parm(parm)
+    if value is None:
+        return None
+    flags = _CMD_BLOCKING if block else 0
+    if type(value) is float:
+        return op, ord(axis), flags | _CMD_HAS_PARM, value
+    return op, ord(axis), flags, None
+
+
+def encode_command(content):
+    """Returns the FRAME_CMD payload for a low-level command, or None if
+    the content can't be packed that way."""
+    fields = _command_fields(content)
+    if fields is None:
+        return None
+    op, axis, flags, value = fields
+    if value is not None:
+        return _CMD.pack(op, axis, flags) + _PARM.pack(value)
+    return _CMD.pack(op, axis, flags)
+
+
+def _pack_command_into(buffer, offset, fields):
+    op, axis, flags, value = fields
+    _CMD.pack_into(buffer, offset, op, axis, flags)
+    offset += _CMD.size
+    if value is not None:
+        _PARM.pack_into(buffer, offset, value)
+        offset += _PARM.size
+    return offset
+
+
+def decode_command(payload):
+    """Turns a FRAME_CMD payload back into [name, axis, parm, block]. A parm
+    comes back as a float, no parm as []."""
+    op, axis, flags = _CMD.unpack_from(payload)
+    parm = []
+    if flags & _CMD_HAS_PARM:
+        parm = _PARM.unpack_from(payload, _CMD.size)[0]
+    name = COMMAND_NAMES[op] if op < len(COMMAND_NAMES) else None
+    return [name, chr(axis), parm, bool(flags & _CMD_BLOCKING)]
+
+
+def _is_batch(content):
+    return type(content) is list and len(content) == 4 and \
+           content[0] in _BATCH_NAMES
+
+
+def _batch_flags(content):
+    flags = _CMD_BLOCKING if content[3] else 0
+    if content[0] == "group":
+        flags |= _BATCH_GROUP
+    return flags
+
+
+def encode_batch(content):
+    """Returns the FRAME_BATCH payload for ["batch", "m", [cmds], block] or
+    ["group", "m", [cmds], block], or None if any of the commands has no
+    compact form."""
+    cmds = content[2]
+    if not 0 < len(cmds) <= MAX_BATCH:
+        return None
+    parts = [_BATCH.pack(_batch_flags(content), len(cmds))]
+    for cmd in cmds:
+        payload = encode_command(cmd)
+        if payload is None:
+            return None
+        parts.append(payload)
+    return b''.join(parts)
+
+
+def decode_batch(payload):
+    flags, count = _BATCH.unpack_from(payload)
+    cmds = []
+    offset = _BATCH.size
+    for i in range(count):
+        cmd = decode_command(payload[offset:])
+        offset += _CMD.size + (_PARM.size if cmd[2] != [] else 0)
+        cmds.append(cmd)
+    name = "group" if flags & _BATCH_GROUP else "batch"
+    return [name, "m", cmds, bool(flags & _CMD_BLOCKING)]
+
+
+def _json_bytes(content):
+    return json.dumps(content, separators=(',', ':')).encode('utf-8')
+
+
+def _is_samples(content):
+    return type(content) is list and len(content) == 5 and \
+           content[0] == SAMPLES
+
+
+def encode_samples(content):
+    """Returns the FRAME_SAMPLES payload for ["samples", t0, dt, channels,
+    data], data being the f32 values as little endian bytes."""
+    _, t0, dt, channels, data = content
+    count = len(data) // (SAMPLE_SIZE * channels)
+    return _SAMPLES.pack(t0, dt, channels, count) + bytes(data)
+
+
+def _detached(msg):
+    """msg with samples data that is a view into a buffer copied out."""
+    if _is_samples(msg) and type(msg[4]) is memoryview:
+        return msg[:4] + [bytes(msg[4])]
+    return msg
+
+
+def decode_samples(payload):
+    t0, dt, channels, count = _SAMPLES.unpack_from(payload)
+    end = _SAMPLES.size + count * channels * SAMPLE_SIZE
+    if channels == 0 or end > len(payload):
+        raise ValueError("samples frame is cut short")
+    return [SAMPLES, t0, dt, channels, payload[_SAMPLES.size:end]]
+
+
+def encode_message(content, seq=None):
+    """Returns the frame for a piece of letter content, using the compact
+    command form when possible. seq, if given, goes in front of the payload
+    and FLAG_SEQ is set."""
+    ctrl = control_message(content)
+    if ctrl is not None:
+        return encode_frame(FRAME_CTRL, _CTRL.pack(_CTRL_CODES[ctrl[0]],
+                                                   ctrl[1]))
+    reply = reply_message(content)
+    if reply is not None:
+        seq, status, result = reply
+        return encode_frame(FRAME_REPLY, _REPLY.pack(seq, status) +
+                            (b'' if result is None else _json_bytes(result)))
+    if _is_samples(content):
+        return encode_frame(FRAME_SAMPLES, encode_samples(content))
+    if _is_batch(content):
+        ftype, payload = FRAME_BATCH, encode_batch(content)
+    else:
+        ftype, payload = FRAME_CMD, encode_command(content)
+    if payload is None:
+        ftype = FRAME_JSON
+        payload = _json_bytes(content)
+    if seq is not None:
+        return encode_frame(ftype | FLAG_SEQ, _SEQ.pack(seq) + payload)
+    return encode_frame(ftype, payload)
+
+
+def add_seq(frame, seq):
+    """Returns a frame made by encode_message() with no seq as if it had
+    been encoded with seq, without encoding the content again."""
+    payload = frame[_HEADER.size:-_CRC.size]
+    return encode_frame(frame[3] | FLAG_SEQ, _SEQ.pack(seq) + payload)
+
+
+def decode_message(ftype, payload):
+    """Turns one frame back into message content. Unknown frame types give
+    None."""
+    if ftype == FRAME_CMD:
+        return decode_command(payload)
+    if ftype == FRAME_JSON:
+        return json.loads(str(payload, 'utf-8'))
+    if ftype == FRAME_CTRL:
+        code, count = _CTRL.unpack_from(payload)
+        return [_CTRL_NAMES.get(code), count]
+    if ftype == FRAME_BATCH:
+        return decode_batch(payload)
+    if ftype == FRAME_REPLY:
+        seq, status = _REPLY.unpack_from(payload)
+        result = payload[_REPLY.size:]
+        return [REPLY, seq, status,
+                json.loads(str(result, 'utf-8')) if len(result) else None]
+    if ftype == FRAME_SAMPLES:
+        return decode_samples(payload)
+    return None
+
+
+_CONTENT = struct.Struct('<BH') #type, payload length
+
+
+def pack_content_into(buffer, offset, content):
+    """Writes content into buffer at offset as type u8 | len u16 | payload,
+    using the same types and payloads as frames but without the framing.
+    Compact commands and batches are packed straight into the buffer.
+    Returns the offset just past what was written."""
+    start = offset + _CONTENT.size
+    end = None
+    if _is_batch(content):
+        cmds = content[2]
+        fields = [_command_fields(cmd) for cmd in cmds]
+        if 0 < len(cmds) <= MAX_BATCH and None not in fields:
+            ftype = FRAME_BATCH
+            _BATCH.pack_into(buffer, start, _batch_flags(content), len(cmds))
+            end = start + _BATCH.size
+            for f in fields:
+                end = _pack_command_into(buffer, end, f)
+    else:
+        fields = _command_fields(content)
+        if fields is not None:
+            ftype = FRAME_CMD
+            end = _pack_command_into(buffer, start, fields)
+    if end is None:
+        ctrl = control_message(content)
+        if ctrl is not None:
+            ftype = FRAME_CTRL
+            _CTRL.pack_into(buffer, start, _CTRL_CODES[ctrl[0]], ctrl[1])
+            end = start + _CTRL.size
+        else:
+            ftype = FRAME_JSON
+            data = _json_bytes(content)
+            end = start + len(data)
+            if end > len(buffer):
+                raise ValueError("buffer too small for letter content")
+            buffer[start:end] = data
+    _CONTENT.pack_into(buffer, offset, ftype, end - start)
+    return end
+
+
+def unpack_content_from(buffer, offset=0):
+    """Reads content written by pack_content_into(). Returns (content,
+    offset just past it)."""
+    ftype, length = _CONTENT.unpack_from(buffer, offset)
+    start = offset + _CONTENT.size
+    view = memoryview(buffer)[start:start + length]
+    if len(view) < length:
+        raise ValueError("packed content is cut short")
+    return decode_message(ftype, view), start + length
+
+
+class FrameDecoder:
+    """Incremental frame parser over one reusable buffer. Bytes go in with
+    feed() (or straight into write_view() followed by commit()) and frames()
+    yields (type, payload) for every complete frame. The payload is a
+    memoryview into the buffer, not a copy, so it is only good until the next
+    feed()/commit(). Each byte is looked at a fixed number of times, so
+    parsing is linear in the amount of data.
+
+    feed_frames() does both a buffer's worth at a time, so a read of any
+    size goes through without the buffer growing."""
+
+    def __init__(self, capacity=4 * (MAX_BODY + _OVERHEAD)):
+        self._buf = bytearray(capacity)
+        self._view = memoryview(self._buf)
+        self._start = 0 #first unparsed byte
+        self._end = 0   #one past the last byte received
+        self.frames_ok = 0
+        self.crc_errors = 0
+        self.bytes_skipped = 0 #garbage between frames
+
+    def write_view(self):
+        """Returns a writable view of the free space at the end of the
+        buffer. Compacts the buffer first if that gives more room."""
+        if self._start:
+            unparsed = self._end - self._start
+            self._view[:unparsed] = self._view[self._start:self._end]
+            self._start, self._end = 0, unparsed
+        return self._view[self._end:]
+
+    def commit(self, count):
+        """Marks count bytes written into write_view() as received."""
+        self._end += count
+
+    def _copy_in(self, data):
+        """Copies as much of data as fits. Returns what didn't."""
+        free = self.write_view()
+        count = min(len(free), len(data))
+        free[:count] = data[:count]
+        self.commit(count)
+        return data[count:]
+
+    def feed(self, data):
+        """Adds data to the buffer. frames() hasn't had a look at it yet, so
+        the buffer grows if it has to rather than lose complete frames."""
+        data = self._copy_in(memoryview(data))
+        if data:
+            #a new buffer, old payload views keep the old one alive
+            unparsed = self._end - self._start
+            self._buf = bytearray(max(2 * len(self._buf), unparsed + len(data)))
+            self._buf[:unparsed] = self._view[self._start:self._end]
+            self._view = memoryview(self._buf)
+            self._start, self._end = 0, unparsed
+            self._copy_in(data)
+
+    def feed_frames(self, data):
+        """feed() and frames() in turn a buffer's worth at a time, yielding
+        (type, payload) for every frame in data. Each payload is only good
+        until the next is asked for. After frames() less than one frame is
+        left unparsed, and the buffer holds several, so there is always room
+        for more."""
+        data = memoryview(data)
+        while True:
+            left = self._copy_in(data)
+            if left and len(left) == len(data):
+                #no room at all, only with a buffer smaller than a frame
+                self.feed(left)
+                left = left[:0]
+            data = left
+            yield from self.frames()
+            if not data:
+                return
+
+    def reset(self):
+        self._start = self._end = 0
+
+    def frames(self):
+        buf = self._buf
+        view = self._view
+        while True:
+            start, end = self._start, self._end
+            if end - start < _OVERHEAD:
+                return
+            if buf[start] != SYNC:
+                sync = buf.find(SYNC, start, end)
+                if sync < 0:
+                    sync = end
+                self.bytes_skipped += sync - start
+                self._start = sync
+                continue
+            length = buf[start + 1] | (buf[start + 2] << 8)
+            if length == 0 or length > MAX_BODY:
+                self.bytes_skipped += 1
+                self._start = start + 1
+                continue
+            crc_at = start + 3 + length
+            if crc_at + _CRC.size > end:
+                return #rest of the frame isn't here yet
+            crc = binascii.crc_hqx(view[start + 1:crc_at], _CRC_SEED)
+            if crc != buf[crc_at] | (buf[crc_at + 1] << 8):
+                self.crc_errors += 1
+                self.bytes_skipped += 1
+                self._start = start + 1
+                continue
+            self._start = crc_at + _CRC.size
+            self.frames_ok += 1
+            yield buf[start + 3], view[start + 4:crc_at]
+
+
+#---------------------------------------------------------------------------
+#Codecs. One interface for either protocol.
+
+class JsonCodec:
+    name = PROTOCOL_JSON
+
+    def encode(self, content, seq=None):
+        return json.dumps(content).encode('utf-8')
+
+    def with_seq(self, data, seq):
+        return data
+
+    def new_decoder(self, with_seq=False):
+        return JsonStreamDecoder(with_seq)
+
+
+class FramedMessageDecoder:
+    """feed() interface on top of FrameDecoder. Frames that don't decode are
+    counted and dropped. with_seq gives (seq, message) pairs."""
+
+    def __init__(self, with_seq=False):
+        self.frames = FrameDecoder()
+        self.bad_frames = 0
+        self._with_seq = with_seq
+
+    def feed(self, data):
+        """Returns the list of messages complete in data. Samples data is
+        copied out of the frame buffer, which later frames write over."""
+        messages = []
+        for msg in self.messages(data):
+            if self._with_seq:
+                messages.append((msg[0], _detached(msg[1])))
+            else:
+                messages.append(_detached(msg))
+        return messages
+
+    def messages(self, data):
+        """Yields each message in data as soon as its frame is parsed. The
+        data of a samples message is a view into the frame buffer, good until
+        the next message is asked for, so it can be copied straight to where
+        it is going."""
+        for ftype, payload in self.frames.feed_frames(data):
+            seq = None
+            try:
+                if ftype & FLAG_SEQ:
+                    seq = _SEQ.unpack_from(payload)[0]
+                    payload = payload[_SEQ.size:]
+                    ftype &= ~FLAG_SEQ
+                msg = decode_message(ftype, payload)
+            except (ValueError, struct.error, IndexError):
+                msg = None
+            if msg is None:
+                self.bad_frames += 1
+            elif self._with_seq:
+                yield seq, msg
+            else:
+                yield msg
+
+    def reset(self):
+        self.frames.reset()
+
+
+class FramedCodec:
+    name = PROTOCOL_FRAMED
+
+    def encode(self, content, seq=None):
+        return encode_message(content, seq)
+
+    def with_seq(self, data, seq):
+        """data from encode(content) turned into encode(content, seq)."""
+        return data if seq is None else add_seq(data, seq)
+
+    def new_decoder(self, with_seq=False):
+        return FramedMessageDecoder(with_seq)
+
+
+_CODECS = {PROTOCOL_JSON: JsonCodec, PROTOCOL_FRAMED: FramedCodec}
+
+
+def codec(protocol):
+    """Returns the codec for PROTOCOL_JSON or PROTOCOL_FRAMED."""
+    return _CODECS[protocol]()